@@ -6,9 +6,81 @@ Enhanced pikepdfのC++拡張メソッドを活用した正しい実装
 
 import pikepdf
 from PIL import Image
+import numpy as np
 import io
 import os
 import sys
+import zlib
+
+# mozjpegによるロスレス再最適化（任意、ハフマン表・プログレッシブ化のみで画質は変わらない）
+try:
+    import mozjpeg_lossless_optimization
+    MOZJPEG_AVAILABLE = True
+except ImportError:
+    MOZJPEG_AVAILABLE = False
+
+# zlib-ng（任意、zlib互換の出力をSIMDで高速に圧縮）
+try:
+    from zlib_ng import zlib_ng
+    ZLIB_NG_AVAILABLE = True
+except ImportError:
+    ZLIB_NG_AVAILABLE = False
+
+def deflate(data):
+    """
+    FlateDecode用にzlib形式で圧縮
+    zlib-ngがあればレベル6（標準zlibのレベル9と同等以下のサイズで数倍速い）、なければ標準zlibのレベル9
+    """
+    if ZLIB_NG_AVAILABLE:
+        return zlib_ng.compress(data, 6)
+    return zlib.compress(data, 9)
+
+
+def png_predict_deflate(img):
+    """
+    8bitグレースケール画像をPNG予測付きでFlate圧縮
+    行ごとに None/Sub/Up/Average/Paeth のうち差分の絶対値和が最小のフィルタを選ぶ（pngと同じ方式）。
+    /DecodeParms << /Predictor 15 /Colors 1 /BitsPerComponent 8 /Columns 幅 >> で復元できる。
+    """
+    x = np.asarray(img, dtype=np.uint8).astype(np.int16)
+    height, width = x.shape
+    left = np.zeros_like(x)
+    left[:, 1:] = x[:, :-1]
+    up = np.zeros_like(x)
+    up[1:] = x[:-1]
+    upleft = np.zeros_like(x)
+    upleft[1:, 1:] = x[:-1, :-1]
+    
+    # Paeth予測子
+    p = left + up - upleft
+    pa, pb, pc = np.abs(p - left), np.abs(p - up), np.abs(p - upleft)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+    
+    # フィルタ種別 0-4 の順に差分を計算（256で折り返す）
+    filtered = np.stack([x, x - left, x - up, x - ((left + up) >> 1), x - paeth]).astype(np.uint8)
+    cost = np.abs(filtered.view(np.int8).astype(np.int32)).sum(axis=2)
+    best = cost.argmin(axis=0)
+    
+    rows = np.empty((height, width + 1), dtype=np.uint8)
+    rows[:, 0] = best
+    rows[:, 1:] = filtered[best, np.arange(height)]
+    return deflate(rows.tobytes())
+
+
+def encode_jpeg(img, quality=70):
+    """
+    JPEGエンコード
+    mozjpegがあればPillowのハフマン最適化（2パス目のエンコード）の代わりにmozjpegでロスレス再最適化する
+    """
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=not MOZJPEG_AVAILABLE)
+    jpeg_data = output.getvalue()
+    if MOZJPEG_AVAILABLE:
+        optimized = mozjpeg_lossless_optimization.optimize(jpeg_data)
+        if len(optimized) < len(jpeg_data):
+            jpeg_data = optimized
+    return jpeg_data
+
 
 def optimize_pdf_with_correct_smask(input_pdf, output_pdf):
     """正しいSMask処理によるPDF最適化"""
@@ -73,15 +145,16 @@ def optimize_pdf_with_correct_smask(input_pdf, output_pdf):
                         if base_img.size != (width, height):
                             base_img = base_img.resize((width, height), Image.Resampling.LANCZOS)
                         if smask_img.size != (width, height):
-                            smask_img = smask_img.resize((width, height), Image.Resampling.LANCZOS)
+                            # アルファは縮小ならBOX、拡大ならBILINEARで十分（Lanczosは不要）
+                            shrink = smask_img.width >= width and smask_img.height >= height
+                            smask_img = smask_img.resize((width, height), Image.Resampling.BOX if shrink
+                                                         else Image.Resampling.BILINEAR)
                         
                         # ベース画像をJPEG圧縮（品質70）
-                        jpeg_output = io.BytesIO()
-                        base_img.save(jpeg_output, format='JPEG', quality=70, optimize=True)
-                        jpeg_data = jpeg_output.getvalue()
+                        jpeg_data = encode_jpeg(base_img, 70)
                         
-                        # SMaskは生ピクセルデータとして保持（ロスレス）
-                        smask_raw_data = smask_img.tobytes()
+                        # SMaskはPNG予測付きでFlate圧縮（ロスレス）
+                        smask_data = png_predict_deflate(smask_img)
                         
                         # _write_with_smaskメソッドを使用してベース画像を更新
                         if hasattr(obj, '_write_with_smask'):
@@ -102,14 +175,16 @@ def optimize_pdf_with_correct_smask(input_pdf, output_pdf):
                         obj.ColorSpace = pikepdf.Name.DeviceRGB
                         obj.BitsPerComponent = 8
                         
-                        # SMaskを生ピクセルデータで更新（FlateDecode圧縮）
-                        smask_obj.write(smask_raw_data, filter=pikepdf.Name.FlateDecode)
+                        # SMaskを更新（PNG予測付きFlateDecode）
+                        smask_obj.write(smask_data, filter=pikepdf.Name.FlateDecode,
+                                        decode_parms=pikepdf.Dictionary(Predictor=15, Colors=1, BitsPerComponent=8,
+                                                                        Columns=smask_img.width))
                         smask_obj.Width = smask_img.width
                         smask_obj.Height = smask_img.height
                         smask_obj.ColorSpace = pikepdf.Name.DeviceGray
                         smask_obj.BitsPerComponent = 8
                         
-                        print(f"    ✓ Updated: JPEG {len(jpeg_data):,} bytes, SMask {len(smask_raw_data):,} bytes (raw)")
+                        print(f"    ✓ Updated: JPEG {len(jpeg_data):,} bytes, SMask {len(smask_data):,} bytes (Flate)")
                         total_processed += 1
                     
                     # SMaskなし画像の処理
@@ -129,9 +204,7 @@ def optimize_pdf_with_correct_smask(input_pdf, output_pdf):
                             img = img.resize((width, height), Image.Resampling.LANCZOS)
                         
                         # JPEG圧縮
-                        output = io.BytesIO()
-                        img.save(output, format='JPEG', quality=70, optimize=True)
-                        jpeg_data = output.getvalue()
+                        jpeg_data = encode_jpeg(img, 70)
                         
                         # 更新
                         obj.write(jpeg_data, filter=pikepdf.Name.DCTDecode)
@@ -386,7 +386,10 @@ class EnhancedPDFOptimizer:
                     
                     # SMaskのサイズ調整
                     if smask_pil.size != rgb_image.size:
-                        smask_pil = smask_pil.resize(rgb_image.size, Image.Resampling.LANCZOS)
+                        # 滑らかなアルファに高次フィルタは不要: 縮小はBOX、拡大はBILINEAR
+                        shrink = smask_pil.width >= rgb_image.width and smask_pil.height >= rgb_image.height
+                        smask_pil = smask_pil.resize(rgb_image.size, Image.Resampling.BOX if shrink
+                                                     else Image.Resampling.BILINEAR)
                     
                     # SMaskをJPEGで保存
                     if smask_pil.mode != 'L':
@@ -54,6 +54,12 @@ except ImportError:
     print("Warning: scikit-image not available. Quality verification will be limited.")
     SSIM_AVAILABLE = False
 
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -83,6 +89,13 @@ class OptimizationConfig:
     skip_small_images: bool = True
     min_image_size: int = 64  # 64x64未満はスキップ
 
+# 名前付き色空間 → (色空間名, 成分数) の変換テーブル（インポート時に構築）
+_CS_TABLE = {
+    pikepdf.Name('/DeviceRGB'): ('RGB', 3),
+    pikepdf.Name('/DeviceCMYK'): ('CMYK', 4),
+    pikepdf.Name('/DeviceGray'): ('Gray', 1),
+} if PIKEPDF_AVAILABLE else {}
+
 def analyze_colorspace(obj: Any) -> Tuple[str, int]:
     """色空間を安全に分析"""
     try:
@@ -92,15 +105,8 @@ def analyze_colorspace(obj: Any) -> Tuple[str, int]:
             return 'Unknown', 3
             
         if isinstance(colorspace, pikepdf.Name):
-            cs_name = str(colorspace)
-            if cs_name == '/DeviceRGB':
-                return 'RGB', 3
-            elif cs_name == '/DeviceCMYK':
-                return 'CMYK', 4
-            elif cs_name == '/DeviceGray':
-                return 'Gray', 1
-            else:
-                return cs_name, 3
+            # 配列は非ハッシュのため、名前の場合のみテーブル参照
+            return _CS_TABLE.get(colorspace) or (str(colorspace), 3)
                 
         elif isinstance(colorspace, list) or hasattr(colorspace, '__len__'):
             if len(colorspace) >= 2:
@@ -128,9 +134,34 @@ def analyze_colorspace(obj: Any) -> Tuple[str, int]:
         return 'Unknown', 3
         
     except Exception as e:
-        logger.warning(f"色空間分析エラー: {e}")
+        logger.warning("色空間分析エラー: %s", e)
         return 'Error', 3
 
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _cmyk_to_rgb_kernel(cmyk, rgb):
+        """CMYK→RGB変換カーネル（1パスで読み書き、中間配列なし）"""
+        for i in prange(cmyk.shape[0]):
+            for j in range(cmyk.shape[1]):
+                inv_k = 255 - np.int32(cmyk[i, j, 3])
+                rgb[i, j, 0] = (255 - np.int32(cmyk[i, j, 0])) * inv_k // 255
+                rgb[i, j, 1] = (255 - np.int32(cmyk[i, j, 1])) * inv_k // 255
+                rgb[i, j, 2] = (255 - np.int32(cmyk[i, j, 2])) * inv_k // 255
+
+def cmyk_array_to_rgb(cmyk_array: np.ndarray) -> np.ndarray:
+    """単純な数式によるCMYK→RGB変換（(H, W, 4) uint8 → (H, W, 3) uint8）"""
+    if NUMBA_AVAILABLE:
+        rgb_array = np.empty(cmyk_array.shape[:2] + (3,), dtype=np.uint8)
+        _cmyk_to_rgb_kernel(cmyk_array, rgb_array)
+        return rgb_array
+    
+    # NumPyフォールバック: 整数演算で中間配列を最小化
+    inv_k = 255 - cmyk_array[:, :, 3:4].astype(np.uint16)
+    rgb_array = 255 - cmyk_array[:, :, :3].astype(np.uint16)
+    rgb_array *= inv_k
+    rgb_array //= 255
+    return rgb_array.astype(np.uint8)
+
 def safe_cmyk_to_rgb(image_data: bytes, width: int, height: int) -> Image.Image:
     """安全なCMYK→RGB変換"""
     try:
@@ -140,47 +171,62 @@ def safe_cmyk_to_rgb(image_data: bytes, width: int, height: int) -> Image.Image:
         # sRGBプロファイルを使用した変換
         rgb_image = cmyk_image.convert('RGB')
         
-        logger.debug(f"CMYK→RGB変換成功: {cmyk_image.size} -> {rgb_image.size}")
+        logger.debug("CMYK→RGB変換成功: %s -> %s", cmyk_image.size, rgb_image.size)
         return rgb_image
         
     except Exception as e:
-        logger.error(f"CMYK→RGB変換エラー: {e}")
+        logger.error("CMYK→RGB変換エラー: %s", e)
         # フォールバック: 単純な数式変換
         try:
             cmyk_array = np.frombuffer(image_data, dtype=np.uint8)
             cmyk_array = cmyk_array.reshape((height, width, 4))
             
-            c, m, y, k = cmyk_array[:,:,0], cmyk_array[:,:,1], cmyk_array[:,:,2], cmyk_array[:,:,3]
-            
             # 単純なCMYK→RGB変換
-            r = 255 * (1 - c / 255) * (1 - k / 255)
-            g = 255 * (1 - m / 255) * (1 - k / 255)  
-            b = 255 * (1 - y / 255) * (1 - k / 255)
-            
-            rgb_array = np.stack([r, g, b], axis=2).astype(np.uint8)
+            rgb_array = cmyk_array_to_rgb(cmyk_array)
             return Image.fromarray(rgb_array, 'RGB')
             
         except Exception as e2:
-            logger.error(f"フォールバック変換も失敗: {e2}")
+            logger.error("フォールバック変換も失敗: %s", e2)
             raise e
 
-def is_background_image_simple(doc, page_index, xref, verbose=False):
+# ストリップ処理の行数（これを超える出力高さの画像は分割してリサイズ）
+STRIP_ROWS = 2048
+
+def resize_in_strips(img: Image.Image, size: Tuple[int, int],
+                     resample=Image.Resampling.LANCZOS, strip_rows: int = STRIP_ROWS) -> Image.Image:
+    """
+    大きな画像を行ストリップ単位でリサイズ
+    Pillow内部の中間バッファを1ストリップ分に抑え、ピークメモリを削減する
+    （box指定によりフィルタは隣接行も参照するため継ぎ目は出ない）
+    """
+    new_width, new_height = size
+    if new_height <= strip_rows:
+        return img.resize(size, resample)
+    
+    result = Image.new(img.mode, size)
+    scale_y = img.height / new_height
+    for top in range(0, new_height, strip_rows):
+        bottom = min(top + strip_rows, new_height)
+        box = (0, top * scale_y, img.width, bottom * scale_y)
+        strip = img.resize((new_width, bottom - top), resample, box=box)
+        result.paste(strip, (0, top))
+        del strip
+    return result
+
+def is_background_image_simple(doc, page_index, xref, verbose=False, page_xrefs=None):
     """
     背景画像判定（簡略版）
     PyMuPDF版から移植
+    
+    page_xrefs: ページ上の画像xrefの集合（省略時はpage.get_images()から作成）
     """
     try:
         page = doc[page_index]
-        img_list = page.get_images()
+        if page_xrefs is None:
+            page_xrefs = {img_item[0] for img_item in page.get_images()}
         
-        # xrefに対応する画像を検索
-        img_entry = None
-        for img_item in img_list:
-            if img_item[0] == xref:
-                img_entry = img_item
-                break
-                
-        if not img_entry:
+        # xrefに対応する画像がページ上に無ければ対象外
+        if xref not in page_xrefs:
             return False
             
         # 画像サイズ情報を取得
@@ -238,9 +284,13 @@ def is_background_image_simple(doc, page_index, xref, verbose=False):
             print(f"        背景判定エラー: {e}")
         return False
 
-def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, quality=70, image_dpi=150, preserve_background=False, verbose=True):
+def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, quality=70, image_dpi=150, preserve_background=False, verbose=True,
+                                                    pdf=None, doc=None):
     """
     Enhanced pikepdf C++拡張を使った完全なJPEG+SMask分離処理
+    
+    pdf（pikepdf）/ doc（PyMuPDF）を渡した場合はそれを使用し、保存とクローズは呼び出し側で行う。
+    省略時は pdf_path を開いて処理し、同じパスに上書き保存する。
     """
     if not PIKEPDF_AVAILABLE:
         if verbose:
@@ -251,18 +301,33 @@ def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, qualit
         if verbose:
             print(f"    Enhanced pikepdf JPEG+SMask分離を実行中 (品質={quality})")
         
-        pdf = pikepdf.Pdf.open(pdf_path, allow_overwriting_input=True)
+        owns_pdf = pdf is None
+        if owns_pdf:
+            pdf = pikepdf.Pdf.open(pdf_path, allow_overwriting_input=True)
         page = pdf.pages[page_index]
         
         if '/Resources' not in page or '/XObject' not in page['/Resources']:
-            pdf.close()
+            if owns_pdf:
+                pdf.close()
             return 0
             
         xobjects = page['/Resources']['/XObject']
         images_processed = 0
         
         # PyMuPDF版で背景画像を事前判定
-        doc = fitz.open(pdf_path)
+        owns_doc = doc is None
+        if owns_doc:
+            doc = fitz.open(pdf_path)
+        
+        # 背景画像のxrefをページ単位で一度だけ判定
+        bg_xrefs = set()
+        if not preserve_background:
+            try:
+                page_xrefs = {img_item[0] for img_item in doc[page_index].get_images()}
+                bg_xrefs = {x for x in page_xrefs
+                            if is_background_image_simple(doc, page_index, x, verbose=verbose, page_xrefs=page_xrefs)}
+            except:
+                pass
         
         for name, obj in list(xobjects.items()):
             if not ('/Subtype' in obj and obj['/Subtype'] == '/Image'):
@@ -286,19 +351,8 @@ def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, qualit
                 if verbose:
                     print(f"      画像 {name}: {width}x{height}, {colorspace_name}, SMask={has_smask}")
                 
-                # 背景画像判定（PyMuPDF版を利用）
-                is_background = False
-                if not preserve_background:
-                    try:
-                        # xrefを取得するため PyMuPDF版を併用
-                        img_list = doc[page_index].get_images()
-                        for img_item in img_list:
-                            # 画像名でマッチング（近似）
-                            if is_background_image_simple(doc, page_index, img_item[0], verbose=verbose):
-                                is_background = True
-                                break
-                    except:
-                        pass
+                # 背景画像判定（pikepdfのオブジェクト番号 = PyMuPDFのxref）
+                is_background = obj.objgen[0] in bg_xrefs
                 
                 # 画像データの読み込み
                 try:
@@ -323,8 +377,13 @@ def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, qualit
                             if 'CMYK' in colorspace_name:
                                 base_img = safe_cmyk_to_rgb(raw_data, width, height)
                             else:
-                                mode = 'RGB' if n_components == 3 else ('L' if n_components == 1 else 'RGBA')
-                                pil_img = Image.frombytes(mode, (width, height), raw_data)
+                                # NumPyビュー経由で直接PIL画像化（frombytesの内部コピーを回避）
+                                pixel_array = np.frombuffer(raw_data, dtype=np.uint8)
+                                if n_components == 1:
+                                    pixel_array = pixel_array.reshape(height, width)
+                                else:
+                                    pixel_array = pixel_array.reshape(height, width, 3 if n_components == 3 else 4)
+                                pil_img = Image.fromarray(pixel_array)
                                 if pil_img.mode != 'RGB':
                                     base_img = pil_img.convert('RGB')
                                 else:
@@ -346,9 +405,15 @@ def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, qualit
                     estimated_dpi = max(width, height) / 8  # 概算
                     if estimated_dpi > image_dpi:
                         scale_factor = image_dpi / estimated_dpi
-                        new_size = (max(1, int(base_img.width * scale_factor)),
-                                  max(1, int(base_img.height * scale_factor)))
-                        base_img = base_img.resize(new_size, Image.Resampling.LANCZOS)
+                        reduce_factor = round(1 / scale_factor)
+                        if reduce_factor in (2, 4) and abs(scale_factor * reduce_factor - 1) < 0.05:
+                            # 1/2・1/4縮小はボックス平均（C実装）で高速処理
+                            base_img = base_img.reduce(reduce_factor)
+                        else:
+                            new_size = (max(1, int(base_img.width * scale_factor)),
+                                      max(1, int(base_img.height * scale_factor)))
+                            base_img = resize_in_strips(base_img, new_size)
+                        new_size = base_img.size
                         if verbose:
                             print(f"        DPI制限適用: {width}x{height} -> {new_size}")
                 
@@ -359,14 +424,15 @@ def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, qualit
                     original_size = base_img.size
                     ultra_size = (max(1, original_size[0] // 4), max(1, original_size[1] // 4))
                     base_img = base_img.resize(ultra_size, Image.Resampling.LANCZOS)
-                    base_img = base_img.resize(original_size, Image.Resampling.LANCZOS)
+                    base_img = resize_in_strips(base_img, original_size)
                     jpeg_quality = 1  # 最低品質
                     if verbose:
                         print(f"        背景超劣化適用: {original_size} -> {ultra_size} -> {original_size}, 品質{jpeg_quality}")
                 
-                # JPEG変換
+                # JPEG変換（低品質時はハフマン最適化の効果が小さいため省略）
+                optimize_huffman = jpeg_quality > 20
                 jpeg_output = io.BytesIO()
-                base_img.save(jpeg_output, format='JPEG', quality=jpeg_quality, optimize=True)
+                base_img.save(jpeg_output, format='JPEG', quality=jpeg_quality, optimize=optimize_huffman)
                 jpeg_data = jpeg_output.getvalue()
                 
                 # SMask処理
@@ -387,16 +453,16 @@ def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, qualit
                             # フォールバック
                             smask_pil = Image.new('L', base_img.size, 255)
                         
-                        # SMaskサイズ調整
-                        if smask_pil.size != base_img.size:
-                            smask_pil = smask_pil.resize(base_img.size, Image.Resampling.LANCZOS)
-                        
                         if smask_pil.mode != 'L':
                             smask_pil = smask_pil.convert('L')
                         
+                        # SMaskサイズ調整（マスクは低周波なのでBILINEARで十分）
+                        if smask_pil.size != base_img.size:
+                            smask_pil = smask_pil.resize(base_img.size, Image.Resampling.BILINEAR)
+                        
                         # SMaskをJPEGで保存
                         smask_output = io.BytesIO()
-                        smask_pil.save(smask_output, format='JPEG', quality=jpeg_quality, optimize=True)
+                        smask_pil.save(smask_output, format='JPEG', quality=jpeg_quality, optimize=optimize_huffman)
                         smask_data = smask_output.getvalue()
                         
                         # Enhanced pikepdf C++メソッドを使用してSMask参照を保持
@@ -445,16 +511,11 @@ def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, qualit
                     print(f"        画像処理エラー {name}: {e}")
                 continue
         
-        # PDF保存（強制的にストリーム更新）
-        try:
-            if hasattr(pdf, 'updateAllPagesCache'):
-                pdf.updateAllPagesCache()  # Enhanced pikepdf の強制更新メソッド
-        except:
-            pass  # 標準pikepdfの場合は無視
-            
-        pdf.save(pdf_path)
-        pdf.close()
-        doc.close()
+        if owns_doc:
+            doc.close()
+        if owns_pdf:
+            save_enhanced_pdf(pdf, pdf_path)
+            pdf.close()
         
         if verbose:
             print(f"    Enhanced pikepdf処理完了: {images_processed}個の画像を処理")
@@ -466,6 +527,21 @@ def complete_jpeg_smask_separation_enhanced_pikepdf(pdf_path, page_index, qualit
             print(f"    Enhanced pikepdf処理エラー: {e}")
         return 0
 
+def save_enhanced_pdf(pdf, output_path):
+    """PDF保存（Enhanced pikepdfの場合は強制的にストリーム更新）"""
+    try:
+        if hasattr(pdf, 'updateAllPagesCache'):
+            pdf.updateAllPagesCache()  # Enhanced pikepdf の強制更新メソッド
+    except:
+        pass  # 標準pikepdfの場合は無視
+    
+    # 画像ストリームは再圧縮済みのため、既存Flateストリームの再圧縮は行わない
+    pdf.save(output_path,
+             linearize=False,
+             compress_streams=True,
+             object_stream_mode=pikepdf.ObjectStreamMode.generate,
+             recompress_flate=False)
+
 def optimize_pdf_with_smask_separation_enhanced(input_path, output_path, quality=70, image_dpi=150, preserve_background=False, verbose=True):
     """
     Enhanced pikepdf統合版メイン最適化関数
@@ -476,19 +552,20 @@ def optimize_pdf_with_smask_separation_enhanced(input_path, output_path, quality
             print(f"Error: Input file not found: {input_path}")
             return False
             
-        # 作業用コピー作成
-        import shutil
-        temp_path = input_path + ".temp"
-        shutil.copy2(input_path, temp_path)
-        
+        if not PIKEPDF_AVAILABLE:
+            print("Error: pikepdf is required for enhanced optimization")
+            return False
+            
         if verbose:
             original_size = os.path.getsize(input_path)
             print(f"Enhanced PDF最適化開始")
             print(f"入力: {input_path} ({original_size:,} bytes)")
         
-        # Enhanced pikepdf処理
+        # Enhanced pikepdf処理（入力は読み取り専用で開き、出力へ直接保存）
         try:
-            doc = fitz.open(temp_path)
+            overwrite = os.path.abspath(input_path) == os.path.abspath(output_path)
+            pdf = pikepdf.Pdf.open(input_path, allow_overwriting_input=overwrite)
+            doc = fitz.open(input_path)
             total_processed = 0
             
             for page_index in range(len(doc)):
@@ -496,21 +573,20 @@ def optimize_pdf_with_smask_separation_enhanced(input_path, output_path, quality
                     print(f"\nページ {page_index + 1}/{len(doc)} 処理中...")
                 
                 processed = complete_jpeg_smask_separation_enhanced_pikepdf(
-                    temp_path, page_index, quality=quality, 
+                    input_path, page_index, quality=quality, 
                     image_dpi=image_dpi, preserve_background=preserve_background, 
-                    verbose=verbose
+                    verbose=verbose, pdf=pdf, doc=doc
                 )
                 total_processed += processed
             
             doc.close()
+            save_enhanced_pdf(pdf, output_path)
+            pdf.close()
             
         except Exception as e:
             print(f"Enhanced pikepdf処理でエラー: {e}")
             return False
         
-        # 結果をコピー
-        shutil.move(temp_path, output_path)
-        
         if verbose:
             final_size = os.path.getsize(output_path)
             reduction = (1 - final_size / original_size) * 100 if original_size > 0 else 0
@@ -523,8 +599,6 @@ def optimize_pdf_with_smask_separation_enhanced(input_path, output_path, quality
         
     except Exception as e:
         print(f"PDF最適化エラー: {e}")
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
         return False
 
 def main():
@@ -1,25 +1,356 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import hashlib
+import io
+import logging
+import logging.handlers
 import os
+import queue
+import shutil
+import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+from PIL import Image
+
+log = logging.getLogger("pdfopt")
+
+# PyMuPDF is imported on first use (see _import_pymupdf) so that --help and
+# argument errors do not pay for loading the MuPDF bindings
+pymupdf = None
+
+# numpy and Numba are loaded the same way (see _import_numpy and
+# _grayscale_kernel); together they take longer to import than PyMuPDF
+np = None
+prange = None
+_rgb_to_gray_jit = None  # False once Numba is known to be missing
+
 try:
-    import fitz  # PyMuPDF
-    pymupdf = fitz
+    import deflate as libdeflate  # libdeflate bindings
+    LIBDEFLATE_AVAILABLE = True
 except ImportError:
+    LIBDEFLATE_AVAILABLE = False
+
+# libdeflate level used for stream recompression (level 10 is both smaller
+# and faster than the maximum level 12 on typical PDF streams)
+LIBDEFLATE_LEVEL = 10
+
+
+def _save_with_libdeflate(doc, output_path, save_options, level=LIBDEFLATE_LEVEL):
+    """
+    Save via MuPDF without deflate, then compress streams with libdeflate.
+    
+    MuPDF still performs garbage collection and cleaning; every stream it
+    leaves unfiltered is then deflated with libdeflate and the document is
+    written through pikepdf.
+    """
+    import pikepdf
+    
+    raw_options = dict(save_options, deflate=False, deflate_images=False, deflate_fonts=False)
+    raw_options.pop('compression_effort', None)
+    buffer = io.BytesIO()
+    doc.save(buffer, **raw_options)
+    buffer.seek(0)
+    
+    with pikepdf.open(buffer) as pdf:
+        for obj in pdf.objects:
+            if isinstance(obj, pikepdf.Stream) and '/Filter' not in obj:
+                data = bytes(libdeflate.zlib_compress(obj.read_raw_bytes(), level))
+                obj.write(data, filter=pikepdf.Name.FlateDecode)
+        pdf.save(output_path,
+                 compress_streams=False,
+                 stream_decode_level=pikepdf.StreamDecodeLevel.none,
+                 object_stream_mode=pikepdf.ObjectStreamMode.generate)
+
+
+def _import_pymupdf():
+    """Import PyMuPDF once and bind it to the module-level ``pymupdf`` name."""
+    global pymupdf
+    if pymupdf is None:
+        try:
+            import fitz as module  # PyMuPDF
+        except ImportError:
+            try:
+                import pymupdf as module
+            except ImportError:
+                print("Error: PyMuPDF is not installed.")
+                print("Please install it with: pip install PyMuPDF")
+                sys.exit(1)
+        pymupdf = module
+    return pymupdf
+
+
+def _import_numpy():
+    """Import numpy once and bind it to the module-level ``np`` name."""
+    global np
+    if np is None:
+        import numpy as module
+        np = module
+    return np
+
+
+# BLAKE2 digests of embedded font programs that subset_fonts() could not shrink
+# (typically fonts that were already subset upstream). Shared by every file
+# optimized in this process: when all fonts of a document are in this set,
+# subsetting is skipped.
+_NO_GAIN_FONT_DIGESTS = set()
+
+
+def _font_programs(doc):
+    """(BLAKE2 digest, decoded length) of each embedded font program, keyed by xref."""
+    programs = {}
+    for xref in range(1, doc.xref_length()):
+        if doc.xref_get_key(xref, 'Type')[1] != '/FontDescriptor':
+            continue
+        for key in ('FontFile', 'FontFile2', 'FontFile3'):
+            kind, value = doc.xref_get_key(xref, key)
+            if kind == 'xref':
+                font_xref = int(value.split()[0])
+                data = doc.xref_stream(font_xref)
+                programs[font_xref] = (hashlib.blake2b(data, digest_size=16).digest(), len(data))
+    return programs
+
+
+def _subset_fonts_cached(doc):
+    """
+    Run doc.subset_fonts() unless no embedded font is expected to shrink.
+    
+    Returns None if subsetting ran, otherwise the reason it was skipped.
+    """
+    before = _font_programs(doc)
+    if not before:
+        return "no embedded fonts"
+    if all(digest in _NO_GAIN_FONT_DIGESTS for digest, _ in before.values()):
+        return "embedded fonts already minimal"
+    
+    doc.subset_fonts()
+    after = _font_programs(doc)
+    for xref, (digest, length) in before.items():
+        if xref in after and after[xref][1] >= length:
+            _NO_GAIN_FONT_DIGESTS.add(digest)
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _save_option_supported(option, value):
+    """Probe once per process whether this MuPDF build accepts a doc.save() option."""
+    probe = pymupdf.open()
+    probe.new_page()
     try:
-        import pymupdf
-        fitz = pymupdf
-    except ImportError:
-        print("Error: PyMuPDF is not installed.")
-        print("Please install it with: pip install PyMuPDF")
-        sys.exit(1)
+        probe.save(io.BytesIO(), **{option: value})
+        return True
+    except TypeError:
+        return False
+    finally:
+        probe.close()
+
+
+def _unique_image_xrefs(doc):
+    """
+    Xrefs of all image XObjects in the document, each listed once.
+    
+    Walks the xref table instead of page.get_images(), so an image shared by
+    many pages is only visited once.
+    """
+    return {xref for xref in range(1, doc.xref_length())
+            if doc.xref_get_key(xref, 'Subtype')[1] == '/Image'}
+
+
+def _has_images(doc):
+    """True if the document contains at least one image XObject (stops at the first)."""
+    return any(doc.xref_get_key(xref, 'Subtype')[1] == '/Image'
+               for xref in range(1, doc.xref_length()))
+
+
+def _replace_jpeg_stream(doc, xref, jpeg_data):
+    """Replace an image XObject's stream with JPEG data, keeping its other keys."""
+    doc.update_stream(xref, jpeg_data, compress=False)
+    doc.xref_set_key(xref, "Filter", "/DCTDecode")
+
+
+def _mozjpeg_encode(jpeg_data, quality, cjpeg_path):
+    """Re-encode JPEG data with mozjpeg's cjpeg (which accepts JPEG input)."""
+    completed = subprocess.run(
+        [cjpeg_path, '-quality', str(quality)],
+        input=jpeg_data, capture_output=True, check=True
+    )
+    return completed.stdout
+
+
+def _recompress_jpegs_with_mozjpeg(doc, quality, cjpeg_path):
+    """
+    Re-encode every gray/RGB JPEG image with mozjpeg, keeping smaller results.
+    
+    Returns the number of replaced images.
+    """
+    replaced = 0
+    for xref in _unique_image_xrefs(doc):
+        try:
+            info = doc.extract_image(xref)
+            if not info or info['ext'] not in ('jpg', 'jpeg') or info['colorspace'] not in (1, 3):
+                continue
+            original = info['image']
+            encoded = _mozjpeg_encode(original, quality, cjpeg_path)
+            if encoded and len(encoded) < len(original):
+                _replace_jpeg_stream(doc, xref, encoded)
+                replaced += 1
+        except Exception:
+            continue
+    return replaced
+
+
+def _rgb_to_gray(rgb):
+    """RGB→luma (77R + 150G + 29B) >> 8, one pass over the pixels (compiled by _grayscale_kernel)."""
+    height, width = rgb.shape[0], rgb.shape[1]
+    gray = np.empty((height, width), dtype=np.uint8)
+    for y in prange(height):
+        for x in range(width):
+            gray[y, x] = (77 * np.int32(rgb[y, x, 0]) + 150 * np.int32(rgb[y, x, 1])
+                          + 29 * np.int32(rgb[y, x, 2])) >> 8
+    return gray
+
+
+def _grayscale_kernel():
+    """Import Numba on first call and return the JIT-compiled _rgb_to_gray (None without Numba)."""
+    global _rgb_to_gray_jit, prange
+    if _rgb_to_gray_jit is None:
+        _import_numpy()
+        try:
+            from numba import njit, prange
+        except ImportError:
+            _rgb_to_gray_jit = False
+        else:
+            _rgb_to_gray_jit = njit(parallel=True, cache=True)(_rgb_to_gray)
+    return _rgb_to_gray_jit or None
+
+
+def _to_grayscale(pil_img):
+    """Convert a PIL image to mode L, using the Numba kernel for RGB when available."""
+    kernel = _grayscale_kernel() if pil_img.mode == 'RGB' else None
+    if kernel is not None:
+        return Image.fromarray(kernel(np.asarray(pil_img)))
+    return pil_img.convert('L')
+
+
+def _warm_grayscale_kernel():
+    """Compile (or load from cache) the grayscale kernel before a batch starts."""
+    kernel = _grayscale_kernel()
+    if kernel is not None:
+        kernel(np.zeros((1, 1, 3), dtype=np.uint8))
+
+
+def _display_dpi(page, xref, width, height):
+    """Lowest effective DPI at which an image is drawn on a page (None if not drawn)."""
+    rects = page.get_image_rects(xref)
+    if not rects:
+        return None
+    largest = max(rects, key=lambda rect: rect.width * rect.height)
+    if largest.width <= 0 or largest.height <= 0:
+        return None
+    return min(width * 72 / largest.width, height * 72 / largest.height)
+
+
+def _resample_images_externally(doc, dpi_threshold, dpi_target, quality, grayscale):
+    """
+    Downscale images above dpi_threshold with Pillow (Lanczos) and re-embed as JPEG.
+    
+    Only plain gray/RGB images are handled here; images with an SMask, color
+    key mask or Decode array are left to MuPDF's rewrite_images pass.
+    Returns the number of resampled images.
+    """
+    resampled = 0
+    seen = set()
+    for page in doc.pages():
+        for img in page.get_images(full=True):
+            xref, smask, width, height = img[0], img[1], img[2], img[3]
+            if xref in seen:
+                continue
+            seen.add(xref)
+            if smask:
+                continue
+            try:
+                if (doc.xref_get_key(xref, "Mask")[0] != 'null'
+                        or doc.xref_get_key(xref, "Decode")[0] != 'null'):
+                    continue
+                
+                dpi = _display_dpi(page, xref, width, height)
+                if dpi is None or dpi <= dpi_threshold:
+                    continue
+                
+                info = doc.extract_image(xref)
+                if not info or info['colorspace'] not in (1, 3):
+                    continue
+                
+                scale = dpi_target / dpi
+                new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                pil_img = Image.open(io.BytesIO(info['image']))
+                mode = 'L' if grayscale or info['colorspace'] == 1 else 'RGB'
+                if mode == 'L' and pil_img.mode != 'L':
+                    pil_img = _to_grayscale(pil_img)
+                elif pil_img.mode != mode:
+                    pil_img = pil_img.convert(mode)
+                pil_img = pil_img.resize(new_size, Image.Resampling.LANCZOS)
+                
+                output = io.BytesIO()
+                pil_img.save(output, format='JPEG', quality=quality)
+                
+                _replace_jpeg_stream(doc, xref, output.getvalue())
+                doc.xref_set_key(xref, "Width", str(new_size[0]))
+                doc.xref_set_key(xref, "Height", str(new_size[1]))
+                doc.xref_set_key(xref, "BitsPerComponent", "8")
+                doc.xref_set_key(xref, "DecodeParms", "null")
+                if info['ext'] not in ('jpg', 'jpeg') or mode == 'L':
+                    doc.xref_set_key(xref, "ColorSpace", "/DeviceGray" if mode == 'L' else "/DeviceRGB")
+                resampled += 1
+            except Exception:
+                continue
+    return resampled
+
+
+def _trim_to_artbox(doc):
+    """
+    Set each page's crop box to its art box where the two differ.
+    
+    Art boxes and page rects are collected in a single pass and compared as
+    (N, 4) arrays, so set_cropbox is only called for pages that change.
+    Returns the number of trimmed pages.
+    """
+    _import_numpy()
+    page_count = doc.page_count
+    artboxes = np.zeros((page_count, 4))
+    rects = np.zeros((page_count, 4))
+    has_artbox = np.zeros(page_count, dtype=bool)
+    
+    for index, page in enumerate(doc.pages()):
+        try:
+            artbox = page.artbox
+            if artbox:
+                artboxes[index] = tuple(artbox)
+                rects[index] = tuple(page.rect)
+                has_artbox[index] = True
+        except Exception:
+            pass
+    
+    changed = np.flatnonzero(has_artbox & np.any(artboxes != rects, axis=1))
+    
+    trimmed_count = 0
+    for index in changed:
+        try:
+            page = doc[int(index)]
+            page.set_cropbox(page.artbox)
+            trimmed_count += 1
+        except Exception:
+            pass
+    return trimmed_count
 
 
 def optimize_pdf_final(input_path, output_path, optimization_level=4, image_dpi=150, 
-                       trim_to_artbox=True, grayscale=False, verbose=True):
+                       trim_to_artbox=True, grayscale=False, deflate_effort=None,
+                       use_libdeflate=False, jpeg_encoder='mupdf', external_resample=False,
+                       streaming_save=False, original_size=None, verbose=True):
     """
     Final PDF optimization - conservative but effective approach.
     
@@ -30,155 +361,191 @@ def optimize_pdf_final(input_path, output_path, optimization_level=4, image_dpi=
         image_dpi: Target DPI for images (default: 150)
         trim_to_artbox: Whether to trim to art box (default: True)
         grayscale: Convert color images to grayscale (default: False)
-        verbose: Print progress messages
+        deflate_effort: Deflate compression effort 1-100 for levels 3+
+                        (default: 20 for level 3, 50 for level 4)
+        use_libdeflate: Compress streams with libdeflate instead of MuPDF's
+                        deflate (requires the 'deflate' package; default: False)
+        jpeg_encoder: 'mupdf' (default) or 'mozjpeg' to re-encode JPEG images
+                      with mozjpeg's cjpeg after MuPDF's image pass (levels 3+)
+        external_resample: Downscale plain gray/RGB images with Pillow before
+                           MuPDF's image pass (levels 3+; default: False)
+        streaming_save: Let MuPDF write straight to output_path instead of
+                        serializing in memory first (for very large PDFs)
+        original_size: Input file size in bytes if already known (avoids a stat)
+        verbose: Log progress at INFO level (DEBUG when False) on the
+                 "pdfopt" logger
     
     Returns:
         dict: Optimization results including file sizes and compression ratio
     """
+    _import_pymupdf()
+    
+    progress = logging.INFO if verbose else logging.DEBUG
+    
     try:
-        # Open the PDF document
-        doc = pymupdf.open(input_path)
-        
-        # Check if password protected
-        if doc.needs_pass:
-            raise ValueError("Password protected PDFs are not supported")
-        
-        # Get original file size
-        original_size = os.path.getsize(input_path)
-        
-        if verbose:
-            print(f"Processing: {input_path}")
-            print(f"Original size: {original_size:,} bytes")
-            print(f"Optimization level: {optimization_level}")
-            print(f"Image DPI: {image_dpi}")
-            print(f"Trim to art box: {trim_to_artbox}")
-            print(f"Grayscale conversion: {grayscale}")
-        
-        # Trim to art box if requested
-        if trim_to_artbox:
+        with pymupdf.open(input_path) as doc:
+            # Check if password protected
+            if doc.needs_pass:
+                raise ValueError("Password protected PDFs are not supported")
+            
+            # Get original file size
+            if original_size is None:
+                original_size = os.stat(input_path).st_size
+            
+            log.log(progress, "Processing: %s", input_path)
+            log.log(progress, "Original size: %d bytes", original_size)
+            log.log(progress, "Optimization level: %d", optimization_level)
+            log.log(progress, "Image DPI: %d", image_dpi)
+            log.log(progress, "Trim to art box: %s", trim_to_artbox)
+            log.log(progress, "Grayscale conversion: %s", grayscale)
+            
+            # Trim to art box if requested
             trimmed_count = 0
-            for page_num in range(len(doc)):
-                page = doc[page_num]
+            if trim_to_artbox:
+                trimmed_count = _trim_to_artbox(doc)
+                if trimmed_count > 0:
+                    log.log(progress, "  Trimmed %d page(s) to art box", trimmed_count)
+            
+            # Level 1: Basic cleaning
+            scrubbed = False
+            if optimization_level >= 1:
                 try:
-                    artbox = page.artbox
-                    if artbox and artbox != page.rect:
-                        page.set_cropbox(artbox)
-                        trimmed_count += 1
-                except:
-                    pass
-            if verbose and trimmed_count > 0:
-                print(f"  Trimmed {trimmed_count} page(s) to art box")
-        
-        # Level 1: Basic cleaning
-        if optimization_level >= 1:
-            try:
-                doc.scrub(
-                    attached_files=False,
-                    clean_pages=True,
-                    embedded_files=False,
-                    hidden_text=False,
-                    javascript=True,
-                    metadata=True,
-                    redactions=True,
-                    redact_images=0,
-                    remove_links=False,
-                    reset_fields=True,
-                    reset_responses=True,
-                    thumbnails=True,
-                    xml_metadata=True
-                )
-                if verbose:
-                    print("  Applied document cleaning")
-            except Exception as e:
-                if verbose:
-                    print(f"  Warning: Document cleaning failed: {e}")
-        
-        # Level 2: Font optimization
-        if optimization_level >= 2:
-            try:
-                doc.subset_fonts()
-                if verbose:
-                    print("  Applied font subsetting")
-            except Exception as e:
-                if verbose:
-                    print(f"  Warning: Font subsetting failed: {e}")
-        
-        # Level 3+: Image optimization with conservative settings
-        if optimization_level >= 3:
-            # Only attempt image optimization with very conservative settings
-            try:
-                # Conservative quality settings to avoid destroying images
-                if optimization_level == 3:
-                    quality = 85  # High quality
-                    dpi_threshold = image_dpi * 3  # Only very high DPI images
-                else:  # level 4
-                    quality = 75  # Good quality
-                    dpi_threshold = image_dpi * 2  # Moderate threshold
-                
-                if verbose:
-                    print(f"  Attempting conservative image optimization (quality={quality}, threshold={dpi_threshold} DPI)")
-                
-                # Try image optimization with safe parameters
-                rewrite_params = {
-                    'dpi_threshold': int(dpi_threshold),
-                    'dpi_target': int(image_dpi),
-                    'quality': quality,
-                    'lossy': True,
-                    'lossless': True,  # Allow lossless for small improvements
-                    'set_to_gray': grayscale
-                }
-                
-                doc.rewrite_images(**rewrite_params)
-                if verbose:
-                    print("  Applied image optimization")
+                    doc.scrub(
+                        attached_files=False,
+                        clean_pages=True,
+                        embedded_files=False,
+                        hidden_text=False,
+                        javascript=True,
+                        metadata=True,
+                        redactions=True,
+                        redact_images=0,
+                        remove_links=False,
+                        reset_fields=True,
+                        reset_responses=True,
+                        thumbnails=True,
+                        xml_metadata=True
+                    )
+                    scrubbed = True
+                    log.log(progress, "  Applied document cleaning")
+                except Exception as e:
+                    log.warning("  Warning: Document cleaning failed: %s", e)
+            
+            # Level 2: Font optimization
+            if optimization_level >= 2:
+                try:
+                    skipped = _subset_fonts_cached(doc)
+                    if skipped:
+                        log.log(progress, "  Font subsetting skipped (%s)", skipped)
+                    else:
+                        log.log(progress, "  Applied font subsetting")
+                except Exception as e:
+                    log.warning("  Warning: Font subsetting failed: %s", e)
+            
+            # Level 3+: Image optimization with conservative settings
+            if optimization_level >= 3 and not _has_images(doc):
+                log.log(progress, "  No images, skipping image optimization")
+            elif optimization_level >= 3:
+                # Only attempt image optimization with very conservative settings
+                try:
+                    # Conservative quality settings to avoid destroying images
+                    if optimization_level == 3:
+                        quality = 85  # High quality
+                        dpi_threshold = image_dpi * 3  # Only very high DPI images
+                    else:  # level 4
+                        quality = 75  # Good quality
+                        dpi_threshold = image_dpi * 2  # Moderate threshold
                     
-            except Exception as e:
-                if verbose:
-                    print(f"  Note: Image optimization skipped: {e}")
-        
-        # Save with appropriate compression settings
-        save_options = {
-            'garbage': min(optimization_level, 4),
-            'deflate': True,
-            'deflate_images': True,
-            'deflate_fonts': True,
-            'clean': True,
-            'pretty': False,
-            'preserve_metadata': False,
-        }
-        
-        # Add advanced options for higher levels
-        if optimization_level >= 3:
-            save_options['use_objstms'] = True
-        
-        if optimization_level >= 4:
-            try:
-                # Try compression_effort if available
-                save_options['compression_effort'] = 50  # Moderate effort
-            except:
-                pass
-        
-        # Save the optimized document
-        try:
-            doc.save(output_path, **save_options)
-        except TypeError:
-            # Remove unsupported options and retry
-            if 'compression_effort' in save_options:
-                del save_options['compression_effort']
-                if verbose:
-                    print("  Note: Advanced compression options not available")
-            doc.save(output_path, **save_options)
-        
-        doc.close()
+                    log.log(progress, "  Attempting conservative image optimization (quality=%d, threshold=%d DPI)",
+                            quality, dpi_threshold)
+                    
+                    # Try image optimization with safe parameters
+                    rewrite_params = {
+                        'dpi_threshold': int(dpi_threshold),
+                        'dpi_target': int(image_dpi),
+                        'quality': quality,
+                        'lossy': True,
+                        'lossless': True,  # Allow lossless for small improvements
+                        'set_to_gray': grayscale
+                    }
+                    
+                    if external_resample:
+                        resampled = _resample_images_externally(
+                            doc, dpi_threshold, image_dpi, quality, grayscale)
+                        log.log(progress, "  Resampled %d image(s) with Pillow", resampled)
+                    
+                    doc.rewrite_images(**rewrite_params)
+                    log.log(progress, "  Applied image optimization")
+                    
+                    if jpeg_encoder == 'mozjpeg':
+                        cjpeg_path = shutil.which('cjpeg')
+                        if cjpeg_path:
+                            replaced = _recompress_jpegs_with_mozjpeg(doc, quality, cjpeg_path)
+                            log.log(progress, "  Re-encoded %d JPEG image(s) with mozjpeg", replaced)
+                        else:
+                            log.log(progress, "  Note: cjpeg not found, mozjpeg re-encoding skipped")
+                        
+                except Exception as e:
+                    log.log(progress, "  Note: Image optimization skipped: %s", e)
+            
+            # Save with appropriate compression settings
+            save_options = {
+                'garbage': min(optimization_level, 4),
+                'deflate': True,
+                'deflate_images': True,
+                'deflate_fonts': True,
+                # scrub(clean_pages=True) already cleaned the content streams
+                'clean': not scrubbed,
+                'pretty': False,
+                'preserve_metadata': False,
+            }
+            
+            # Add advanced options for higher levels (when this MuPDF build supports them)
+            if optimization_level >= 3 and _save_option_supported('use_objstms', True):
+                save_options['use_objstms'] = True
+            
+            if optimization_level >= 3:
+                if deflate_effort is None:
+                    deflate_effort = 20 if optimization_level == 3 else 50
+                if _save_option_supported('compression_effort', deflate_effort):
+                    save_options['compression_effort'] = deflate_effort
+                else:
+                    log.log(progress, "  Note: Advanced compression options not available, "
+                            "using default deflate level")
+            
+            if use_libdeflate and not LIBDEFLATE_AVAILABLE:
+                use_libdeflate = False
+                log.log(progress, "  Note: libdeflate not available, using MuPDF deflate")
+            
+            # Save the optimized document
+            optimized_size = None
+            if not doc.is_dirty and trimmed_count == 0:
+                # Nothing changed: copy the input instead of re-serializing it
+                if os.path.abspath(input_path) != os.path.abspath(output_path):
+                    shutil.copyfile(input_path, output_path)
+                log.log(progress, "  No changes made, copied input unchanged")
+            elif use_libdeflate:
+                _save_with_libdeflate(doc, output_path, save_options)
+                log.log(progress, "  Compressed streams with libdeflate (level %d)", LIBDEFLATE_LEVEL)
+            elif streaming_save:
+                doc.save(output_path, **save_options)
+            else:
+                # Serialize in memory and write the file in one go
+                buffer = io.BytesIO()
+                doc.save(buffer, **save_options)
+                data = buffer.getvalue()
+                optimized_size = len(data)
+                Path(output_path).write_bytes(data)
         
         # Calculate results
-        optimized_size = os.path.getsize(output_path)
+        if optimized_size is None:
+            optimized_size = os.stat(output_path, follow_symlinks=False).st_size
         compression_ratio = (1 - optimized_size / original_size) * 100
         
-        if verbose:
-            print(f"Optimized size: {optimized_size:,} bytes")
-            print(f"Compression ratio: {compression_ratio:.1f}%")
-            print(f"Saved to: {output_path}")
+        if 'compression_effort' in save_options and not use_libdeflate:
+            log.log(progress, "Deflate effort: %d", save_options['compression_effort'])
+        log.log(progress, "Optimized size: %d bytes", optimized_size)
+        log.log(progress, "Compression ratio: %.1f%%", compression_ratio)
+        log.log(progress, "Saved to: %s", output_path)
         
         return {
             'success': True,
@@ -189,22 +556,56 @@ def optimize_pdf_final(input_path, output_path, optimization_level=4, image_dpi=
         }
         
     except Exception as e:
-        if verbose:
-            print(f"Error: {e}")
+        log.error("Error: %s", e)
         return {
             'success': False,
             'error': str(e)
         }
-    finally:
-        if 'doc' in locals() and not doc.is_closed:
-            doc.close()
+
+
+def _available_cpus():
+    """Number of CPUs this process may run on (respects CPU affinity where supported)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _optimize_job(job_kwargs, log_level):
+    """
+    Worker entry point: run optimize_pdf_final and return its log records.
+    
+    Records are queued by a QueueHandler instead of being written by the
+    worker; the parent emits them through its own handlers when the file
+    completes, so output stays grouped per file.
+    """
+    records = queue.SimpleQueue()
+    log.handlers = [logging.handlers.QueueHandler(records)]
+    log.propagate = False
+    log.setLevel(log_level)
+    
+    result = optimize_pdf_final(**job_kwargs)
+    
+    collected = []
+    while not records.empty():
+        collected.append(records.get())
+    return result, collected
 
 
 def process_batch(pdf_files, output_dir=None, optimization_level=4, 
-                 image_dpi=150, trim_to_artbox=True, grayscale=False, suffix='-optimized'):
-    """Process multiple PDF files in batch."""
-    results = []
+                 image_dpi=150, trim_to_artbox=True, grayscale=False, suffix='-optimized',
+                 deflate_effort=None, use_libdeflate=False, jpeg_encoder='mupdf',
+                 external_resample=False, streaming_save=False, num_workers=None):
+    """
+    Process multiple PDF files in batch.
+    
+    Files are optimized in parallel worker processes when num_workers > 1
+    (default: min(available CPUs, 4)). Worker log records are queued and emitted by
+    the parent as each file completes, so logs never interleave.
+    """
+    if num_workers is None:
+        num_workers = min(_available_cpus(), 4)
     
+    jobs = []
     for pdf_path in pdf_files:
         pdf_path = Path(pdf_path)
         
@@ -218,26 +619,80 @@ def process_batch(pdf_files, output_dir=None, optimization_level=4,
             output_filename = pdf_path.stem + suffix + '.pdf'
             output_path = pdf_path.parent / output_filename
         
-        print(f"\nProcessing {pdf_path.name}...")
-        result = optimize_pdf_final(
-            str(pdf_path), 
-            str(output_path),
-            optimization_level=optimization_level,
-            image_dpi=image_dpi,
-            trim_to_artbox=trim_to_artbox,
-            grayscale=grayscale,
-            verbose=True
-        )
+        try:
+            original_size = pdf_path.stat().st_size
+        except OSError:
+            original_size = None  # Reported by optimize_pdf_final
         
-        results.append({
+        job_kwargs = {
+            'input_path': str(pdf_path),
+            'original_size': original_size,
+            'output_path': str(output_path),
+            'optimization_level': optimization_level,
+            'image_dpi': image_dpi,
+            'trim_to_artbox': trim_to_artbox,
+            'grayscale': grayscale,
+            'deflate_effort': deflate_effort,
+            'use_libdeflate': use_libdeflate,
+            'jpeg_encoder': jpeg_encoder,
+            'external_resample': external_resample,
+            'streaming_save': streaming_save,
+            'verbose': True
+        }
+        jobs.append((pdf_path, output_path, job_kwargs))
+    
+    def batch_entry(pdf_path, output_path, result):
+        return {
             'input': str(pdf_path),
+            'name': pdf_path.name,
             'output': str(output_path) if result['success'] else None,
             'result': result
-        })
+        }
+    
+    if grayscale and external_resample:
+        _warm_grayscale_kernel()
+    
+    results = [None] * len(jobs)
+    
+    if num_workers <= 1 or len(jobs) <= 1:
+        for index, (pdf_path, output_path, job_kwargs) in enumerate(jobs):
+            print(f"\nProcessing {pdf_path.name}...")
+            result = optimize_pdf_final(**job_kwargs)
+            results[index] = batch_entry(pdf_path, output_path, result)
+        return results
+    
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        log_level = log.getEffectiveLevel()
+        futures = {executor.submit(_optimize_job, job_kwargs, log_level): index
+                   for index, (_, _, job_kwargs) in enumerate(jobs)}
+        for future in as_completed(futures):
+            index = futures[future]
+            pdf_path, output_path, _ = jobs[index]
+            result, records = future.result()
+            print(f"\nProcessing {pdf_path.name}...")
+            for record in records:
+                log.handle(record)
+            results[index] = batch_entry(pdf_path, output_path, result)
     
     return results
 
 
+def _pdf_path(value):
+    """argparse type for input files: an existing file with a .pdf extension."""
+    path = Path(value)
+    if path.suffix.lower() != '.pdf' or not path.is_file():
+        raise argparse.ArgumentTypeError(f"'{value}' not found or not a PDF")
+    return path
+
+
+def _deflate_effort(value):
+    """argparse type for --deflate-effort (integer 1-100)."""
+    effort = int(value)
+    if not 1 <= effort <= 100:
+        raise argparse.ArgumentTypeError(f"must be between 1 and 100 (got {effort})")
+    return effort
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Final PDF optimizer - reliable compression with quality preservation',
@@ -249,6 +704,10 @@ Optimization levels:
   3: Conservative - Level 2 + high-quality image compression (30-60%% reduction)
   4: Balanced - Level 3 + moderate image compression (40-70%% reduction)
 
+Deflate effort (levels 3-4) trades save time for size. An effort of about 40
+(roughly libdeflate level 10) is the sweet spot: higher values are much
+slower for a marginal size gain.
+
 This tool preserves text searchability and image quality while reducing file size.
 
 Examples:
@@ -258,10 +717,11 @@ Examples:
   %(prog)s *.pdf -o compressed/            # Batch process to directory
   %(prog)s document.pdf --no-trim          # Don't trim to art box
   %(prog)s document.pdf --grayscale        # Convert images to grayscale
+  %(prog)s document.pdf --deflate-effort 40  # Faster save, near-max compression
         """
     )
     
-    parser.add_argument('pdf_files', nargs='+', help='PDF file(s) to optimize')
+    parser.add_argument('pdf_files', nargs='+', type=_pdf_path, help='PDF file(s) to optimize')
     parser.add_argument('-l', '--level', type=int, choices=[1, 2, 3, 4], default=4,
                         help='Optimization level 1-4 (default: 4)')
     parser.add_argument('-d', '--dpi', type=int, default=150,
@@ -274,24 +734,35 @@ Examples:
                         help='Do not trim to art box (default: trim enabled)')
     parser.add_argument('--grayscale', action='store_true',
                         help='Convert color images to grayscale')
+    parser.add_argument('--deflate-effort', type=_deflate_effort, metavar='1-100',
+                        help='Deflate compression effort (default: 20 for level 3, 50 for level 4)')
+    parser.add_argument('--libdeflate', action='store_true',
+                        help='Compress streams with libdeflate (requires the deflate package)')
+    parser.add_argument('--jpeg-encoder', choices=['mupdf', 'mozjpeg'], default='mupdf',
+                        help='JPEG encoder for levels 3-4 (mozjpeg requires cjpeg on PATH; default: mupdf)')
+    parser.add_argument('--external-resample', action='store_true',
+                        help='Downscale images with Pillow Lanczos before MuPDF re-embeds them '
+                             '(fastest with the Pillow-SIMD build)')
+    parser.add_argument('--streaming-save', action='store_true',
+                        help='Write output directly to disk instead of buffering it in memory '
+                             '(lower peak memory for very large PDFs)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Show detailed progress')
     
     args = parser.parse_args()
     
-    # Validate input files
-    valid_files = []
-    for pdf_file in args.pdf_files:
-        if os.path.exists(pdf_file) and pdf_file.lower().endswith('.pdf'):
-            valid_files.append(pdf_file)
-        else:
-            print(f"Warning: Skipping '{pdf_file}' (not found or not a PDF)")
+    # Progress details from optimize_pdf_final are shown with -v
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    log.propagate = False
     
-    if not valid_files:
-        print("Error: No valid PDF files found")
-        sys.exit(1)
+    # Input files were validated by argparse (_pdf_path)
+    valid_files = args.pdf_files
     
-    # Process files
+    # Process files (PyMuPDF saves are partly I/O bound; more than 6 workers regresses)
+    num_workers = min(_available_cpus(), 6, len(valid_files))
     print(f"Processing {len(valid_files)} PDF file(s)...")
     print(f"Settings: Level={args.level}, DPI={args.dpi}, Trim={'ON' if not args.no_trim else 'OFF'}, Grayscale={'ON' if args.grayscale else 'OFF'}")
     
@@ -302,7 +773,13 @@ Examples:
         image_dpi=args.dpi,
         trim_to_artbox=not args.no_trim,
         grayscale=args.grayscale,
-        suffix=args.suffix
+        suffix=args.suffix,
+        deflate_effort=args.deflate_effort,
+        use_libdeflate=args.libdeflate,
+        jpeg_encoder=args.jpeg_encoder,
+        external_resample=args.external_resample,
+        streaming_save=args.streaming_save,
+        num_workers=num_workers
     )
     
     # Summary
@@ -316,13 +793,14 @@ Examples:
     
     for item in results:
         result = item['result']
+        name = item['name']
         if result['success']:
             successful += 1
             total_original += result['original_size']
             total_optimized += result['optimized_size']
-            print(f"✓ {Path(item['input']).name}: {result['compression_ratio']:.1f}% reduced")
+            print(f"✓ {name}: {result['compression_ratio']:.1f}% reduced")
         else:
-            print(f"✗ {Path(item['input']).name}: {result.get('error', 'Unknown error')}")
+            print(f"✗ {name}: {result.get('error', 'Unknown error')}")
     
     if successful > 0:
         overall_ratio = (1 - total_optimized / total_original) * 100
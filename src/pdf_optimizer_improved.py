@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import gc
+import hashlib
 import os
+import re
 import sys
 import io
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import numpy as np
 from PIL import Image
 
 try:
@@ -19,36 +26,367 @@ except ImportError:
         print("Please install it with: pip install PyMuPDF")
         sys.exit(1)
 
+# Optional lossless mozjpeg pass (trellis-free Huffman/progressive re-optimization)
+try:
+    import mozjpeg_lossless_optimization
+    MOZJPEG_AVAILABLE = True
+except ImportError:
+    MOZJPEG_AVAILABLE = False
+
+# Optional libjpeg-turbo encoder; also needs the turbojpeg shared library.
+# One instance is shared since PyTurboJPEG creates a handle per encode call.
+try:
+    from turbojpeg import (TurboJPEG, TJPF_GRAY, TJPF_RGB, TJSAMP_GRAY, TJSAMP_420, TJFLAG_PROGRESSIVE,
+                           TJCS_GRAY, TJCS_CMYK, TJCS_YCCK)
+    _TJ = TurboJPEG()
+    TURBOJPEG_AVAILABLE = True
+except (ImportError, OSError, RuntimeError):
+    TURBOJPEG_AVAILABLE = False
 
-def process_image_safely(doc, page, img_info, xref, image_dpi=150, quality=70, grayscale=False, verbose=True):
+# Optional JIT for fused pixel kernels
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# USE_NATIVE_IMAGE_PIPE=1 sends JPEG sources through libjpeg-turbo end to end
+# (scaled decode -> resize -> encode on numpy buffers) instead of Pillow
+USE_NATIVE_IMAGE_PIPE = os.environ.get('USE_NATIVE_IMAGE_PIPE') == '1'
+
+# Pillow-SIMD is a binary-compatible Pillow build with SSE4/AVX2 resize,
+# color conversion and JPEG paths; its versions carry a ".postN" suffix
+PILLOW_SIMD = 'post' in Image.__version__
+
+# Optional SIMD Lanczos resampler (Pillow-compatible)
+try:
+    from pic_scale import Plan, Resampling as PSR
+    PIC_SCALE_AVAILABLE = True
+except ImportError:
+    PIC_SCALE_AVAILABLE = False
+
+# Modes pic-scale accepts; anything else is resized with Pillow
+PIC_SCALE_MODES = ('L', 'LA', 'RGB', 'RGBA')
+
+
+# ITU-T T.81 Annex K base quantization tables (natural order, DC first)
+_STD_LUMA_QTABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+_STD_CHROMA_QTABLE = (
+    17, 18, 24, 47, 99, 99, 99, 99,
+    18, 21, 26, 66, 99, 99, 99, 99,
+    24, 26, 56, 99, 99, 99, 99, 99,
+    47, 66, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+)
+
+# At or below this quality the DC coefficient keeps DC_QUALITY precision so
+# smooth gradients (sky, tinted backgrounds) don't break into 8x8 blocks
+DC_BOOST_MAX_QUALITY = 50
+DC_QUALITY = 85
+
+# Minimum pixel count for progressive JPEG output (same threshold as
+# pdf_optimizer_simple_smask, which documents why)
+PROGRESSIVE_MIN_PIXELS = 200_000
+
+
+def _scale_qtable(table, quality):
+    """Scale a base quantization table the way libjpeg's jpeg_set_quality does."""
+    scale = 5000 // quality if quality < 50 else 200 - quality * 2
+    return [min(max((q * scale + 50) // 100, 1), 255) for q in table]
+
+
+def _estimate_jpeg_quality(img):
     """
-    Process a single image in the PDF with improved error handling and multiple fallback methods.
+    Estimate the IJG quality of an opened JPEG from its luma quantization table.
+    
+    Only the header is read; returns None when there is no table.
+    """
+    tables = getattr(img, 'quantization', None)
+    if not tables or 0 not in tables:
+        return None
+    scale = sum(tables[0]) * 100 / sum(_STD_LUMA_QTABLE)
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return max(1, min(100, round(quality)))
+
+
+@functools.lru_cache(maxsize=16)
+def _jpeg_qtables(quality, grayscale):
+    """
+    Return the quantization tables for a (quality, grayscale) pair, built once.
+    
+    They match libjpeg's own scaling for quality; at or below
+    DC_BOOST_MAX_QUALITY the DC entries come from DC_QUALITY instead.
+    Grayscale JPEGs only use the luma table.
+    """
+    bases = (_STD_LUMA_QTABLE,) if grayscale else (_STD_LUMA_QTABLE, _STD_CHROMA_QTABLE)
+    tables = []
+    for base in bases:
+        table = _scale_qtable(base, quality)
+        if quality <= DC_BOOST_MAX_QUALITY:
+            table[0] = _scale_qtable(base[:1], DC_QUALITY)[0]
+        tables.append(table)
+    return tables
+
+
+@functools.lru_cache(maxsize=64)
+def _get_plan(src_size, dst_size, mode):
+    """
+    Return a pic-scale Lanczos plan for the given geometry and mode.
+    
+    Scanned PDFs usually embed many images at the same size, so the filter
+    weights are computed once per (source, target, mode) and reused. The cache
+    is shared by the encoder threads.
+    """
+    return Plan(src_size, dst_size, PSR.LANCZOS, mode, premultiply_alpha=True)
+
+
+_PDF_DELIMITERS = '()<>[]{}/%'
+
+
+def _pdf_value_end(source, i):
+    """Return the index just past the PDF object that starts at source[i]."""
+    if source.startswith('<<', i) or source[i] == '[':
+        # Dictionary or array: scan to the matching close, skipping strings
+        depth = 0
+        while i < len(source):
+            if source.startswith('<<', i):
+                depth, i = depth + 1, i + 2
+                continue
+            if source.startswith('>>', i):
+                depth, i = depth - 1, i + 2
+            elif source[i] == '[':
+                depth, i = depth + 1, i + 1
+            elif source[i] == ']':
+                depth, i = depth - 1, i + 1
+            elif source[i] in '(<':
+                i = _pdf_value_end(source, i)
+            else:
+                i += 1
+            if depth == 0:
+                return i
+        return i
+    if source[i] == '(':
+        # Literal string with balanced parentheses and backslash escapes
+        depth = 0
+        while i < len(source):
+            if source[i] == '\\':
+                i += 2
+                continue
+            depth += {'(': 1, ')': -1}.get(source[i], 0)
+            i += 1
+            if depth == 0:
+                return i
+        return i
+    if source[i] == '<':
+        return source.find('>', i) + 1 or len(source)
+    
+    ref = _PDF_REFERENCE.match(source, i)
+    if ref:
+        return ref.end()
+    # Name, number, boolean or null
+    i += 1
+    while i < len(source) and not source[i].isspace() and source[i] not in _PDF_DELIMITERS:
+        i += 1
+    return i
+
+
+_PDF_REFERENCE = re.compile(r"\d+\s+\d+\s+R\b")
+
+
+def _parse_xref_dict(doc, xref):
+    """
+    Read an object's top-level dictionary entries with a single xref_object call.
     
     Returns:
-        tuple: (success, original_size, new_size, error_message)
+        dict: key name -> value source, e.g. {'Width': '300', 'SMask': '12 0 R'}
     """
-    try:
-        # Check if image has transparency/mask BEFORE extracting
-        has_transparency = False
+    source = doc.xref_object(xref, compressed=True)
+    entries = {}
+    
+    i = source.find('<<')
+    if i < 0:
+        return entries
+    i += 2
+    while i < len(source):
+        while i < len(source) and source[i].isspace():
+            i += 1
+        if i >= len(source) or source[i] != '/':
+            break  # '>>' or malformed
+        key_end = _pdf_value_end(source, i)
+        key = source[i + 1:key_end]
+        
+        i = key_end
+        while i < len(source) and source[i].isspace():
+            i += 1
+        value_end = _pdf_value_end(source, i)
+        entries[key] = source[i:value_end]
+        i = value_end
+    
+    return entries
+
+
+def _hash_pdf_value(doc, value, digest, depth=0):
+    """
+    Feed a PDF object's source into digest, hashing indirect references by content.
+    
+    Identical ICC profiles or palettes stored as separate objects then hash
+    the same. References are followed a few levels deep.
+    """
+    digest.update(re.sub(r"\d+ 0 R", "R", value).encode())
+    if depth >= 3:
+        return
+    for ref in re.findall(r"(\d+) 0 R", value):
+        ref = int(ref)
+        if doc.xref_is_stream(ref):
+            digest.update(doc.xref_stream_raw(ref) or b"")
+        _hash_pdf_value(doc, doc.xref_object(ref, compressed=True), digest, depth + 1)
+
+
+def _find_duplicate_images(doc, image_infos):
+    """
+    Find images embedded more than once under different xrefs.
+    
+    image_infos maps xref -> get_images() entry. Images are keyed by a hash of
+    the raw stream plus every dictionary entry except /Length, with referenced
+    objects (ICC profiles, palettes, optional content groups) compared by
+    content, so /ImageMask, /Interpolate, /Intent or /OC differences keep
+    images apart. Images with a soft mask are skipped since their SMask
+    references differ anyway.
+    
+    Returns:
+        dict: duplicate xref -> canonical xref
+    """
+    seen = {}  # digest -> first xref with that content
+    duplicates = {}
+    
+    for xref, img in image_infos.items():
+        if img[1]:  # has SMask
+            continue
         try:
-            smask = doc.xref_get_key(xref, "SMask")
-            mask = doc.xref_get_key(xref, "Mask")
-            
-            # Check if image has soft mask (alpha channel)
-            if smask and smask not in [None, 'null', ('null', 'null')]:
-                has_transparency = True
-                if verbose:
-                    print(f"      Image {xref} has SMask (transparency) - will preserve")
+            raw = doc.xref_stream_raw(xref)
+            if not raw:
+                continue
+            entries = _parse_xref_dict(doc, xref)
+            digest = hashlib.blake2b(raw, digest_size=16)
+            for key in sorted(entries):
+                if key == "Length":
+                    continue
+                digest.update(f"/{key}".encode())
+                _hash_pdf_value(doc, entries[key], digest)
+        except Exception:
+            continue
+        
+        key = digest.digest()
+        if key in seen:
+            duplicates[xref] = seen[key]
+        else:
+            seen[key] = xref
+    
+    return duplicates
+
+
+def _repoint_image_references(doc, duplicates):
+    """
+    Point every XObject resource entry for a duplicate image at its canonical xref.
+    
+    Returns:
+        set: Duplicate xrefs that still have a reference which could not be rewritten
+    """
+    unresolved = set()
+    
+    for page in doc:
+        for item in page.get_images(full=True):
+            xref, name, referencer = item[0], item[7], item[9]
+            if xref not in duplicates:
+                continue
             
-            # Check if image has hard mask
-            if mask and mask not in [None, 'null', ('null', 'null')]:
-                # Check if it's a real mask (not just null)
-                if isinstance(mask, tuple) and mask[0] != 'null':
+            owner = referencer or page.xref
+            key = f"Resources/XObject/{name}"
+            target = f"{duplicates[xref]} 0 R"
+            try:
+                current = doc.xref_get_key(owner, key)
+                if current == ('xref', f"{xref} 0 R"):
+                    doc.xref_set_key(owner, key, target)
+                elif current != ('xref', target):
+                    # Inherited or inline resources - leave this image as is
+                    unresolved.add(xref)
+            except Exception:
+                unresolved.add(xref)
+    
+    return unresolved
+
+
+# Run a garbage collection pass after this many written-back images
+GC_INTERVAL = 50
+
+# Images above image_dpi * DPI_THRESHOLD_FACTOR are downsampled (conservative margin)
+DPI_THRESHOLD_FACTOR = 1.5
+
+
+@functools.lru_cache(maxsize=1024)
+def _effective_dpi(width, height, rect_width, rect_height):
+    """
+    Return the DPI of a width x height image displayed in a rect of the given size (points).
+    
+    Memoized by geometry, since scanned PDFs repeat the same image and
+    placement sizes on every page.
+    """
+    # Calculate DPI based on display size vs actual size
+    display_width_inches = rect_width / 72  # 72 points per inch
+    display_height_inches = rect_height / 72
+    
+    dpi_x = width / display_width_inches
+    dpi_y = height / display_height_inches
+    return max(dpi_x, dpi_y)
+
+
+def _prepare_image(doc, page, img_info, xref, image_dpi=150, quality=70, verbose=True, display_rect=None,
+                   dpi_threshold=None, grayscale=False, smask_xref=None):
+    """
+    Inspect a single image and extract it if it needs re-encoding.
+    
+    Runs on the main thread since it reads from the PyMuPDF document.
+    display_rect is the image's largest placement across all pages; when
+    omitted, the first placement on page is used. dpi_threshold defaults to
+    image_dpi * DPI_THRESHOLD_FACTOR. smask_xref defaults to img_info[1], the
+    soft mask field of the get_images() entry (0 if none).
+    
+    Returns:
+        tuple: (job, skip_result) - job is (xref, img_data, width, height, actual_dpi, lossless)
+               when the image should be re-encoded (lossless: JPEG entropy re-optimization
+               only), otherwise None and skip_result is the
+               (success, original_size, new_size, error_message) tuple to report
+    """
+    try:
+        # Check if image has transparency/mask BEFORE extracting. The soft mask
+        # xref comes with the get_images() entry; only a hard /Mask needs a lookup
+        if smask_xref is None:
+            smask_xref = img_info[1]
+        has_transparency = False
+        if smask_xref:
+            has_transparency = True
+            if verbose:
+                print(f"      Image {xref} has SMask (transparency) - will preserve")
+        else:
+            try:
+                if doc.xref_get_key(xref, "Mask")[0] != 'null':
                     has_transparency = True
                     if verbose:
                         print(f"      Image {xref} has Mask - will preserve")
-        except:
-            pass
+            except:
+                pass
         
         # If image has transparency, skip processing to preserve it
         if has_transparency:
@@ -57,15 +395,15 @@ def process_image_safely(doc, page, img_info, xref, image_dpi=150, quality=70, g
                 img_dict = doc.extract_image(xref)
                 if img_dict:
                     original_size = len(img_dict["image"])
-                    return False, original_size, original_size, "Has transparency - preserving original"
+                    return None, (False, original_size, original_size, "Has transparency - preserving original")
             except:
                 pass
-            return False, 0, 0, "Has transparency - preserving original"
+            return None, (False, 0, 0, "Has transparency - preserving original")
         
         # Extract the image
         img_dict = doc.extract_image(xref)
         if not img_dict:
-            return False, 0, 0, "Could not extract image data"
+            return None, (False, 0, 0, "Could not extract image data")
         
         img_data = img_dict["image"]
         img_ext = img_dict["ext"]
@@ -76,219 +414,452 @@ def process_image_safely(doc, page, img_info, xref, image_dpi=150, quality=70, g
         
         # Skip very small images to avoid artifacts
         if width < 50 or height < 50 or original_size < 1024:
-            return False, original_size, original_size, f"Image too small: {width}x{height}"
+            return None, (False, original_size, original_size, f"Image too small: {width}x{height}")
         
         # Calculate actual DPI more robustly
         actual_dpi = 150  # Default fallback
         try:
             # Try multiple methods to get image placement
-            img_rects = page.get_image_rects(img_info)
-            if img_rects and len(img_rects) > 0:
-                rect = img_rects[0]
-                if rect.width > 0 and rect.height > 0:
-                    # Calculate DPI based on display size vs actual size
-                    display_width_inches = rect.width / 72  # 72 points per inch
-                    display_height_inches = rect.height / 72
-                    
-                    if display_width_inches > 0 and display_height_inches > 0:
-                        dpi_x = width / display_width_inches
-                        dpi_y = height / display_height_inches
-                        actual_dpi = max(dpi_x, dpi_y)
-                        
+            rect = display_rect
+            if rect is None:
+                img_rects = page.get_image_rects(img_info)
+                if img_rects and len(img_rects) > 0:
+                    rect = img_rects[0]
+            if rect is not None and rect.width > 0 and rect.height > 0:
+                actual_dpi = _effective_dpi(width, height, rect.width, rect.height)
+                
         except Exception as dpi_error:
             if verbose:
                 print(f"      Warning: DPI calculation failed for {xref}: {dpi_error}")
         
         # Determine if processing is needed
-        dpi_threshold = image_dpi * 1.5  # More conservative threshold
+        if dpi_threshold is None:
+            dpi_threshold = image_dpi * DPI_THRESHOLD_FACTOR
+        
+        # Re-encoding a JPEG already at or below the target quality that needs no
+        # pixel change only adds generation loss; at most its entropy coding is
+        # re-optimized losslessly. Higher-quality JPEGs fall through and are re-encoded
+        if (img_ext in ('jpg', 'jpeg') and actual_dpi <= dpi_threshold
+                and (not grayscale or img_dict["colorspace"] == 1)):
+            try:
+                src_quality = _estimate_jpeg_quality(Image.open(io.BytesIO(img_data)))
+            except Exception:
+                src_quality = None
+            if src_quality is not None and src_quality <= quality:
+                if MOZJPEG_AVAILABLE:
+                    return (xref, img_data, width, height, actual_dpi, True), None
+                if verbose:
+                    print(f"      Skipping {xref}: {width}x{height} ({actual_dpi:.0f} DPI) - already JPEG q{src_quality}")
+                return None, (False, original_size, original_size, f"Already JPEG q{src_quality}")
+        
         needs_processing = (actual_dpi > dpi_threshold) or (quality < 85 and original_size > 10240)
         
         if not needs_processing:
             if verbose:
                 print(f"      Skipping {xref}: {width}x{height} ({actual_dpi:.0f} DPI) - already optimal")
-            return False, original_size, original_size, "Already optimal"
+            return None, (False, original_size, original_size, "Already optimal")
         
-        # Process the image
-        try:
-            # Load image with PIL
-            img = Image.open(io.BytesIO(img_data))
-            original_mode = img.mode
-            
-            # Calculate new dimensions if DPI reduction needed
-            if actual_dpi > dpi_threshold:
-                scale = image_dpi / actual_dpi
-                new_width = max(int(width * scale), 64)  # Ensure minimum size
-                new_height = max(int(height * scale), 64)
-                
-                # Use high-quality resampling
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                if verbose:
-                    print(f"      Resizing {xref}: {width}x{height} ({actual_dpi:.0f} DPI) → {new_width}x{new_height} ({image_dpi} DPI)")
+        return (xref, img_data, width, height, actual_dpi, False), None
+        
+    except Exception as e:
+        return None, (False, 0, 0, f"Extraction failed: {e}")
+
+
+def _alpha_is_opaque(img):
+    """Return True if every pixel of the image's alpha channel is 255."""
+    alpha_arr = np.asarray(img.getchannel('A'), dtype=np.uint8)
+    return not np.any(alpha_arr != 255)
+
+
+def _composite_on_white(img):
+    """
+    Composite an RGBA or LA image onto a white background.
+    
+    Returns an RGB (or L for LA) image; the blend is exact to /255 rounding.
+    """
+    arr = np.asarray(img)
+    color = arr[..., :-1].astype(np.uint16)
+    alpha = arr[..., -1:].astype(np.uint16)
+    
+    # color * a + 255 * (255 - a), divided by 255 with rounding
+    blended = color * alpha + 255 * (255 - alpha) + 128
+    out = ((blended + (blended >> 8)) >> 8).astype(np.uint8)
+    
+    if img.mode == 'LA':
+        return Image.fromarray(out[..., 0], 'L')
+    return Image.fromarray(out, 'RGB')
+
+
+if NUMBA_AVAILABLE:
+    # nogil rather than parallel: the kernel already runs on encoder pool threads
+    @njit(nogil=True, cache=True)
+    def _rgba_to_gray_on_white_kernel(rgba):
+        """Composite onto white and convert to luma in one pass (same rounding as Pillow)."""
+        height, width = rgba.shape[0], rgba.shape[1]
+        gray = np.empty((height, width), dtype=np.uint8)
+        for y in range(height):
+            for x in range(width):
+                a = np.uint32(rgba[y, x, 3])
+                background = 255 * (255 - a) + 128
+                t = np.uint32(rgba[y, x, 0]) * a + background
+                r = (t + (t >> 8)) >> 8
+                t = np.uint32(rgba[y, x, 1]) * a + background
+                g = (t + (t >> 8)) >> 8
+                t = np.uint32(rgba[y, x, 2]) * a + background
+                b = (t + (t >> 8)) >> 8
+                gray[y, x] = (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16
+        return gray
+
+
+def _compute_jpeg_bytes(img_data, width, height, scale, grayscale, quality):
+    """
+    Decode, resize, convert and JPEG-encode a single image.
+    
+    Pure function on the image bytes so it can run on a worker thread.
+    
+    Returns:
+        tuple: (new_bytes, new_width, new_height), or None if compression is not beneficial
+    """
+    # Load image with PIL
+    img = Image.open(io.BytesIO(img_data))
+    
+    # Calculate new dimensions if DPI reduction needed
+    if scale is not None:
+        new_width = max(int(width * scale), 64)  # Ensure minimum size
+        new_height = max(int(height * scale), 64)
+        
+        # JPEG: let libjpeg decode at 1/2, 1/4 or 1/8 scale (DCT scaling) while
+        # staying at least 2x the target, so the full-size pixels are never held
+        if img.format == 'JPEG':
+            img.draft(None, (new_width * 2, new_height * 2))
+        
+        # Use high-quality resampling for the remaining step
+        if PIC_SCALE_AVAILABLE and img.mode in PIC_SCALE_MODES:
+            img = _get_plan(img.size, (new_width, new_height), img.mode).resize(img)
+        else:
+            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    
+    # Handle different color modes properly - avoid unnecessary background creation
+    if img.mode == 'CMYK':
+        # CMYK requires special handling
+        img = img.convert('RGB')
+    elif img.mode == 'RGBA':
+        # Check if image actually has transparency
+        if _alpha_is_opaque(img):
+            # No transparency - just convert to RGB
+            img = img.convert('RGB')
+        elif grayscale and NUMBA_AVAILABLE:
+            # Has transparency and grayscale output - composite and convert in one pass
+            img = Image.fromarray(_rgba_to_gray_on_white_kernel(np.asarray(img)), 'L')
+        else:
+            # Has transparency - composite with white background only if needed
+            img = _composite_on_white(img)
+    elif img.mode == 'LA':
+        # Grayscale with alpha - check if actually has transparency
+        if _alpha_is_opaque(img):
+            # No transparency - just convert to L
+            img = img.convert('L')
+        else:
+            # Has transparency - composite with white background
+            img = _composite_on_white(img)
+    elif img.mode == 'P':
+        # Palette mode - check for transparency
+        if 'transparency' in img.info:
+            # Has transparency - convert carefully
+            img = img.convert('RGBA')
             
-            # Handle different color modes properly - avoid unnecessary background creation
-            if img.mode == 'CMYK':
-                # CMYK requires special handling
-                img = img.convert('RGB')
-            elif img.mode == 'RGBA':
-                # Check if image actually has transparency
-                alpha_channel = img.split()[3]
-                alpha_min, alpha_max = alpha_channel.getextrema()
-                
-                if alpha_min == 255 and alpha_max == 255:
-                    # No transparency - just convert to RGB
-                    img = img.convert('RGB')
-                else:
-                    # Has transparency - composite with white background only if needed
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    background.paste(img, mask=alpha_channel)
-                    img = background
-            elif img.mode == 'LA':
-                # Grayscale with alpha - check if actually has transparency
-                alpha_channel = img.split()[1]
-                alpha_min, alpha_max = alpha_channel.getextrema()
-                
-                if alpha_min == 255 and alpha_max == 255:
-                    # No transparency - just convert to L
-                    img = img.convert('L')
-                else:
-                    # Has transparency - convert to RGB with white background
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    rgb_img = img.convert('RGB')
-                    background.paste(rgb_img, mask=alpha_channel)
-                    img = background
-            elif img.mode == 'P':
-                # Palette mode - check for transparency
-                if 'transparency' in img.info:
-                    # Has transparency - convert carefully
-                    img = img.convert('RGBA')
-                    alpha_channel = img.split()[3]
-                    alpha_min, alpha_max = alpha_channel.getextrema()
-                    
-                    if alpha_min == 255 and alpha_max == 255:
-                        # Transparent color not actually used
-                        img = img.convert('RGB')
-                    else:
-                        # Has actual transparency
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        background.paste(img, mask=alpha_channel)
-                        img = background
-                else:
-                    # No transparency - direct conversion
-                    img = img.convert('RGB')
-            elif img.mode not in ('RGB', 'L'):
-                # Convert any other modes to RGB
+            if _alpha_is_opaque(img):
+                # Transparent color not actually used
                 img = img.convert('RGB')
+            elif grayscale and NUMBA_AVAILABLE:
+                img = Image.fromarray(_rgba_to_gray_on_white_kernel(np.asarray(img)), 'L')
+            else:
+                # Has actual transparency
+                img = _composite_on_white(img)
+        else:
+            # No transparency - direct conversion
+            img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'L'):
+        # Convert any other modes to RGB
+        img = img.convert('RGB')
+    
+    # Convert to grayscale if requested
+    if grayscale and img.mode != 'L':
+        img = img.convert('L')
+    
+    # Pillow writes progressive only from PROGRESSIVE_MIN_PIXELS up
+    progressive = img.width * img.height >= PROGRESSIVE_MIN_PIXELS
+    
+    # Optimize JPEG encoding parameters
+    save_options = {
+        'format': 'JPEG',
+        # Cached per (quality, grayscale) and passed pre-scaled; 'quality' must be
+        # omitted, Pillow would otherwise rescale the tables by it as a percentage
+        'qtables': _jpeg_qtables(quality, img.mode == 'L'),
+        # Progressive encoding always builds optimized Huffman tables, so a
+        # separate optimize pass is only needed for baseline
+        'optimize': not progressive,
+        'progressive': progressive,
+    }
+    
+    # For grayscale images, ensure proper subsampling
+    if img.mode == 'L':
+        save_options['subsampling'] = 0  # No chroma subsampling for grayscale
+    
+    # Save compressed image; TurboJPEG encodes straight from the pixel buffer
+    # (DC-boosted tables need Pillow). Its flags offer no Huffman optimization
+    # besides progressive mode, so it always writes progressive regardless of
+    # PROGRESSIVE_MIN_PIXELS, as encode_jpeg in pdf_optimizer_working.py does
+    if TURBOJPEG_AVAILABLE and quality > DC_BOOST_MAX_QUALITY and img.mode in ('L', 'RGB'):
+        if img.mode == 'L':
+            pixel_format, subsample = TJPF_GRAY, TJSAMP_GRAY
+        else:
+            pixel_format, subsample = TJPF_RGB, TJSAMP_420
+        new_img_data = _TJ.encode(np.asarray(img), quality=quality, pixel_format=pixel_format,
+                                  jpeg_subsample=subsample, flags=TJFLAG_PROGRESSIVE)
+    else:
+        output = io.BytesIO()
+        img.save(output, **save_options)
+        new_img_data = output.getvalue()
+    
+    # Lossless mozjpeg re-optimization of the entropy coding
+    if MOZJPEG_AVAILABLE:
+        optimized = mozjpeg_lossless_optimization.optimize(new_img_data)
+        if len(optimized) < len(new_img_data):
+            new_img_data = optimized
+    
+    # Skip if compression made it worse (rare but possible)
+    if len(new_img_data) >= len(img_data) * 0.95:  # Allow 5% threshold
+        return None
+    
+    return new_img_data, img.size[0], img.size[1]
+
+
+def _native_optimize_image_bytes(img_data, width, height, scale, grayscale, quality):
+    """
+    JPEG -> JPEG through libjpeg-turbo: DCT-scaled decode, resize, encode.
+    
+    Pixels stay in numpy buffers; a Pillow image is only wrapped around them
+    when a resize step remains after the DCT scaling. CMYK/YCCK sources fall
+    back to _compute_jpeg_bytes.
+    
+    Returns:
+        tuple: (new_bytes, new_width, new_height), or None if compression is not beneficial
+    """
+    _, _, _, colorspace = _TJ.decode_header(img_data)
+    if colorspace in (TJCS_CMYK, TJCS_YCCK):
+        return _compute_jpeg_bytes(img_data, width, height, scale, grayscale, quality)
+    
+    new_width, new_height = width, height
+    scaling_factor = None
+    if scale is not None:
+        new_width = max(int(width * scale), 64)  # Ensure minimum size
+        new_height = max(int(height * scale), 64)
+        # Smallest DCT scale that stays at least 2x the target (as Image.draft does)
+        candidates = [f for f in _TJ.scaling_factors
+                      if f[0] <= f[1] and width * f[0] // f[1] >= new_width * 2
+                      and height * f[0] // f[1] >= new_height * 2]
+        if candidates:
+            scaling_factor = min(candidates, key=lambda f: f[0] / f[1])
+    
+    gray = grayscale or colorspace == TJCS_GRAY
+    pixels = _TJ.decode(img_data, pixel_format=TJPF_GRAY if gray else TJPF_RGB, scaling_factor=scaling_factor)
+    if gray:
+        pixels = pixels[..., 0]
+    
+    if pixels.shape[1] != new_width or pixels.shape[0] != new_height:
+        img = Image.fromarray(pixels, 'L' if gray else 'RGB')
+        if PIC_SCALE_AVAILABLE:
+            img = _get_plan(img.size, (new_width, new_height), img.mode).resize(img)
+        else:
+            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        pixels = np.asarray(img)
+    
+    # Always progressive: the only Huffman optimization TurboJPEG's flags offer
+    # (see the TurboJPEG branch of _compute_jpeg_bytes)
+    new_img_data = _TJ.encode(np.ascontiguousarray(pixels), quality=quality,
+                              pixel_format=TJPF_GRAY if gray else TJPF_RGB,
+                              jpeg_subsample=TJSAMP_GRAY if gray else TJSAMP_420, flags=TJFLAG_PROGRESSIVE)
+    
+    if len(new_img_data) >= len(img_data) * 0.95:  # Allow 5% threshold
+        return None
+    return new_img_data, new_width, new_height
+
+
+def _optimize_jpeg_lossless(img_data, width, height):
+    """
+    Losslessly re-optimize a JPEG's entropy coding with mozjpeg (no decode/IDCT).
+    
+    Returns:
+        tuple: (new_bytes, width, height), or None if nothing was saved
+    """
+    optimized = mozjpeg_lossless_optimization.optimize(img_data)
+    if len(optimized) >= len(img_data):
+        return None
+    return optimized, width, height
+
+
+def _encode_task(job, image_dpi, dpi_threshold, grayscale, quality):
+    """Return the (function, args) pair that produces the new bytes for a prepared image."""
+    xref, img_data, width, height, actual_dpi, lossless = job
+    if lossless:
+        return _optimize_jpeg_lossless, (img_data, width, height)
+    
+    encoder = _compute_jpeg_bytes
+    if (USE_NATIVE_IMAGE_PIPE and TURBOJPEG_AVAILABLE and img_data[:2] == b'\xff\xd8'
+            and quality > DC_BOOST_MAX_QUALITY):
+        encoder = _native_optimize_image_bytes
+    return encoder, (img_data, width, height, _resize_scale(actual_dpi, image_dpi, dpi_threshold),
+                     grayscale, quality)
+
+
+def _encode_job(task):
+    """Worker wrapper for an _encode_task pair that returns (encoded, error) instead of raising."""
+    func, args = task
+    try:
+        return func(*args), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _apply_to_pdf(doc, page, xref, new_bytes, width, height, grayscale):
+    """
+    Write re-encoded JPEG data back into the PDF (main thread only).
+    
+    Returns:
+        str or None: Error message if every replacement method failed
+    """
+    # Get original image properties to preserve them (one read, before any change)
+    try:
+        original_props = _parse_xref_dict(doc, xref)
+    except Exception:
+        original_props = {}
+    
+    # Try multiple replacement methods with better error handling and layer preservation
+    
+    # Method 1: Use page.replace_image (preserves layer order)
+    try:
+        # Replace the image using the safest method
+        page.replace_image(xref, stream=new_bytes)
+        
+        # Verify the replacement was successful and dimensions are correct
+        # This helps catch cases where the replacement might have failed silently
+        # (reads the dictionary only; extracting the image would copy its pixels)
+        try:
+            replaced = _parse_xref_dict(doc, xref)
+            if replaced.get('Width') == str(width) and replaced.get('Height') == str(height):
+                return None
+            else:
+                raise Exception("Image replacement verification failed - dimensions mismatch")
+        except:
+            raise Exception("Image replacement verification failed - could not extract replaced image")
+        
+    except Exception as e:
+        # Method 2: Direct stream replacement with careful property preservation
+        try:
+            # Clear potentially problematic filters
+            try:
+                doc.xref_set_key(xref, "Filter", "null")
+                doc.xref_set_key(xref, "DecodeParms", "null")
+                doc.xref_set_key(xref, "Length", "null")
+            except:
+                pass
             
-            # Convert to grayscale if requested
-            if grayscale and img.mode != 'L':
-                img = img.convert('L')
-            
-            # Optimize JPEG encoding parameters
-            save_options = {
-                'format': 'JPEG',
-                'quality': quality,
-                'optimize': True,
-                'progressive': True,  # Progressive JPEG for better compression
-            }
-            
-            # For grayscale images, ensure proper subsampling
-            if img.mode == 'L':
-                save_options['subsampling'] = 0  # No chroma subsampling for grayscale
+            # Update the image stream with JPEG data
+            doc.xref_stream(xref, new_bytes)
             
-            # Save compressed image
-            output = io.BytesIO()
-            img.save(output, **save_options)
-            new_img_data = output.getvalue()
-            new_size = len(new_img_data)
+            # Set JPEG-specific properties
+            doc.xref_set_key(xref, "Filter", "/DCTDecode")
+            doc.xref_set_key(xref, "Length", str(len(new_bytes)))
+            doc.xref_set_key(xref, "Width", str(width))
+            doc.xref_set_key(xref, "Height", str(height))
             
-            # Skip if compression made it worse (rare but possible)
-            if new_size >= original_size * 0.95:  # Allow 5% threshold
-                return False, original_size, original_size, "Compression not beneficial"
+            # Set appropriate color space
+            if grayscale or Image.open(io.BytesIO(new_bytes)).mode == 'L':
+                doc.xref_set_key(xref, "ColorSpace", "/DeviceGray")
+            else:
+                doc.xref_set_key(xref, "ColorSpace", "/DeviceRGB")
             
-            # Try multiple replacement methods with better error handling and layer preservation
-            replacement_success = False
-            last_error = None
+            doc.xref_set_key(xref, "BitsPerComponent", "8")
             
-            # Method 1: Use page.replace_image (preserves layer order)
-            try:
-                # Get original image properties to preserve them
-                original_obj = doc.xref_get_key(xref, "")  # Get original object
-                
-                # Replace the image using the safest method
-                page.replace_image(xref, stream=new_img_data)
-                
-                # Verify the replacement was successful and dimensions are correct
-                # This helps catch cases where the replacement might have failed silently
-                try:
-                    replaced_dict = doc.extract_image(xref)
-                    if replaced_dict and replaced_dict['width'] == img.size[0] and replaced_dict['height'] == img.size[1]:
-                        replacement_success = True
-                    else:
-                        raise Exception("Image replacement verification failed - dimensions mismatch")
-                except:
-                    raise Exception("Image replacement verification failed - could not extract replaced image")
-                
-            except Exception as e:
-                last_error = str(e)
-                
-                # Method 2: Direct stream replacement with careful property preservation
-                try:
-                    # Store original image properties that we want to preserve
-                    original_props = {}
-                    try:
-                        original_props['ColorSpace'] = doc.xref_get_key(xref, "ColorSpace")
-                        original_props['BitsPerComponent'] = doc.xref_get_key(xref, "BitsPerComponent")
-                        original_props['Interpolate'] = doc.xref_get_key(xref, "Interpolate")
-                    except:
-                        pass
-                    
-                    # Clear potentially problematic filters
-                    try:
-                        doc.xref_set_key(xref, "Filter", "null")
-                        doc.xref_set_key(xref, "DecodeParms", "null")
-                        doc.xref_set_key(xref, "Length", "null")
-                    except:
-                        pass
-                    
-                    # Update the image stream with JPEG data
-                    doc.xref_stream(xref, new_img_data)
-                    
-                    # Set JPEG-specific properties
-                    doc.xref_set_key(xref, "Filter", "/DCTDecode")
-                    doc.xref_set_key(xref, "Length", str(new_size))
-                    doc.xref_set_key(xref, "Width", str(img.size[0]))
-                    doc.xref_set_key(xref, "Height", str(img.size[1]))
-                    
-                    # Set appropriate color space
-                    if grayscale or img.mode == 'L':
-                        doc.xref_set_key(xref, "ColorSpace", "/DeviceGray")
-                    else:
-                        doc.xref_set_key(xref, "ColorSpace", "/DeviceRGB")
-                    
-                    doc.xref_set_key(xref, "BitsPerComponent", "8")
-                    
-                    # Preserve certain original properties if they exist
-                    if 'Interpolate' in original_props and original_props['Interpolate'] not in [None, 'null']:
-                        doc.xref_set_key(xref, "Interpolate", original_props['Interpolate'])
-                    
-                    replacement_success = True
-                    
-                except Exception as e2:
-                    last_error = f"Method 1: {e}, Method 2: {e2}"
+            # Preserve certain original properties if they exist
+            if original_props.get('Interpolate', 'null') != 'null':
+                doc.xref_set_key(xref, "Interpolate", original_props['Interpolate'])
             
-            if replacement_success:
-                reduction = (1 - new_size / original_size) * 100
-                if verbose:
-                    print(f"      Compressed {xref}: {original_size:,} → {new_size:,} bytes ({reduction:.1f}% reduction)")
-                return True, original_size, new_size, None
-            else:
-                return False, original_size, original_size, f"Replacement failed: {last_error}"
-                
-        except Exception as process_error:
-            return False, original_size, original_size, f"Processing failed: {process_error}"
+            return None
             
-    except Exception as e:
-        return False, 0, 0, f"Extraction failed: {e}"
+        except Exception as e2:
+            return f"Method 1: {e}, Method 2: {e2}"
+
+
+def _finish_image(doc, page, job, encoded, image_dpi, grayscale, verbose=True):
+    """
+    Apply the result of the encode task for one prepared image.
+    
+    Returns:
+        tuple: (success, original_size, new_size, error_message)
+    """
+    xref, img_data, width, height, actual_dpi, lossless = job
+    original_size = len(img_data)
+    
+    if encoded is None:
+        return False, original_size, original_size, "Compression not beneficial"
+    
+    new_img_data, new_width, new_height = encoded
+    new_size = len(new_img_data)
+    
+    if lossless:
+        # Same pixels and color space - swap the stream, keep the image dictionary
+        try:
+            doc.update_stream(xref, new_img_data, compress=False)
+            doc.xref_set_key(xref, "Filter", "/DCTDecode")
+        except Exception as e:
+            return False, original_size, original_size, f"Replacement failed: {e}"
+        if verbose:
+            print(f"      Losslessly optimized {xref}: {original_size:,} → {new_size:,} bytes")
+        return True, original_size, new_size, None
+    
+    if verbose and (new_width, new_height) != (width, height):
+        print(f"      Resizing {xref}: {width}x{height} ({actual_dpi:.0f} DPI) → {new_width}x{new_height} ({image_dpi} DPI)")
+    
+    last_error = _apply_to_pdf(doc, page, xref, new_img_data, new_width, new_height, grayscale)
+    if last_error is not None:
+        return False, original_size, original_size, f"Replacement failed: {last_error}"
+    
+    reduction = (1 - new_size / original_size) * 100
+    if verbose:
+        print(f"      Compressed {xref}: {original_size:,} → {new_size:,} bytes ({reduction:.1f}% reduction)")
+    return True, original_size, new_size, None
+
+
+def _resize_scale(actual_dpi, image_dpi, dpi_threshold):
+    """Return the downscale factor for an image, or None if it is within the DPI threshold."""
+    return image_dpi / actual_dpi if actual_dpi > dpi_threshold else None
+
+
+def process_image_safely(doc, page, img_info, xref, image_dpi=150, quality=70, grayscale=False, verbose=True,
+                         display_rect=None, smask_xref=None):
+    """
+    Process a single image in the PDF with improved error handling and multiple fallback methods.
+    
+    display_rect: Precomputed largest placement of the image (see _prepare_image)
+    smask_xref: Soft mask xref from the get_images() entry (defaults to img_info[1])
+    
+    Returns:
+        tuple: (success, original_size, new_size, error_message)
+    """
+    dpi_threshold = image_dpi * DPI_THRESHOLD_FACTOR
+    job, skip_result = _prepare_image(doc, page, img_info, xref, image_dpi, quality, verbose, display_rect,
+                                      dpi_threshold, grayscale, smask_xref)
+    if job is None:
+        return skip_result
+    
+    encoded, process_error = _encode_job(_encode_task(job, image_dpi, dpi_threshold, grayscale, quality))
+    if process_error is not None:
+        original_size = len(job[1])
+        return False, original_size, original_size, f"Processing failed: {process_error}"
+    
+    return _finish_image(doc, page, job, encoded, image_dpi, grayscale, verbose)
 
 
 def optimize_pdf_improved(input_path, output_path, optimization_level=4, image_dpi=150, 
@@ -309,167 +880,235 @@ def optimize_pdf_improved(input_path, output_path, optimization_level=4, image_d
         dict: Optimization results including file sizes and compression ratio
     """
     try:
-        # Open the PDF document
-        doc = pymupdf.open(input_path)
-        
-        # Check if password protected
-        if doc.needs_pass:
-            raise ValueError("Password protected PDFs are not supported")
-        
-        # Get original file size
-        original_size = os.path.getsize(input_path)
-        
-        if verbose:
-            print(f"Processing: {input_path}")
-            print(f"Original size: {original_size:,} bytes")
-            print(f"Optimization level: {optimization_level}")
-            print(f"Image DPI: {image_dpi}")
-            print(f"Trim to art box: {trim_to_artbox}")
-            print(f"Grayscale conversion: {grayscale}")
-        
-        # Step 1: Art box trimming
-        if trim_to_artbox:
-            trimmed_count = 0
-            for page_num in range(len(doc)):
-                page = doc[page_num]
+        # Open the PDF document; closed when the block exits, even on error
+        with pymupdf.open(input_path) as doc:
+            # Check if password protected
+            if doc.needs_pass:
+                raise ValueError("Password protected PDFs are not supported")
+            
+            # Get original file size
+            original_size = os.path.getsize(input_path)
+            
+            if verbose:
+                print(f"Processing: {input_path}")
+                print(f"Original size: {original_size:,} bytes")
+                print(f"Optimization level: {optimization_level}")
+                print(f"Image DPI: {image_dpi}")
+                print(f"Trim to art box: {trim_to_artbox}")
+                print(f"Grayscale conversion: {grayscale}")
+            
+            # Step 1: Art box trimming
+            if trim_to_artbox:
+                trimmed_count = 0
+                for page in doc.pages():
+                    try:
+                        artbox = page.artbox
+                        if artbox and artbox != page.rect:
+                            page.set_cropbox(artbox)
+                            trimmed_count += 1
+                    except:
+                        pass
+                if verbose and trimmed_count > 0:
+                    print(f"  Trimmed {trimmed_count} page(s) to art box")
+            
+            # Step 2: Basic optimizations
+            if optimization_level >= 1:
                 try:
-                    artbox = page.artbox
-                    if artbox and artbox != page.rect:
-                        page.set_cropbox(artbox)
-                        trimmed_count += 1
-                except:
-                    pass
-            if verbose and trimmed_count > 0:
-                print(f"  Trimmed {trimmed_count} page(s) to art box")
-        
-        # Step 2: Basic optimizations
-        if optimization_level >= 1:
-            try:
-                doc.scrub(
-                    attached_files=False,
-                    clean_pages=True,
-                    embedded_files=False,
-                    hidden_text=False,
-                    javascript=True,
-                    metadata=True,
-                    redactions=True,
-                    redact_images=0,
-                    remove_links=False,
-                    reset_fields=True,
-                    reset_responses=True,
-                    thumbnails=True,
-                    xml_metadata=True
-                )
-                if verbose:
-                    print("  Applied level 1 optimization: Document cleanup")
-            except Exception as e:
-                if verbose:
-                    print(f"  Warning: Document cleanup failed: {e}")
-        
-        if optimization_level >= 2:
-            try:
-                doc.subset_fonts()
-                if verbose:
-                    print("  Applied level 2 optimization: Font subsetting")
-            except Exception as e:
-                if verbose:
-                    print(f"  Warning: Font subsetting failed: {e}")
-        
-        # Step 3: Image optimization (levels 3 and 4)
-        if optimization_level >= 3:
-            quality = 75 if optimization_level == 3 else 50
+                    doc.scrub(
+                        attached_files=False,
+                        clean_pages=True,
+                        embedded_files=False,
+                        hidden_text=False,
+                        javascript=True,
+                        metadata=True,
+                        redactions=True,
+                        redact_images=0,
+                        remove_links=False,
+                        reset_fields=True,
+                        reset_responses=True,
+                        thumbnails=True,
+                        xml_metadata=True
+                    )
+                    if verbose:
+                        print("  Applied level 1 optimization: Document cleanup")
+                except Exception as e:
+                    if verbose:
+                        print(f"  Warning: Document cleanup failed: {e}")
             
-            # Collect all unique images
-            all_images = {}  # xref -> (page, img_info, page_count)
-            image_usage = {}  # xref -> count
+            if optimization_level >= 2:
+                try:
+                    doc.subset_fonts()
+                    if verbose:
+                        print("  Applied level 2 optimization: Font subsetting")
+                except Exception as e:
+                    if verbose:
+                        print(f"  Warning: Font subsetting failed: {e}")
+            
+            # Step 3: Image optimization (levels 3 and 4)
+            if optimization_level >= 3:
+                quality = 75 if optimization_level == 3 else 50
+                dpi_threshold = image_dpi * DPI_THRESHOLD_FACTOR
             
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                image_list = page.get_images()
+                # Collect all unique images
+                all_images = {}  # xref -> (page, img_info, page_count)
+                image_usage = Counter()  # xref -> count
+                display_rects = {}  # xref -> largest placement on any page
+            
+                for page_index, page in enumerate(doc.pages()):
+                    image_list = page.get_images(full=True)
+                    image_usage.update(img[0] for img in image_list)
                 
-                for img in image_list:
-                    xref = img[0]
-                    if xref not in all_images:
-                        all_images[xref] = (page, img, page_num + 1)
-                        image_usage[xref] = 1
-                    else:
-                        image_usage[xref] += 1
+                    for img in image_list:
+                        xref = img[0]
+                        all_images.setdefault(xref, (page, img, page_index + 1))
+                    
+                        # DPI is judged at the largest display size, so an image shown
+                        # small on one page and large on another is not over-reduced
+                        try:
+                            for rect in page.get_image_rects(img):
+                                largest = display_rects.get(xref)
+                                if largest is None or rect.width * rect.height > largest.width * largest.height:
+                                    display_rects[xref] = rect
+                        except Exception:
+                            pass
             
-            if verbose:
-                total_refs = sum(image_usage.values())
-                print(f"  Found {len(all_images)} unique image(s) with {total_refs} total reference(s)")
-                print(f"  Target quality: {quality}, DPI: {image_dpi}")
+                # Collapse identical images embedded under several xrefs; the orphaned
+                # copies are dropped by garbage collection on save
+                duplicates = _find_duplicate_images(doc, {xref: img for xref, (_, img, _) in all_images.items()})
+                if duplicates:
+                    unresolved = _repoint_image_references(doc, duplicates)
+                    merged = 0
+                    for xref, canonical in duplicates.items():
+                        if xref in unresolved:
+                            continue
+                        image_usage[canonical] += image_usage.pop(xref)
+                        rect = display_rects.pop(xref, None)
+                        largest = display_rects.get(canonical)
+                        if rect is not None and (largest is None or
+                                                 rect.width * rect.height > largest.width * largest.height):
+                            display_rects[canonical] = rect
+                        del all_images[xref]
+                        merged += 1
+                    if verbose and merged:
+                        print(f"  Merged {merged} duplicate image(s)")
+            
+                if verbose:
+                    total_refs = sum(image_usage.values())
+                    print(f"  Found {len(all_images)} unique image(s) with {total_refs} total reference(s)")
+                    print(f"  Target quality: {quality}, DPI: {image_dpi}")
+            
+                # Process images with detailed tracking
+                processed_count = 0
+                failed_count = 0
+                total_original_image_size = 0
+                total_compressed_image_size = 0
+                error_summary = {}
+            
+                outcomes = []  # (xref, page_num, result tuple, lossless)
             
-            # Process images with detailed tracking
-            processed_count = 0
-            failed_count = 0
-            total_original_image_size = 0
-            total_compressed_image_size = 0
-            error_summary = {}
+                # Images are inspected/extracted and written back on the main thread
+                # (PyMuPDF is only ever touched there) while decode/resize/encode runs
+                # on worker threads, which Pillow lets run without the GIL. At most
+                # 2 * workers extracted images are in flight, bounding peak memory.
+                workers = os.cpu_count() or 1
+                pending = deque()  # (job, page, page_num, future) in submission order
+                applied = 0
             
-            for xref, (page, img, page_num) in all_images.items():
-                success, orig_size, new_size, error_msg = process_image_safely(
-                    doc, page, img, xref, image_dpi, quality, grayscale, verbose
-                )
+                def apply_oldest():
+                    nonlocal applied
+                    job, page, page_num, future = pending.popleft()
+                    encoded, process_error = future.result()
+                    if process_error is not None:
+                        image_size = len(job[1])
+                        result = (False, image_size, image_size, f"Processing failed: {process_error}")
+                    else:
+                        result = _finish_image(doc, page, job, encoded, image_dpi, grayscale, verbose)
+                    outcomes.append((job[0], page_num, result, job[5]))
                 
-                if success:
-                    processed_count += 1
-                    total_original_image_size += orig_size
-                    total_compressed_image_size += new_size
-                else:
-                    failed_count += 1
-                    if error_msg:
-                        error_type = error_msg.split(':')[0]  # Get error category
-                        error_summary[error_type] = error_summary.get(error_type, 0) + 1
-                        if verbose and "failed" in error_msg.lower():
-                            print(f"      Failed to process {xref} on page {page_num}: {error_msg}")
+                    applied += 1
+                    if applied % GC_INTERVAL == 0:
+                        gc.collect()
             
-            if verbose:
-                if processed_count > 0:
-                    image_reduction = (1 - total_compressed_image_size / total_original_image_size) * 100
-                    print(f"  Successfully processed: {processed_count} images")
-                    print(f"  Image compression: {total_original_image_size:,} → {total_compressed_image_size:,} bytes ({image_reduction:.1f}% reduction)")
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for xref, (page, img, page_num) in all_images.items():
+                        job, skip_result = _prepare_image(doc, page, img, xref, image_dpi, quality, verbose,
+                                                          display_rects.get(xref), dpi_threshold, grayscale,
+                                                          img[1])
+                        if job is None:
+                            outcomes.append((xref, page_num, skip_result, False))
+                            continue
+                    
+                        task = _encode_task(job, image_dpi, dpi_threshold, grayscale, quality)
+                        pending.append((job, page, page_num, executor.submit(_encode_job, task)))
+                        del job, task  # pending holds the only reference to the image bytes
+                        if len(pending) > 2 * workers:
+                            apply_oldest()
                 
-                if failed_count > 0:
-                    print(f"  Skipped/failed: {failed_count} images")
-                    for error_type, count in error_summary.items():
-                        print(f"    {error_type}: {count} image(s)")
-        
-        # Step 4: Save with optimized settings
-        save_options = {
-            'garbage': min(optimization_level, 4),
-            'deflate': True,
-            'deflate_images': True,
-            'deflate_fonts': True,
-            'clean': True,
-            'pretty': False,
-            'no_new_id': False,
-            'preserve_metadata': False,
-        }
-        
-        if optimization_level >= 3:
-            save_options['use_objstms'] = True
-        
-        # Advanced compression for level 4
-        if optimization_level >= 4:
-            try:
-                save_options['compression_effort'] = 100
-            except:
-                pass  # Not supported in all versions
-        
-        # Save the optimized PDF
-        try:
-            doc.save(output_path, **save_options)
-        except TypeError as e:
-            if 'compression_effort' in save_options:
-                del save_options['compression_effort']
+                    while pending:
+                        apply_oldest()
+            
+                lossless_saved = 0  # bytes saved by lossless JPEG re-optimization
+                for xref, page_num, (success, orig_size, new_size, error_msg), lossless in outcomes:
+                    if success:
+                        processed_count += 1
+                        total_original_image_size += orig_size
+                        total_compressed_image_size += new_size
+                        if lossless:
+                            lossless_saved += orig_size - new_size
+                    else:
+                        failed_count += 1
+                        if error_msg:
+                            error_type = error_msg.split(':')[0]  # Get error category
+                            error_summary[error_type] = error_summary.get(error_type, 0) + 1
+                            if verbose and "failed" in error_msg.lower():
+                                print(f"      Failed to process {xref} on page {page_num}: {error_msg}")
+            
                 if verbose:
-                    print("  Note: compression_effort not supported, using standard compression")
+                    if processed_count > 0:
+                        image_reduction = (1 - total_compressed_image_size / total_original_image_size) * 100
+                        print(f"  Successfully processed: {processed_count} images")
+                        print(f"  Image compression: {total_original_image_size:,} → {total_compressed_image_size:,} bytes ({image_reduction:.1f}% reduction)")
+                        if lossless_saved:
+                            print(f"    of which lossless JPEG re-optimization: {lossless_saved:,} bytes")
+                
+                    if failed_count > 0:
+                        print(f"  Skipped/failed: {failed_count} images")
+                        for error_type, count in error_summary.items():
+                            print(f"    {error_type}: {count} image(s)")
+            
+            # Step 4: Save with optimized settings
+            save_options = {
+                'garbage': min(optimization_level, 4),
+                'deflate': True,
+                'deflate_images': True,
+                'deflate_fonts': True,
+                'clean': True,
+                'pretty': False,
+                'no_new_id': False,
+                'preserve_metadata': False,
+            }
+            
+            if optimization_level >= 3:
+                save_options['use_objstms'] = True
+            
+            # Advanced compression for level 4
+            if optimization_level >= 4:
+                try:
+                    save_options['compression_effort'] = 100
+                except:
+                    pass  # Not supported in all versions
+            
+            # Save the optimized PDF
+            try:
                 doc.save(output_path, **save_options)
-            else:
-                raise e
-        
-        doc.close()
+            except TypeError as e:
+                if 'compression_effort' in save_options:
+                    del save_options['compression_effort']
+                    if verbose:
+                        print("  Note: compression_effort not supported, using standard compression")
+                    doc.save(output_path, **save_options)
+                else:
+                    raise e
         
         # Final size calculation
         optimized_size = os.path.getsize(output_path)
@@ -495,9 +1134,6 @@ def optimize_pdf_improved(input_path, output_path, optimization_level=4, image_d
             'success': False,
             'error': str(e)
         }
-    finally:
-        if 'doc' in locals() and not doc.is_closed:
-            doc.close()
 
 
 def process_batch(pdf_files, output_dir=None, optimization_level=4, 
@@ -645,6 +1281,9 @@ Examples:
         print("Error: No valid PDF files found")
         sys.exit(1)
     
+    if args.verbose and not PILLOW_SIMD:
+        print(f"Hint: Pillow {Image.__version__} detected; install pillow-simd for faster image processing")
+    
     # Process files
     print(f"PDF Optimizer (Improved) - Processing {len(valid_files)} file(s)")
     print(f"Settings: Level={args.level}, DPI={args.dpi}, Trim={'ON' if not args.no_trim else 'OFF'}, Grayscale={'ON' if args.grayscale else 'OFF'}")
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import os
+import re
 import sys
 import io
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageChops
 
 try:
     import fitz  # PyMuPDF
@@ -26,34 +31,328 @@ except ImportError:
     print("Warning: pikepdf is not available. Advanced SMask processing will be limited.")
     PIKEPDF_AVAILABLE = False
 
+# mozjpegによるロスレス再最適化（任意、ハフマン表・プログレッシブ化のみで画質は変わらない）
+try:
+    import mozjpeg_lossless_optimization
+    MOZJPEG_AVAILABLE = True
+except ImportError:
+    MOZJPEG_AVAILABLE = False
+
+# zlib-ng（任意、zlib互換の出力をSIMDで高速に圧縮）
+try:
+    from zlib_ng import zlib_ng
+    ZLIB_NG_AVAILABLE = True
+except ImportError:
+    ZLIB_NG_AVAILABLE = False
+
+# ICCプロファイルによる色変換（任意、CMYK画像をRGBにする際に使用）
+try:
+    from PIL import ImageCms
+    IMAGECMS_AVAILABLE = True
+except ImportError:
+    IMAGECMS_AVAILABLE = False
+
+# 画素ループのJITコンパイル（任意）
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# SIMD版Lanczosリサンプラ（任意、Pillow互換）
+try:
+    from pic_scale import Plan, Resampling as PSR
+    PIC_SCALE_AVAILABLE = True
+except ImportError:
+    PIC_SCALE_AVAILABLE = False
+
+# pic-scaleが扱えるモード（それ以外はPillowでリサイズ）
+PIC_SCALE_MODES = ('L', 'LA', 'RGB', 'RGBA')
+
+# 大きな縮小ではまず整数倍率のreduce()（ボックス平均）で縮め、目標サイズの
+# この倍率以上が残った状態からLanczosをかける（Pillowのreducing_gapと同じ意味）
+REDUCING_GAP = 2.0
+
+# xref_get_key(xref, "SMask") が返す間接参照 "12 0 R" からオブジェクト番号を取り出す
+SMASK_REF_RE = re.compile(r'(\d+)\s+\d+\s+R')
+
+# 背景画像のぼかし半径（radius=5 のガウシアンブラー3回分に相当）
+BACKGROUND_BLUR_RADIUS = 5 * 3 ** 0.5
+
+# プログレッシブJPEGにする最小画素数
+# PDFビューアは一括描画なので段階表示の利点はなく、小さな画像ではスキャンヘッダ分だけ大きくなる
+PROGRESSIVE_MIN_PIXELS = 200_000
+
+# SMaskのJPEG品質はRGBの品質からこれだけ下げる（ただしALPHA_MIN_QUALITY未満にはしない）
+# 合成結果への影響は色より小さい。縁のリンギングが目立たないよう下げすぎない
+ALPHA_QUALITY_DROP = 20
+ALPHA_MIN_QUALITY = 35
+
+# IJG標準の輝度量子化テーブル（JPEGの品質推定に使用）
+STD_LUMA_QTABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_plan(src_size, dst_size, mode, premultiply_alpha=True):
+    """
+    pic-scaleのLanczosプランを取得
+    フィルタ係数は同じサイズ・モードの組み合わせで一度だけ計算して再利用する
+    """
+    return Plan(src_size, dst_size, PSR.LANCZOS, mode, premultiply_alpha=premultiply_alpha, workers=0)
+
+
+def prereduce(img, size):
+    """
+    REDUCING_GAPを残して整数倍率のボックス平均で先に縮小する（pic-scale用）
+    reduce()は割り切れない端数で画像がずれるため、画像全体を保つBOXリサイズを使う
+    """
+    factor_x = int(img.width / size[0] / REDUCING_GAP) or 1
+    factor_y = int(img.height / size[1] / REDUCING_GAP) or 1
+    if factor_x > 1 or factor_y > 1:
+        img = img.resize((round(img.width / factor_x), round(img.height / factor_y)), Image.Resampling.BOX)
+    return img
+
+
+def resize_lanczos(img, size):
+    """Lanczosリサイズ（pic-scaleがあればSIMD版、なければPillow）"""
+    if PIC_SCALE_AVAILABLE and img.mode in PIC_SCALE_MODES:
+        img = prereduce(img, size)
+        # アルファはPillowと同じく乗算済みで補間（LA/RGBA以外には影響しない）
+        return _get_plan(img.size, size, img.mode).resize(img)
+    return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+
+
+def resize_smask(smask_img, size):
+    """
+    SMaskをベース画像のサイズに合わせる
+    アルファは滑らかな（または2値の）面なので8タップのLanczosは使わず、
+    縮小だけならBOX（画素平均）、拡大を含むならBILINEARで補間する
+    """
+    if smask_img.width >= size[0] and smask_img.height >= size[1]:
+        return smask_img.resize(size, Image.Resampling.BOX)
+    return smask_img.resize(size, Image.Resampling.BILINEAR)
+
+
+def resize_with_smask(base_img, smask_img, size):
+    """
+    ベース画像(RGB)とSMask(L)を1回のLanczosパスでまとめてリサイズ
+    SMaskは別ストリームに保存するため、アルファを乗算せず独立したチャンネルとして補間する
+    
+    Returns:
+        (base_img, smask_img): リサイズ後のRGB画像とL画像
+    """
+    if PIC_SCALE_AVAILABLE:
+        # RGBAのままPillowで縮小するとアルファが乗算されるため、先縮小はチャンネルを分けたまま行う
+        merged = Image.merge('RGBA', (*prereduce(base_img, size).split(), prereduce(smask_img, size)))
+        merged = _get_plan(merged.size, size, 'RGBA', False).resize(merged)
+    else:
+        # RGBaモードはPillowがアルファ乗算をせずに4チャンネルをそのまま補間する
+        merged = Image.merge('RGBa', (*base_img.split(), smask_img))
+        merged = merged.resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    r, g, b, a = merged.split()
+    return Image.merge('RGB', (r, g, b)), a
+
+
+def alpha_jpeg_quality(quality):
+    """RGBの品質 quality に対するSMask用のJPEG品質（RGBより高くはしない）"""
+    return min(quality, max(ALPHA_MIN_QUALITY, quality - ALPHA_QUALITY_DROP))
+
+
+def encode_jpeg(img, quality):
+    """
+    JPEGエンコード（PROGRESSIVE_MIN_PIXELS 以上の画像だけプログレッシブ）
+    mozjpegがあればPillowのハフマン最適化の代わりにmozjpegでロスレス再最適化する
+    """
+    progressive = img.width * img.height >= PROGRESSIVE_MIN_PIXELS
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=not MOZJPEG_AVAILABLE, progressive=progressive)
+    # getvalue()はBytesIOの内部バッファをそのまま返すのでコピーは発生しない
+    jpeg_data = output.getvalue()
+    if MOZJPEG_AVAILABLE:
+        optimized = mozjpeg_lossless_optimization.optimize(jpeg_data)
+        if len(optimized) < len(jpeg_data):
+            jpeg_data = optimized
+    return jpeg_data
+
+
+def deflate(data):
+    """Flateストリーム用の圧縮（zlib-ngのレベル6は標準zlibのレベル9と同程度のサイズで速い）"""
+    if ZLIB_NG_AVAILABLE:
+        return zlib_ng.compress(data, 6)
+    return zlib.compress(data, 9)
+
+
+def encode_indexed_flate(img, gray=False):
+    """
+    パレット画像（Pモード）をRGBに展開せず、/Indexed のFlateストリームにする
+    インデックスの差には意味がないので予測子は付けない（PNGもパレット画像はフィルタなしを推奨）
+    gray=True ならベースを DeviceGray にする（1色1バイト、元がグレースケールの画像用）
+    ベースの色空間を変えると透明グループの合成結果が変わるので、元画像の色空間に合わせること
+    
+    Returns:
+        (colorspace, flate_data)
+    """
+    hival = img.getextrema()[1]
+    palette = bytes(img.getpalette('RGB')[:3 * (hival + 1)]).ljust(3 * (hival + 1), b'\0')
+    if gray:
+        colorspace = f"[/Indexed/DeviceGray {hival}<{palette[0::3].hex()}>]"
+    else:
+        colorspace = f"[/Indexed/DeviceRGB {hival}<{palette.hex()}>]"
+    return colorspace, deflate(img.tobytes())
+
+
+def encode_indexed_if_few_colors(img, max_colors=256):
+    """
+    色数が max_colors 以下（文字・図版など）ならパレット化して encode_indexed_flate でロスレス保存
+    写真のように色数が多い画像はNone（Flateでは小さくならない）
+    getcolors() は上限を超えた時点で数えるのをやめるので、写真の判定は安い
+    """
+    colors = img.getcolors(max_colors)
+    if colors is None:
+        return None
+    # メディアンカットは色数が指定以下なら元の色をそのままパレットにする
+    return encode_indexed_flate(img.quantize(len(colors)), gray=img.mode == 'L')
+
+
+def estimate_jpeg_quality(img):
+    """
+    JPEGの輝度量子化テーブルからIJG相当の品質値を推定する（ヘッダのみ参照、デコード不要）
+    JPEGでない・テーブルがない場合はNone
+    """
+    tables = getattr(img, 'quantization', None)
+    if not tables or 0 not in tables:
+        return None
+    scale = sum(tables[0]) * 100 / sum(STD_LUMA_QTABLE)
+    if scale <= 100:
+        quality = (200 - scale) / 2
+    else:
+        quality = 5000 / scale
+    return max(1, min(100, round(quality)))
+
+
+def split_alpha(img):
+    """
+    RGBA/LA画像をRGB画像とアルファ（L）に分離
+    どちらもPillowのC実装で1パス（convert('RGB') はLAのグレーを3チャンネルに複製する）。
+    np.asarray() はPillowのバッファを共有せずコピーするので、NumPy経由より速い
+    """
+    return img.convert('RGB'), img.getchannel('A')
+
+
+if NUMBA_AVAILABLE:
+    # process_images_threaded のスレッドから呼ばれるので parallel ではなく nogil にする
+    @njit(nogil=True, cache=True)
+    def _composite_on_white_kernel(pixels):
+        """白背景への合成を1パスで行う（uint16の中間配列なし、LAはグレーを3チャンネルに複製）"""
+        height, width, channels = pixels.shape
+        out = np.empty((height, width, 3), dtype=np.uint8)
+        for y in range(height):
+            for x in range(width):
+                a = np.uint32(pixels[y, x, channels - 1])
+                background = 255 * (255 - a) + 128
+                for c in range(3):
+                    t = np.uint32(pixels[y, x, min(c, channels - 2)]) * a + background
+                    out[y, x, c] = (t + (t >> 8)) >> 8
+        return out
+
+
+def composite_on_white(img):
+    """
+    RGBA/LA画像を白背景に合成してRGB画像を返す
+    NumPyの整数演算で、Pillowのpaste(mask=)と同じ丸めになる（Numbaがあれば同じ式をJITで1パス）
+    アルファがすべて255なら合成せずにカラー部分を取り出すだけ
+    """
+    pixels = np.asarray(img)
+    if NUMBA_AVAILABLE:
+        return Image.fromarray(_composite_on_white_kernel(pixels))
+    color = pixels[..., :-1]
+    alpha = pixels[..., -1:]
+    if alpha.min() < 255:
+        # color * a + 255 * (255 - a) を丸めて255で割る
+        alpha = alpha.astype(np.uint16)
+        blended = color.astype(np.uint16) * alpha + 255 * (255 - alpha) + 128
+        color = ((blended + (blended >> 8)) >> 8).astype(np.uint8)
+    if img.mode == 'LA':  # グレースケールを3チャンネルに複製
+        color = np.repeat(color, 3, axis=-1)
+    return Image.fromarray(np.ascontiguousarray(color))
+
+
+# 透明度判定で先に調べる先頭部分のサイズ（不透明でない画素は画像の端に現れやすい）
+ALPHA_PROBE_BYTES = 4096
+
+# SMaskストリームを展開して調べる単位（透明な画素が見つかればそれ以降は展開しない）
+SMASK_SAMPLE_BYTES = 65536
+
+
+def alpha_below(alpha, threshold):
+    """
+    アルファ（L画像）にthreshold未満の値があるかをNumPyの最小値集約で判定
+    先頭ALPHA_PROBE_BYTESで見つかれば残りは走査しない
+    """
+    values = np.asarray(alpha).reshape(-1)
+    if values[:ALPHA_PROBE_BYTES].min() < threshold:
+        return True
+    return bool(values.min() < threshold)
+
+
+def peek_png_transparency(data):
+    """
+    PNGのチャンク見出しだけを読み、透明度を持ち得るかを判定（伸張なし）
+    IHDRのカラータイプ 4/6（アルファ付き）か、IDAT前の tRNS チャンクがあれば True。
+    PNGとして解釈できない場合も True を返し、判定をPILに委ねる。
+    """
+    if data[:8] != b'\x89PNG\r\n\x1a\n' or data[12:16] != b'IHDR' or len(data) < 26:
+        return True
+    if data[25] in (4, 6):
+        return True
+    
+    # tRNS は仕様上 IDAT より前に置かれる
+    pos = 8
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        chunk_type = data[pos + 4:pos + 8]
+        if chunk_type == b'tRNS':
+            return True
+        if chunk_type in (b'IDAT', b'IEND'):
+            return False
+        pos += length + 12
+    return True
 
-def should_preserve_transparency(doc, xref, verbose=False):
+
+def should_preserve_transparency(doc, xref, verbose=False, cache=None):
     """
     Simple check: only preserve PNG images with actual transparency.
     Process all JPEG images regardless of SMask.
+    cache: per-image dict shared with the other checks (see cached_extract_image)
     """
     try:
-        img_dict = doc.extract_image(xref)
+        img_dict = cached_extract_image(doc, xref, cache)
         if not img_dict:
             return False, "No data"
         
         img_format = img_dict.get('ext', 'unknown')
         
         # Only preserve PNG with real transparency
-        if img_format == 'png':
+        # (header says no alpha and no tRNS -> skip decoding entirely)
+        if img_format == 'png' and peek_png_transparency(img_dict['image']):
             try:
-                img = Image.open(io.BytesIO(img_dict['image']))
+                img = cached_open_image(doc, xref, cache)
                 
                 if img.mode in ('RGBA', 'LA'):
-                    if img.mode == 'RGBA':
-                        alpha = img.split()[3]
-                    else:
-                        alpha = img.split()[1]
-                    
-                    alpha_min, alpha_max = alpha.getextrema()
+                    alpha = img.getchannel('A')
                     
-                    if alpha_min < 255:  # Has actual transparency
+                    if alpha_below(alpha, 255):  # Has actual transparency
                         if verbose:
+                            alpha_min, alpha_max = alpha.getextrema()
                             print(f"        PNG with transparency (alpha: {alpha_min}-{alpha_max})")
                         return True, "PNG transparency"
                 
@@ -68,7 +367,7 @@ def should_preserve_transparency(doc, xref, verbose=False):
         
         # Process all JPEG images, even with SMask
         if verbose and img_format in ('jpeg', 'jpg'):
-            smask = doc.xref_get_key(xref, "SMask")
+            smask = cached_smask_ref(doc, xref, cache)
             if smask and smask not in [None, 'null', ('null', 'null')]:
                 print(f"        JPEG with SMask - will process and preserve SMask")
         
@@ -94,183 +393,564 @@ def extract_smask_data(doc, smask_ref):
     return None
 
 
-def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, image_dpi=150, preserve_background=False, verbose=True):
+
+def cached_extract_image(doc, xref, cache=None):
     """
-    pikepdfを使った完全なJPEG+SMask分離処理
-    PyMuPDFの制限を回避してSMask参照を維持
+    doc.extract_image の結果をxref単位でキャッシュ
+    cacheは画像1枚の処理中だけ使うdict（Noneなら毎回抽出）
+    """
+    if cache is None:
+        return doc.extract_image(xref)
+    key = ('image', xref)
+    if key not in cache:
+        cache[key] = doc.extract_image(xref)
+    return cache[key]
+
+
+def cached_open_image(doc, xref, cache=None):
+    """抽出した画像データをPILで開いた結果をキャッシュ（データがなければNone）"""
+    key = ('pil', xref)
+    if cache is not None and key in cache:
+        return cache[key]
+    img_dict = cached_extract_image(doc, xref, cache)
+    img = Image.open(io.BytesIO(img_dict['image'])) if img_dict else None
+    if cache is not None:
+        cache[key] = img
+    return img
+
+
+def cached_smask_ref(doc, xref, cache=None):
+    """doc.xref_get_key(xref, "SMask") の結果をキャッシュ"""
+    if cache is None:
+        return doc.xref_get_key(xref, "SMask")
+    key = ('smask', xref)
+    if key not in cache:
+        cache[key] = doc.xref_get_key(xref, "SMask")
+    return cache[key]
+
+
+def sample_smask_min(doc, smask_xref, threshold=250):
+    """
+    SMaskストリームを画像としてデコードせずにアルファの最小値を調べる
+    8bit・FlateDecode・予測子なし・Decode配列が恒等のストリームのみ対象（それ以外はNone）
+    SMASK_SAMPLE_BYTESずつ展開し、threshold未満が見つかった時点で打ち切る
+    （その場合の戻り値は実際の最小値以上だがthreshold未満）
+    """
+    try:
+        if doc.xref_get_key(smask_xref, "BitsPerComponent")[1] != '8':
+            return None
+        if doc.xref_get_key(smask_xref, "Filter")[1] != '/FlateDecode':
+            return None
+        # PNG予測子はデータに行ごとのフィルタバイトが入るため対象外
+        if doc.xref_get_key(smask_xref, "DecodeParms/Predictor")[1] not in ('null', '1'):
+            return None
+        # Decode配列は恒等変換 [0 1] のみ対象
+        decode = doc.xref_get_key(smask_xref, "Decode")
+        if decode[0] != 'null' and decode[1].replace(' ', '') not in ('[01]', '[0.01.0]'):
+            return None
+        
+        inflater = zlib.decompressobj()
+        chunk = inflater.decompress(doc.xref_stream_raw(smask_xref), SMASK_SAMPLE_BYTES)
+        if not chunk:
+            return None
+        alpha_min = 255
+        while chunk:
+            alpha_min = min(alpha_min, int(np.frombuffer(chunk, np.uint8).min()))
+            if alpha_min < threshold:
+                break
+            chunk = inflater.decompress(inflater.unconsumed_tail, SMASK_SAMPLE_BYTES)
+        return alpha_min
+    except Exception:
+        return None
+
+
+def cached_smask_min(doc, xref, smask_ref, cache=None):
+    """sample_smask_min の結果をキャッシュ（SMask参照がxrefでなければNone）"""
+    key = ('smask_min', xref)
+    if cache is not None and key in cache:
+        return cache[key]
+    alpha_min = None
+    if isinstance(smask_ref, tuple) and smask_ref[0] == 'xref':
+        alpha_min = sample_smask_min(doc, int(smask_ref[1].split()[0]))
+    if cache is not None:
+        cache[key] = alpha_min
+    return alpha_min
+
+
+def cached_smask_data(doc, xref, smask_ref, cache=None):
+    """extract_smask_data の結果（SMask画像またはNone）をキャッシュ"""
+    if cache is None:
+        return extract_smask_data(doc, smask_ref)
+    key = ('smask_img', xref)
+    if key not in cache:
+        cache[key] = extract_smask_data(doc, smask_ref)
+    return cache[key]
+
+def encode_smask_pair(base_img, smask_img, width, height, quality=70, image_dpi=150, preserve_background=False):
+    """
+    complete_jpeg_smask_separation_pikepdf のワーカー処理
+    リサイズ・背景判定・JPEGエンコードを行う（pikepdfのオブジェクトには触れないのでスレッドで実行可能）
     
     Returns:
-        success (bool): 処理成功フラグ
-        processed_count (int): 処理した画像数
-        result_message (str): 結果メッセージ
+        size (tuple): 出力サイズ (width, height)（ベース画像とSMaskで共通）
+        jpeg_data (bytes): ベース画像のJPEG
+        alpha_data (bytes): SMaskのグレースケールJPEG
+        log (list): 詳細表示用のメッセージ
     """
-    if not PIKEPDF_AVAILABLE:
-        return False, 0, "pikepdf not available"
+    log = []
+    
+    # サイズ合わせ
+    if base_img.size != smask_img.size:
+        smask_img = resize_smask(smask_img, base_img.size)
+    
+    # DPI最適化（解像度ダウン）
+    # 実効DPIを推定（ピクセル数ベース）
+    # 一般的なPDFでは72 DPI基準で計算
+    estimated_dpi = max(width, height) / 10  # 簡易推定
+    dpi_threshold = image_dpi * 1.5
+    
+    if estimated_dpi > dpi_threshold:
+        scale = image_dpi / estimated_dpi
+        new_width = max(int(width * scale), 32)
+        new_height = max(int(height * scale), 32)
+        
+        log.append(f"      DPI最適化: {width}x{height} → {new_width}x{new_height}")
+        
+        # 画像リサイズ
+        base_img, smask_img = resize_with_smask(base_img, smask_img, (new_width, new_height))
+    
+    # 背景画像判定（PyMuPDF版のロジックを再実装）
+    is_background = False
+    if not preserve_background:
+        # 簡易背景判定：大きい画像は背景の可能性が高い
+        img_area = base_img.width * base_img.height
+        if img_area > 1000000:  # 100万ピクセル以上は背景候補
+            is_background = True
+            log.append(f"      背景画像判定: {base_img.width}x{base_img.height} ({img_area:,}px)")
+    
+    # JPEG品質調整と極端劣化
+    current_quality = quality
+    if is_background:
+        current_quality = 1  # 背景画像は品質1
         
+        # さらに極端な劣化：解像度を大幅に下げる
+        ultra_width = max(base_img.width // 4, 32)
+        ultra_height = max(base_img.height // 4, 32)
+        base_img, smask_img = resize_with_smask(base_img, smask_img, (ultra_width, ultra_height))
+        
+        log.append(f"      背景画像: 超劣化適用 → {ultra_width}x{ultra_height}, JPEG品質1")
+    
+    # JPEGで保存
+    jpeg_data = encode_jpeg(base_img, current_quality)
+    
+    # Alpha（SMask）をグレースケールJPEGで保存（ColorSpace DeviceGrayと一致、品質はRGBより低め）
+    alpha_data = encode_jpeg(smask_img, alpha_jpeg_quality(current_quality))
+    
+    return base_img.size, jpeg_data, alpha_data, log
+
+
+@functools.lru_cache(maxsize=8)
+def _cmyk_to_srgb_transform(icc_data):
+    """CMYKのICCプロファイルからsRGBへの変換を作成（同じプロファイルは使い回す）"""
+    profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_data))
+    return ImageCms.buildTransform(profile, ImageCms.createProfile('sRGB'), 'CMYK', 'RGB')
+
+
+def cmyk_jpeg_to_rgb(img, colorspace):
+    """
+    CMYKのJPEGをRGBに変換
+    Adobe形式（APP14）のJPEGは値が反転して格納されているので戻してから、
+    ICCBasedならそのプロファイルでsRGBに変換する（使えなければ単純変換）
+    """
+    if 'adobe' in img.info:
+        img = ImageChops.invert(img)
+    if IMAGECMS_AVAILABLE and isinstance(colorspace, pikepdf.Array) and len(colorspace) == 2 \
+            and colorspace[0] == '/ICCBased':
+        try:
+            transform = _cmyk_to_srgb_transform(bytes(colorspace[1].read_bytes()))
+            return ImageCms.applyTransform(img, transform)
+        except Exception:
+            pass
+    return img.convert('RGB')
+
+
+def pikepdf_image_to_pil(obj):
+    """
+    pikepdfの画像XObjectをPIL画像に変換
+    8bitのDeviceRGB/DeviceGrayでFlate圧縮（または無圧縮）のものは、
+    デコード済みバッファから Image.frombuffer で直接作る（BytesIO経由のコピーを省く）。
+    DCTのCMYK画像はAdobeの反転とICCプロファイルを考慮してRGBにする
+    （as_pil_image() は反転を戻さず、SMaskも合成してしまう）。
+    それ以外は PdfImage.as_pil_image() に任せる。
+    """
+    mode = {'/DeviceRGB': 'RGB', '/DeviceGray': 'L'}.get(str(obj.get('/ColorSpace')))
+    filters = obj.get('/Filter')
+    if filters is not None and not isinstance(filters, pikepdf.Array):
+        filters = [filters]
+    if (mode is not None and obj.get('/BitsPerComponent') == 8 and '/Decode' not in obj
+            and all(f == pikepdf.Name.FlateDecode for f in (filters or []))):
+        try:
+            width = int(obj['/Width'])
+            height = int(obj['/Height'])
+            buffer = obj.get_stream_buffer()
+            if len(buffer) >= width * height * len(mode):
+                return Image.frombuffer(mode, (width, height), buffer, 'raw', mode, 0, 1)
+        except Exception:
+            pass
+    if filters == [pikepdf.Name.DCTDecode] and '/Decode' not in obj:
+        try:
+            img = Image.open(io.BytesIO(bytes(obj.read_raw_bytes())))
+            if img.mode == 'CMYK':
+                return cmyk_jpeg_to_rgb(img, obj.get('/ColorSpace'))
+        except Exception:
+            pass
+    return pikepdf.PdfImage(obj).as_pil_image()
+
+
+def raw_jpeg_quality(obj, raw=None):
+    """
+    DCTDecodeのみで圧縮された画像XObjectのJPEG品質を推定する
+    Image.open はヘッダしか読まないので、画素はデコードしない。JPEGでなければNone
+    raw: 読み込み済みの obj.read_raw_bytes()
+    """
+    filters = obj.get('/Filter')
+    if filters is not None and not isinstance(filters, pikepdf.Array):
+        filters = [filters]
+    if filters != [pikepdf.Name.DCTDecode] or '/Decode' in obj:
+        return None
     try:
-        pdf = pikepdf.Pdf.open(pdf_path)
+        if raw is None:
+            raw = bytes(obj.read_raw_bytes())
+        return estimate_jpeg_quality(Image.open(io.BytesIO(raw)))
+    except Exception:
+        return None
+
+
+def smask_pair_keeps_size(width, height, image_dpi=150, preserve_background=False):
+    """encode_smask_pair がDPI最適化も背景画像の劣化もせず、元のサイズのままエンコードするか"""
+    if max(width, height) / 10 > image_dpi * 1.5:
+        return False
+    return preserve_background or width * height <= 1000000
+
+
+def encode_page_smask_images(pdf_source, page_index, quality=70, image_dpi=150, preserve_background=False,
+                             max_workers=None):
+    """
+    ページ上のSMask付き画像をデコードし、JPEG+SMaskにエンコードする
+    pdf_source: PDFのパスまたはPDF全体のbytes
+    PDFは読み取りのみで、pikepdfのオブジェクトは返さない（プロセスプールのワーカーとして実行可能）
+    
+    Returns:
+        ページにXObjectがなければNone、それ以外は (name, objgen, original_size, log, result) のリスト
+        result: encode_smask_pair の (size, jpeg_data, alpha_data)、失敗時はNone
+    """
+    if isinstance(pdf_source, bytes):
+        pdf_source = io.BytesIO(pdf_source)
+    with pikepdf.Pdf.open(pdf_source) as pdf:
         page = pdf.pages[page_index]
         
         if '/Resources' not in page or '/XObject' not in page['/Resources']:
-            pdf.close()
-            return False, 0, "No images found"
+            return None
             
         xobjects = page['/Resources']['/XObject']
-        processed_count = 0
-        total_savings = 0
         
-        for name, obj in xobjects.items():
-            if '/Subtype' in obj and obj['/Subtype'] == '/Image' and '/SMask' in obj:
-                try:
-                    width = int(obj['/Width'])
-                    height = int(obj['/Height'])
-                    
-                    if verbose:
-                        print(f"    pikepdf処理: {name} ({width}x{height})")
-                    
-                    # 元サイズ取得
+        # デコードはこのスレッドで行い、リサイズ・JPEGエンコードをスレッドプールに投入
+        # （PillowのLanczosとlibjpegはGILを解放する）
+        jobs = []  # (name, objgen, original_size, log, future) をXObjectの順に
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+            for name, obj in xobjects.items():
+                if '/Subtype' in obj and obj['/Subtype'] == '/Image' and '/SMask' in obj:
+                    log = []
+                    future = None
+                    original_size = 0
                     try:
-                        original_size = len(bytes(obj.read_raw_bytes()))
-                    except:
-                        original_size = 0
-                    
-                    # ベース画像抽出
-                    base_img = pikepdf.PdfImage(obj).as_pil_image()
-                    if base_img.mode == 'CMYK':
-                        base_img = base_img.convert('RGB')
-                    elif base_img.mode != 'RGB':
-                        base_img = base_img.convert('RGB')
-                    
-                    # SMask抽出
-                    smask_obj = obj['/SMask']
-                    smask_img = pikepdf.PdfImage(smask_obj).as_pil_image()
-                    if smask_img.mode != 'L':
-                        smask_img = smask_img.convert('L')
-                    
-                    # サイズ合わせ
-                    if base_img.size != smask_img.size:
-                        smask_img = smask_img.resize(base_img.size, Image.Resampling.LANCZOS)
-                    
-                    # DPI最適化（解像度ダウン）
-                    original_width, original_height = base_img.size
-                    
-                    # 実効DPIを推定（ピクセル数ベース）
-                    # 一般的なPDFでは72 DPI基準で計算
-                    estimated_dpi = max(width, height) / 10  # 簡易推定
-                    dpi_threshold = image_dpi * 1.5
-                    
-                    if estimated_dpi > dpi_threshold:
-                        scale = image_dpi / estimated_dpi
-                        new_width = max(int(width * scale), 32)
-                        new_height = max(int(height * scale), 32)
-                        
-                        if verbose:
-                            print(f"      DPI最適化: {width}x{height} → {new_width}x{new_height}")
+                        width = int(obj['/Width'])
+                        height = int(obj['/Height'])
                         
-                        # 画像リサイズ
-                        base_img = base_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                        smask_img = smask_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    
-                    # 背景画像判定（PyMuPDF版のロジックを再実装）
-                    is_background = False
-                    if not preserve_background:
-                        # 簡易背景判定：大きい画像は背景の可能性が高い
-                        img_area = base_img.width * base_img.height
-                        if img_area > 1000000:  # 100万ピクセル以上は背景候補
-                            is_background = True
-                            if verbose:
-                                print(f"      背景画像判定: {base_img.width}x{base_img.height} ({img_area:,}px)")
-                    
-                    # JPEG品質調整と極端劣化
-                    current_quality = quality
-                    if is_background:
-                        current_quality = 1  # 背景画像は品質1
+                        log.append(f"    pikepdf処理: {name} ({width}x{height})")
                         
-                        # さらに極端な劣化：解像度を大幅に下げる
-                        ultra_width = max(base_img.width // 4, 32)
-                        ultra_height = max(base_img.height // 4, 32)
-                        base_img = base_img.resize((ultra_width, ultra_height), Image.Resampling.LANCZOS)
-                        smask_img = smask_img.resize((ultra_width, ultra_height), Image.Resampling.LANCZOS)
-                        
-                        if verbose:
-                            print(f"      背景画像: 超劣化適用 → {ultra_width}x{ultra_height}, JPEG品質1")
-                    
-                    # JPEGで保存
-                    jpeg_output = io.BytesIO()
-                    base_img.save(jpeg_output, format='JPEG', quality=current_quality, optimize=True)
-                    jpeg_data = jpeg_output.getvalue()
-                    
-                    # Alpha（SMask）をJPEGで保存
-                    alpha_rgb = Image.merge('RGB', (smask_img, smask_img, smask_img))
-                    alpha_output = io.BytesIO()
-                    alpha_rgb.save(alpha_output, format='JPEG', quality=current_quality, optimize=True)
-                    alpha_data = alpha_output.getvalue()
-                    
-                    # PDFオブジェクトを更新（正しい方法）
-                    try:
-                        # 新しいXObjectを作成
-                        new_img_obj = pdf.make_stream(jpeg_data)
-                        new_img_obj.Width = base_img.width
-                        new_img_obj.Height = base_img.height
-                        new_img_obj.Filter = pikepdf.Name.DCTDecode
-                        new_img_obj.ColorSpace = obj.ColorSpace  # 元のColorSpaceを保持
-                        new_img_obj.BitsPerComponent = obj.get('/BitsPerComponent', 8)
+                        # 元サイズ取得
+                        try:
+                            raw = bytes(obj.read_raw_bytes())
+                            original_size = len(raw)
+                        except:
+                            raw = None
+                            original_size = 0
                         
-                        # 新しいSMaskオブジェクトを作成
-                        new_smask_obj = pdf.make_stream(alpha_data)
-                        new_smask_obj.Width = smask_img.width
-                        new_smask_obj.Height = smask_img.height
-                        new_smask_obj.Filter = pikepdf.Name.DCTDecode
-                        new_smask_obj.ColorSpace = pikepdf.Name.DeviceGray
-                        new_smask_obj.BitsPerComponent = 8
+                        # ベース・SMaskとも既に目標品質以下のJPEGで、サイズも変わらないなら
+                        # 再圧縮しても劣化が重なるだけなので、デコードせずそのまま残す
+                        smask_obj = obj['/SMask']
+                        # 置き換えはベース+SMaskの組なので、SMaskのサイズも元サイズに含める
+                        try:
+                            original_size += len(bytes(smask_obj.read_raw_bytes()))
+                        except:
+                            pass
+                        if (smask_pair_keeps_size(width, height, image_dpi, preserve_background)
+                                and int(smask_obj.get('/Width', 0)) == width
+                                and int(smask_obj.get('/Height', 0)) == height):
+                            base_quality = raw_jpeg_quality(obj, raw)
+                            smask_quality = raw_jpeg_quality(smask_obj)
+                            if (base_quality is not None and smask_quality is not None
+                                    and max(base_quality, smask_quality) <= quality):
+                                log.append(f"      既にJPEG品質{max(base_quality, smask_quality)}以下: 再圧縮なし")
+                                jobs.append((str(name), obj.objgen, original_size, log, None))
+                                continue
                         
-                        # SMask参照を設定
-                        new_img_obj.SMask = new_smask_obj
+                        # ベース画像抽出
+                        base_img = pikepdf_image_to_pil(obj)
+                        if base_img.mode == 'CMYK':
+                            base_img = base_img.convert('RGB')
+                        elif base_img.mode != 'RGB':
+                            base_img = base_img.convert('RGB')
                         
-                        # Resources辞書で参照を更新
-                        xobjects[name] = new_img_obj
+                        # SMask抽出
+                        smask_img = pikepdf_image_to_pil(smask_obj)
+                        if smask_img.mode != 'L':
+                            smask_img = smask_img.convert('L')
                         
-                        if verbose:
-                            print(f"      XObject置換完了: {base_img.width}x{base_img.height}")
-                            
-                    except Exception as write_error:
-                        if verbose:
-                            print(f"      XObject置換エラー: {write_error}")
-                        # エラー時は処理をスキップ
-                        continue
+                        future = executor.submit(encode_smask_pair, base_img, smask_img, width, height,
+                                                 quality, image_dpi, preserve_background)
+                    except Exception as e:
+                        log.append(f"      画像処理エラー: {e}")
                     
-                    new_total_size = len(jpeg_data) + len(alpha_data)
-                    if original_size > 0:
-                        savings = original_size - new_total_size
-                        total_savings += savings
-                        if verbose:
-                            reduction = (savings / original_size) * 100
-                            print(f"      {len(jpeg_data):,}+{len(alpha_data):,}bytes, {reduction:.1f}%削減")
-                    
-                    processed_count += 1
-                    
-                except Exception as e:
-                    if verbose:
-                        print(f"      画像処理エラー: {e}")
-                    continue
+                    jobs.append((str(name), obj.objgen, original_size, log, future))
+    
+    results = []
+    for name, objgen, original_size, log, future in jobs:
+        result = None
+        if future is not None:
+            try:
+                size, jpeg_data, alpha_data, encode_log = future.result()
+                log.extend(encode_log)
+                result = (size, jpeg_data, alpha_data)
+            except Exception as e:
+                log.append(f"      画像処理エラー: {e}")
+        results.append((name, objgen, original_size, log, result))
+    return results
+
+
+# プロセスプールの各ワーカーが保持するPDFデータ（タスクごとにpickleして送らないため）
+_worker_pdf_data = None
+
+
+def _init_page_worker(pdf_data):
+    """ProcessPoolExecutorのinitializer：PDFデータをワーカーに一度だけ渡す"""
+    global _worker_pdf_data
+    _worker_pdf_data = pdf_data
+
+
+def _encode_page_in_worker(page_index, quality, image_dpi, preserve_background, max_workers):
+    """ワーカーが保持するPDFデータに対して encode_page_smask_images を実行"""
+    return encode_page_smask_images(_worker_pdf_data, page_index, quality, image_dpi,
+                                    preserve_background, max_workers)
+
+
+def jpeg_colorspace_for(obj):
+    """
+    RGBに変換してJPEG化した画像のColorSpace
+    元がRGBのICCBasedならそのまま使い、それ以外（CMYK、Indexedなど）はDeviceRGB
+    """
+    colorspace = obj.get('/ColorSpace')
+    if isinstance(colorspace, pikepdf.Array) and len(colorspace) == 2 and colorspace[0] == '/ICCBased':
+        if int(colorspace[1].get('/N', 0)) == 3:
+            return colorspace
+    return pikepdf.Name.DeviceRGB
+
+
+def apply_page_smask_images(pdf, page_index, results, replaced=None, verbose=True):
+    """
+    encode_page_smask_images の結果でページのXObjectを置き換える
+    （pikepdfのオブジェクト操作はスレッドセーフではないので、1つのプロセス・スレッドで順番に呼ぶ）
+    replaced: 元XObjectのobjgen → 新しいXObject。複数ページで共有される画像は一度だけ置き換える
+    
+    Returns:
+        processed_count (int): 置き換えた画像数
+        total_savings (int): 削減バイト数
+    """
+    if replaced is None:
+        replaced = {}
+    xobjects = pdf.pages[page_index]['/Resources']['/XObject']
+    processed_count = 0
+    total_savings = 0
+    
+    for name, objgen, original_size, log, result in results:
+        if objgen in replaced:
+            # 他のページで置換済み：同じ新XObjectを参照させる
+            xobjects[name] = replaced[objgen]
+            continue
         
-        # 保存（最大圧縮オプション）
-        pdf.save(pdf_path, 
-                 compress_streams=True,      # ストリーム再圧縮を有効
-                 recompress_flate=True,     # Flateストリーム再圧縮
-                 normalize_content=True,    # コンテンツストリーム最適化
-                 )
-        pdf.close()
+        if verbose:
+            for line in log:
+                print(line)
+        if result is None:
+            continue
+        (new_width, new_height), jpeg_data, alpha_data = result
+        
+        # 元の画像+SMaskより小さくならなければ置き換えない
+        new_total_size = len(jpeg_data) + len(alpha_data)
+        if original_size and new_total_size >= original_size:
+            if verbose:
+                print(f"      削減効果なし: {new_total_size:,} >= {original_size:,}bytes")
+            continue
+        
+        # PDFオブジェクトを更新（正しい方法）
+        try:
+            obj = xobjects[name]
+            
+            # 新しいXObjectを作成
+            new_img_obj = pdf.make_stream(jpeg_data)
+            new_img_obj.Type = pikepdf.Name.XObject
+            new_img_obj.Subtype = pikepdf.Name.Image
+            new_img_obj.Width = new_width
+            new_img_obj.Height = new_height
+            new_img_obj.Filter = pikepdf.Name.DCTDecode
+            new_img_obj.ColorSpace = jpeg_colorspace_for(obj)
+            new_img_obj.BitsPerComponent = 8
+            
+            # 新しいSMaskオブジェクトを作成（ベース画像と同じサイズ）
+            new_smask_obj = pdf.make_stream(alpha_data)
+            new_smask_obj.Type = pikepdf.Name.XObject
+            new_smask_obj.Subtype = pikepdf.Name.Image
+            new_smask_obj.Width = new_width
+            new_smask_obj.Height = new_height
+            new_smask_obj.Filter = pikepdf.Name.DCTDecode
+            new_smask_obj.ColorSpace = pikepdf.Name.DeviceGray
+            new_smask_obj.BitsPerComponent = 8
+            
+            # SMask参照を設定
+            new_img_obj.SMask = new_smask_obj
+            
+            # Resources辞書で参照を更新
+            xobjects[name] = new_img_obj
+            replaced[objgen] = new_img_obj
+            
+            if verbose:
+                print(f"      XObject置換完了: {new_width}x{new_height}")
+                
+        except Exception as write_error:
+            if verbose:
+                print(f"      XObject置換エラー: {write_error}")
+            # エラー時は処理をスキップ
+            continue
+        
+        if original_size > 0:
+            savings = original_size - new_total_size
+            total_savings += savings
+            if verbose:
+                reduction = (savings / original_size) * 100
+                print(f"      {len(jpeg_data):,}+{len(alpha_data):,}bytes, {reduction:.1f}%削減")
+        
+        processed_count += 1
+    
+    return processed_count, total_savings
+
+
+def save_pikepdf_result(pdf, pdf_path, recompress=False):
+    """
+    pikepdfで処理したPDFを保存
+    新しいストリームは圧縮し、既存ストリームの再圧縮・正規化は recompress 指定時のみ
+    （差し替えるのはDCTの画像だけなので通常は不要）
+    """
+    pdf.save(pdf_path, 
+             compress_streams=True,         # 未圧縮ストリームを圧縮
+             recompress_flate=recompress,   # Flateストリーム再圧縮
+             normalize_content=recompress,  # コンテンツストリーム最適化
+             )
+
+
+def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, image_dpi=150, preserve_background=False, verbose=True,
+                                            recompress=False):
+    """
+    pikepdfを使った完全なJPEG+SMask分離処理（1ページ分）
+    PyMuPDFの制限を回避してSMask参照を維持
+    recompress: 保存時に既存のFlateストリームとコンテンツストリームも再圧縮・正規化する
+    
+    Returns:
+        success (bool): 処理成功フラグ
+        processed_count (int): 処理した画像数
+        result_message (str): 結果メッセージ
+    """
+    if not PIKEPDF_AVAILABLE:
+        return False, 0, "pikepdf not available"
+        
+    try:
+        results = encode_page_smask_images(pdf_path, page_index, quality, image_dpi, preserve_background)
+        if results is None:
+            return False, 0, "No images found"
+        
+        with pikepdf.Pdf.open(pdf_path, allow_overwriting_input=True) as pdf:
+            processed_count, total_savings = apply_page_smask_images(pdf, page_index, results, verbose=verbose)
+            save_pikepdf_result(pdf, pdf_path, recompress)
         
         return True, processed_count, f"pikepdf: {processed_count}個処理, {total_savings:,}bytes削減"
         
     except Exception as e:
-        if 'pdf' in locals():
-            pdf.close()
         return False, 0, f"pikepdf処理エラー: {e}"
 
 
-def complete_jpeg_smask_separation(doc, page, xref, img, quality=70, grayscale=False, verbose=True):
+def encode_rgba_as_jpeg_pair(img, quality=70, grayscale=False):
+    """
+    RGBA/LA画像をベース(RGB/L)とアルファ(L)に分け、それぞれJPEGにエンコード
+    docに触れないのでスレッドプールから呼び出せる（Pillowのエンコード中はGILが解放される）
+    
+    Returns:
+        (size, colorspace, jpeg_data, alpha_data)
+    """
+    # RGBA分離
+    rgb_img, alpha_img = split_alpha(img)
+        
+    # グレースケール変換
+    if grayscale:
+        rgb_img = rgb_img.convert('L')
+        
+    # RGB部分をJPEGで保存
+    jpeg_data = encode_jpeg(rgb_img, quality)
+    
+    # Alpha部分もJPEGで保存（グレースケール、品質は alpha_jpeg_quality で下げる）
+    alpha_data = encode_jpeg(alpha_img, alpha_jpeg_quality(quality))
+    
+    colorspace = '/DeviceGray' if rgb_img.mode == 'L' else '/DeviceRGB'
+    return rgb_img.size, colorspace, jpeg_data, alpha_data
+
+
+def write_jpeg_smask_pair(doc, xref, smask_xref, size, colorspace, jpeg_data, alpha_data):
+    """
+    エンコード済みのJPEGとSMaskをxrefに書き込む（docを変更するのでメインスレッドで呼ぶ）
+    ストリームを直接差し替え、辞書は1回で書き換える
+    （replace_imageは新規オブジェクトを作ってコピーするうえSMask参照を落とす）
+    """
+    width, height = size
+    doc.update_stream(xref, jpeg_data, compress=False)
+    doc.update_object(xref, (
+        f"<</Type/XObject/Subtype/Image/Width {width}/Height {height}"
+        f"/ColorSpace{colorspace}/BitsPerComponent 8/Filter/DCTDecode"
+        f"/SMask {smask_xref} 0 R/Length {len(jpeg_data)}>>"
+    ))
+    
+    # SMaskも同様にJPEG（グレースケール）で差し替え
+    doc.update_stream(smask_xref, alpha_data, compress=False)
+    doc.update_object(smask_xref, (
+        f"<</Type/XObject/Subtype/Image/Width {width}/Height {height}"
+        f"/ColorSpace/DeviceGray/BitsPerComponent 8/Filter/DCTDecode"
+        f"/Length {len(alpha_data)}>>"
+    ))
+
+
+def write_flate_image(doc, xref, size, colorspace, flate_data):
+    """
+    エンコード済みのFlate画像（/Indexed など）をxrefに書き込む（docを変更するのでメインスレッドで呼ぶ）
+    write_jpeg_smask_pair と同様に辞書は1回で書き換える（SMask参照は外れる）
+    """
+    width, height = size
+    doc.update_stream(xref, flate_data, compress=False)
+    doc.update_object(xref, (
+        f"<</Type/XObject/Subtype/Image/Width {width}/Height {height}"
+        f"/ColorSpace{colorspace}/BitsPerComponent 8/Filter/FlateDecode"
+        f"/Length {len(flate_data)}>>"
+    ))
+
+
+def complete_jpeg_smask_separation(doc, page, xref, img, quality=70, grayscale=False, verbose=True, cache=None):
     """
     完全なJPEG+SMask分離処理 - PNG膨張問題を根本的に解決
     JPEG画像とSMaskの両方をJPEG形式で保存
@@ -284,62 +964,25 @@ def complete_jpeg_smask_separation(doc, page, xref, img, quality=70, grayscale=F
             return False, "Not RGBA/LA image"
             
         # SMask参照を取得
-        smask_ref = doc.xref_get_key(xref, "SMask")
+        smask_ref = cached_smask_ref(doc, xref, cache)
         if not smask_ref or smask_ref in [None, 'null', ('null', 'null')]:
             return False, "No SMask found"
             
         # SMask xrefを抽出
         smask_xref = None
         if isinstance(smask_ref, tuple) and len(smask_ref) >= 2:
-            smask_str = smask_ref[1]
-            if ' 0 R' in smask_str:
-                smask_xref = int(smask_str.split(' 0 R')[0])
+            match = SMASK_REF_RE.match(smask_ref[1])
+            if match:
+                smask_xref = int(match.group(1))
                 
         if not smask_xref:
             return False, "Invalid SMask xref"
             
-        # RGBA分離
-        if img.mode == 'RGBA':
-            r, g, b, a = img.split()
-            rgb_img = Image.merge('RGB', (r, g, b))
-            alpha_img = a
-        elif img.mode == 'LA':
-            l, a = img.split()
-            rgb_img = Image.merge('RGB', (l, l, l))
-            alpha_img = a
-            
-        # グレースケール変換
-        if grayscale:
-            rgb_img = rgb_img.convert('L')
-            
-        # 1. RGB部分をJPEGで保存
-        jpeg_output = io.BytesIO()
-        if grayscale and rgb_img.mode == 'L':
-            rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True)
-        else:
-            rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True, progressive=True)
-        new_jpeg_data = jpeg_output.getvalue()
-        
-        # 2. Alpha部分もJPEGで保存（グレースケール）
-        alpha_rgb = Image.merge('RGB', (alpha_img, alpha_img, alpha_img))
-        alpha_jpeg_output = io.BytesIO()
-        alpha_rgb.save(alpha_jpeg_output, format='JPEG', quality=quality, optimize=True)
-        new_alpha_data = alpha_jpeg_output.getvalue()
-        
-        # 3. 元画像をJPEGで置換
-        page.replace_image(xref, stream=new_jpeg_data)
-        
-        # 4. SMaskをJPEGで置換
-        page.replace_image(smask_xref, stream=new_alpha_data)
+        # 1. RGB部分とAlpha部分をそれぞれJPEGにエンコード（docには触れない）
+        size, colorspace, new_jpeg_data, new_alpha_data = encode_rgba_as_jpeg_pair(img, quality, grayscale)
         
-        # 5. オブジェクト属性を更新（サイズのみ、SMask参照は保持）
-        doc.xref_set_key(xref, "Width", str(rgb_img.width))
-        doc.xref_set_key(xref, "Height", str(rgb_img.height))
-        # SMask参照を再設定（重要！）
-        doc.xref_set_key(xref, "SMask", smask_ref)
-        
-        doc.xref_set_key(smask_xref, "Width", str(alpha_img.width))
-        doc.xref_set_key(smask_xref, "Height", str(alpha_img.height))
+        # 2. ストリームと辞書を書き換え
+        write_jpeg_smask_pair(doc, xref, smask_xref, size, colorspace, new_jpeg_data, new_alpha_data)
         
         if verbose:
             print(f"        完全JPEG分離: RGB {len(new_jpeg_data):,}b + Alpha {len(new_alpha_data):,}b")
@@ -361,27 +1004,15 @@ def save_as_jpeg_smask_separated(img, quality=70, grayscale=False, verbose=True)
         if img.mode not in ('RGBA', 'LA'):
             return False, None, None
             
-        # RGB部分とアルファ部分を分離
-        if img.mode == 'RGBA':
-            r, g, b, a = img.split()
-            rgb_img = Image.merge('RGB', (r, g, b))
-            alpha_img = a
-        elif img.mode == 'LA':
-            l, a = img.split()
-            rgb_img = Image.merge('RGB', (l, l, l))  # グレースケールをRGBに
-            alpha_img = a
+        # RGB部分とアルファ部分を分離（LAのグレースケールはRGBに）
+        rgb_img, alpha_img = split_alpha(img)
         
         # グレースケール変換
         if grayscale:
             rgb_img = rgb_img.convert('L')
             
         # JPEG部分の保存
-        jpeg_output = io.BytesIO()
-        if grayscale and rgb_img.mode == 'L':
-            rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True)
-        else:
-            rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True, progressive=True)
-        jpeg_data = jpeg_output.getvalue()
+        jpeg_data = encode_jpeg(rgb_img, quality)
         
         # SMask部分の保存（グレースケールPNG、最大圧縮）
         smask_output = io.BytesIO()
@@ -399,32 +1030,34 @@ def save_as_jpeg_smask_separated(img, quality=70, grayscale=False, verbose=True)
         return False, None, None
 
 
-def combine_jpeg_with_smask(doc, img_dict, xref):
-    """JPEG画像とSMaskを合成してRGBA画像を作成"""
+def combine_jpeg_with_smask(doc, img_dict, xref, cache=None):
+    """JPEG画像とSMaskを合成してRGBA画像を作成（cacheがあれば抽出結果を共有）"""
     try:
-        jpeg_img = Image.open(io.BytesIO(img_dict['image']))
+        if cache is not None:
+            jpeg_img = cached_open_image(doc, xref, cache)
+        else:
+            jpeg_img = Image.open(io.BytesIO(img_dict['image']))
         
         # SMask取得
-        smask_ref = doc.xref_get_key(xref, "SMask")
+        smask_ref = cached_smask_ref(doc, xref, cache)
         if not smask_ref or smask_ref in [None, 'null', ('null', 'null')]:
             return jpeg_img
         
-        smask_img = extract_smask_data(doc, smask_ref)
+        smask_img = cached_smask_data(doc, xref, smask_ref, cache)
         if smask_img:
-            # RGBをRGBAに変換
-            if jpeg_img.mode != 'RGB':
-                jpeg_img = jpeg_img.convert('RGB')
+            # RGBAに変換（元のアルファがあってもSMaskで置き換える）
+            rgba_img = jpeg_img.convert('RGBA')
             
             # SMaskをアルファチャンネルとしてサイズ調整
-            if smask_img.size != jpeg_img.size:
-                smask_img = smask_img.resize(jpeg_img.size, Image.Resampling.LANCZOS)
+            if smask_img.size != rgba_img.size:
+                smask_img = resize_smask(smask_img, rgba_img.size)
             
             # グレースケールのSMaskをアルファチャンネルとして使用
             if smask_img.mode != 'L':
                 smask_img = smask_img.convert('L')
             
-            # RGBA画像を作成
-            rgba_img = Image.merge('RGBA', (*jpeg_img.split(), smask_img))
+            # アルファを直接設定（split/mergeによるチャンネルごとのコピーを省く）
+            rgba_img.putalpha(smask_img)
             return rgba_img
         
         return jpeg_img
@@ -433,23 +1066,16 @@ def combine_jpeg_with_smask(doc, img_dict, xref):
         return Image.open(io.BytesIO(img_dict['image']))
 
 
+# 品質レベル（0-30）ごとの色数（pngquantの品質設定に対応）
+PNG_QUALITY_COLORS = (16,) * 6 + (32,) * 5 + (64,) * 5 + (128,) * 5 + (192,) * 5 + (256,) * 5
+
+
 def png_quality_to_colors(quality):
     """
     品質レベル（0-30）をPILの色数にマッピング
-    pngquantの品質設定に対応
-    """
-    if quality <= 5:
-        return 16   # 最低品質
-    elif quality <= 10:
-        return 32
-    elif quality <= 15:
-        return 64
-    elif quality <= 20:
-        return 128
-    elif quality <= 25:
-        return 192
-    else:  # 26-30
-        return 256  # 最高品質
+    pngquantの品質設定に対応（範囲外の値は0-30に丸める）
+    """
+    return PNG_QUALITY_COLORS[max(0, min(30, quality))]
 
 
 def optimize_png_with_quantization(img, png_quality=20, verbose=True):
@@ -462,17 +1088,21 @@ def optimize_png_with_quantization(img, png_quality=20, verbose=True):
     colors = png_quality_to_colors(png_quality)
     
     try:
-        # RGBAの場合はFast Octreeを使用
-        if img.mode == 'RGBA':
-            quantized = img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
-            result = quantized.convert('RGBA')
-        elif img.mode == 'LA':
-            # LAの場合はRGBAに変換してから処理
-            rgba_img = img.convert('RGBA')
-            quantized = rgba_img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+        # アルファを使っていなければRGBだけを量子化（アルファ付きパレットは不要）
+        if img.getchannel('A').getextrema() == (255, 255):
+            return img.convert('RGB').quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+        
+        # 量子化はRGBAで行う（LAはRGBAに変換）
+        rgba_img = img if img.mode == 'RGBA' else img.convert('RGBA')
+        try:
+            # libimagequant はアルファ付きパレットを直接生成できる
+            result = rgba_img.quantize(colors=colors, method=Image.Quantize.LIBIMAGEQUANT,
+                                       dither=Image.Dither.FLOYDSTEINBERG)
+        except ValueError:
+            # libimagequant 非対応のPillowビルドではFast Octreeで代替
+            quantized = rgba_img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE,
+                                          dither=Image.Dither.FLOYDSTEINBERG)
             result = quantized.convert('RGBA')
-        else:
-            result = img
             
         if verbose:
             print(f"        色数削減: {colors}色")
@@ -484,20 +1114,32 @@ def optimize_png_with_quantization(img, png_quality=20, verbose=True):
         return img
 
 
-def has_actual_transparency(doc, xref, verbose=False):
+def has_actual_transparency(doc, xref, verbose=False, cache=None):
     """
     画像が実質的に透明度を使っているかチェック
     SMaskがあっても、全体が不透明（アルファ値255）なら透明度なしと判定
     """
     try:
         # SMaskの確認
-        smask_ref = doc.xref_get_key(xref, "SMask")
+        smask_ref = cached_smask_ref(doc, xref, cache)
         if not smask_ref or smask_ref in [None, 'null', ('null', 'null')]:
             # SMaskなし
             return False
             
+        # 8bitのFlateストリームなら画像としてデコードせずにアルファの最小値だけを調べる
+        alpha_min = cached_smask_min(doc, xref, smask_ref, cache)
+        if alpha_min is not None:
+            # アルファの最小値が 250 以上なら、ほぼ不透明と判定
+            has_transparency = alpha_min < 250
+            if verbose:
+                if has_transparency:
+                    print(f"        実質的な透明度あり (alpha {alpha_min} を検出)")
+                else:
+                    print(f"        実質的な透明度なし (alpha最小値: {alpha_min})")
+            return has_transparency
+        
         # SMaskデータを抽出
-        smask_img = extract_smask_data(doc, smask_ref)
+        smask_img = cached_smask_data(doc, xref, smask_ref, cache)
         if not smask_img:
             return False
             
@@ -505,14 +1147,12 @@ def has_actual_transparency(doc, xref, verbose=False):
         if smask_img.mode != 'L':
             smask_img = smask_img.convert('L')
             
-        # アルファ値の最小値と最大値を取得
-        alpha_min, alpha_max = smask_img.getextrema()
-        
         # 実質的に透明度があるかの判定
-        # alpha_min が 250 以上なら、ほぼ不透明と判定
-        has_transparency = alpha_min < 250
+        # アルファの最小値が 250 以上なら、ほぼ不透明と判定
+        has_transparency = alpha_below(smask_img, 250)
         
         if verbose:
+            alpha_min, alpha_max = smask_img.getextrema()
             if has_transparency:
                 print(f"        実質的な透明度あり (alpha: {alpha_min}-{alpha_max})")
             else:
@@ -526,7 +1166,7 @@ def has_actual_transparency(doc, xref, verbose=False):
         return False
 
 
-def is_background_image(page, img_info, xref, doc, verbose=False):
+def is_background_image(page, img_info, xref, doc, verbose=False, cache=None):
     """
     背景画像かどうかを判定
     - ページの90%以上を覆う
@@ -534,7 +1174,7 @@ def is_background_image(page, img_info, xref, doc, verbose=False):
     """
     try:
         # 画像の表示領域を取得
-        img_rects = page.get_image_rects(img_info)
+        img_rects = cached_image_rects(page, img_info, cache)
         if not img_rects:
             return False
             
@@ -555,22 +1195,17 @@ def is_background_image(page, img_info, xref, doc, verbose=False):
             return False
             
         # 実質的な透明度チェック
-        if has_actual_transparency(doc, xref, verbose):
+        if has_actual_transparency(doc, xref, verbose, cache):
             return False
             
         # 画像形式チェック（PNG/GIFなどの透明度チェック）
-        img_dict = doc.extract_image(xref)
-        if img_dict:
-            img = Image.open(io.BytesIO(img_dict['image']))
+        img = cached_open_image(doc, xref, cache)
+        if img:
             if img.mode in ('RGBA', 'LA'):
                 # RGBAやLAでも実際の透明度をチェック
-                if img.mode == 'RGBA':
-                    alpha = img.split()[3]
-                elif img.mode == 'LA':
-                    alpha = img.split()[1]
+                alpha = img.getchannel('A')
                     
-                alpha_min, alpha_max = alpha.getextrema()
-                if alpha_min < 250:  # 実質的な透明度あり
+                if alpha_below(alpha, 250):  # 実質的な透明度あり
                     return False
                     
             elif 'transparency' in img.info:
@@ -597,12 +1232,11 @@ def apply_extreme_degradation(img, verbose=False):
         # ガウシアンぼかしを最大適用
         from PIL import ImageFilter
         
-        # 複数回ぼかしを適用して効果を強める
-        for _ in range(3):
-            img = img.filter(ImageFilter.GaussianBlur(radius=5))
+        # radius=5 を3回かけるのと同じぼかし（分散は加算されるので半径は√3倍）を1回で適用
+        img = img.filter(ImageFilter.GaussianBlur(radius=BACKGROUND_BLUR_RADIUS))
         
         if verbose:
-            print(f"        ぼかし適用: ガウシアンブラー x3 (radius=5)")
+            print(f"        ぼかし適用: ガウシアンブラー (radius={BACKGROUND_BLUR_RADIUS:.2f})")
             
         return img
         
@@ -612,18 +1246,126 @@ def apply_extreme_degradation(img, verbose=False):
         return img
 
 
-def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=150, quality=70, 
+def cached_image_rects(page, img_info, cache=None):
+    """page.get_image_rects の結果をキャッシュ"""
+    if cache is None:
+        return page.get_image_rects(img_info)
+    key = ('rects', img_info[0])
+    if key not in cache:
+        cache[key] = page.get_image_rects(img_info)
+    return cache[key]
+
+
+def calculate_display_dpi(page, img_info, width, height, cache=None):
+    """ページ上の表示サイズから実効DPIを算出（取得できなければ150）"""
+    actual_dpi = 150
+    try:
+        img_rects = cached_image_rects(page, img_info, cache)
+        if img_rects and len(img_rects) > 0:
+            rect = img_rects[0]
+            if rect.width > 0 and rect.height > 0:
+                dpi_x = width / (rect.width / 72)
+                dpi_y = height / (rect.height / 72)
+                actual_dpi = max(dpi_x, dpi_y)
+    except:
+        pass
+    return actual_dpi
+
+
+def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=150, quality=70,
                                           grayscale=False, png_quality=20, preserve_background=False, verbose=True):
     """
     Process image while preserving SMask relationship.
     """
+    job = prepare_image_job(doc, page, img_info, xref, image_dpi, quality, grayscale, png_quality,
+                            preserve_background, verbose)
+    if not isinstance(job, dict):
+        return job
+    return finish_image_job(doc, page, job, lambda: encode_image_job(job))
+
+
+def process_images_threaded(doc, all_images, image_dpi=150, quality=70, grayscale=False, png_quality=20,
+                            preserve_background=False, verbose=True, max_workers=None):
+    """
+    all_images の各画像を process_image_with_smask_preservation と同じ手順で処理し、結果を順に返す
+    PyMuPDFの読み書き（前段・後段）はこのスレッドで、エンコード（中段）はスレッドプールで行う。
+    デコード済みの画像を溜め込まないよう、先行させるジョブはワーカー数の2倍までにする。
+
+    Yields:
+        (success, original_size, new_size, message)
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    
+    # 前段が後続の画像を先読みしても結果が変わらないよう、表示位置は置換前にまとめて取得する
+    # （置換後のページでは他の画像の表示位置が正しく取れないことがある）
+    caches = {}
+    for xref, (page, img_info) in all_images.items():
+        caches[xref] = {}
+        try:
+            cached_image_rects(page, img_info, caches[xref])
+        except Exception:
+            pass
+    
+    pending = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for xref, (page, img_info) in all_images.items():
+            job = prepare_image_job(doc, page, img_info, xref, image_dpi, quality, grayscale, png_quality,
+                                    preserve_background, verbose, caches.pop(xref))
+            # 処理不要な画像（jobが結果タプル）も順番を保つため同じキューに入れる
+            future = executor.submit(encode_image_job, job) if isinstance(job, dict) else None
+            pending.append((page, job, future))
+            while pending and (len(pending) > max_workers * 2 or pending[0][2] is None):
+                page, job, future = pending.pop(0)
+                yield job if future is None else finish_image_job(doc, page, job, future.result)
+        for page, job, future in pending:
+            yield job if future is None else finish_image_job(doc, page, job, future.result)
+
+
+def finish_image_job(doc, page, job, encode):
+    """encode() でエンコード結果（スレッドなら future.result）を受け取り、PDFに反映する"""
+    try:
+        encoded = encode()
+    except Exception as e:
+        return False, job['original_size'], job['original_size'], f"Processing error: {e}"
+    return apply_image_job(doc, page, job, encoded)
+
+
+def prepare_image_job(doc, page, img_info, xref, image_dpi=150, quality=70,
+                      grayscale=False, png_quality=20, preserve_background=False, verbose=True, cache=None):
+    """
+    process_image_with_smask_preservation の前段（PyMuPDFの読み取りはすべてここで行う）
+    
+    Returns:
+        処理不要な場合は結果タプル (success, original_size, new_size, message)、
+        処理する場合は encode_image_job / apply_image_job に渡すジョブ(dict)
+    """
+    # Extraction results shared by the checks below; only valid until the image is replaced
+    if cache is None:
+        cache = {}
     try:
+        # 辞書の Width/Height だけで判定できるものはデコード前に除外
+        try:
+            meta_width = int(doc.xref_get_key(xref, "Width")[1])
+            meta_height = int(doc.xref_get_key(xref, "Height")[1])
+        except (ValueError, TypeError):
+            meta_width = meta_height = None
+        
+        if meta_width is not None:
+            if meta_width < 50 or meta_height < 50:
+                return False, 0, 0, f"Too small metadata: {meta_width}x{meta_height}"
+            
+            actual_dpi = calculate_display_dpi(page, img_info, meta_width, meta_height, cache)
+            if quality >= 85 and actual_dpi <= image_dpi * 1.5:
+                if verbose:
+                    print(f"      Image {xref}: {meta_width}x{meta_height} @ {actual_dpi:.0f} DPI - optimal")
+                return False, 0, 0, "Already optimal"
+        
         # Check transparency
-        preserve, reason = should_preserve_transparency(doc, xref, verbose)
+        preserve, reason = should_preserve_transparency(doc, xref, verbose, cache)
         
         if preserve:
             try:
-                img_dict = doc.extract_image(xref)
+                img_dict = cached_extract_image(doc, xref, cache)
                 if img_dict:
                     return False, len(img_dict["image"]), len(img_dict["image"]), f"Preserved: {reason}"
             except:
@@ -631,7 +1373,7 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
             return False, 0, 0, f"Preserved: {reason}"
         
         # Extract image
-        img_dict = doc.extract_image(xref)
+        img_dict = cached_extract_image(doc, xref, cache)
         if not img_dict:
             return False, 0, 0, "No data"
         
@@ -645,17 +1387,7 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
             return False, original_size, original_size, f"Too small: {width}x{height}"
         
         # Calculate DPI
-        actual_dpi = 150
-        try:
-            img_rects = page.get_image_rects(img_info)
-            if img_rects and len(img_rects) > 0:
-                rect = img_rects[0]
-                if rect.width > 0 and rect.height > 0:
-                    dpi_x = width / (rect.width / 72)
-                    dpi_y = height / (rect.height / 72)
-                    actual_dpi = max(dpi_x, dpi_y)
-        except:
-            pass
+        actual_dpi = calculate_display_dpi(page, img_info, width, height, cache)
         
         dpi_threshold = image_dpi * 1.5
         needs_processing = (actual_dpi > dpi_threshold) or (quality < 85 and original_size > 10240)
@@ -668,14 +1400,14 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
         # Check if this is a background image
         is_background = False
         if not preserve_background:
-            is_background = is_background_image(page, img_info, xref, doc, verbose)
+            is_background = is_background_image(page, img_info, xref, doc, verbose, cache)
         
         # Process image
         try:
             # Store SMask info BEFORE processing
             original_smask = None
             try:
-                original_smask = doc.xref_get_key(xref, "SMask")
+                original_smask = cached_smask_ref(doc, xref, cache)
                 if original_smask and original_smask in [None, 'null', ('null', 'null')]:
                     original_smask = None
             except:
@@ -684,191 +1416,268 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
             # Get original format
             img_format = img_dict.get('ext', 'unknown')
             
+            # 既に目標品質以下のJPEGで、リサイズもグレースケール化も不要なら再圧縮しない
+            # （再圧縮しても小さくならず劣化だけが重なる）。mozjpegがあればロスレス再最適化のみ行う
+            if (img_format == 'jpeg' and not original_smask and not is_background
+                    and actual_dpi <= dpi_threshold):
+                src_img = cached_open_image(doc, xref, cache)
+                src_quality = estimate_jpeg_quality(src_img)
+                if (src_quality is not None and src_quality <= quality
+                        and not (grayscale and src_img.mode != 'L')):
+                    if MOZJPEG_AVAILABLE and src_img.mode in ('L', 'RGB'):
+                        optimized = mozjpeg_lossless_optimization.optimize(img_data)
+                        if len(optimized) < original_size:
+                            doc.update_stream(xref, optimized, compress=False)
+                            doc.xref_set_key(xref, "Filter", "/DCTDecode")
+                            if verbose:
+                                print(f"      JPEG {xref}: q{src_quality} - lossless re-optimization only")
+                            return True, original_size, len(optimized), None
+                    return False, original_size, original_size, f"Already JPEG q{src_quality}"
+            
             # Process with PIL - combine with SMask if present
-            img = combine_jpeg_with_smask(doc, img_dict, xref)
+            img = combine_jpeg_with_smask(doc, img_dict, xref, cache)
             
-            # Background images get extreme treatment
-            if is_background:
-                # 32 DPI固定でリサイズ
-                background_dpi = 32
-                scale = background_dpi / actual_dpi
-                new_width = max(int(width * scale), 64)
-                new_height = max(int(height * scale), 64)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                if verbose:
-                    print(f"      背景画像リサイズ {xref}: {width}x{height} → {new_width}x{new_height} @ 32 DPI")
-                
-                # 最大ぼかし適用
-                img = apply_extreme_degradation(img, verbose)
-                
-            # Normal resize if needed
-            elif actual_dpi > dpi_threshold:
-                scale = image_dpi / actual_dpi
-                new_width = max(int(width * scale), 64)
-                new_height = max(int(height * scale), 64)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                if verbose:
-                    print(f"      Resizing {xref}: {width}x{height} @ {actual_dpi:.0f} DPI → {new_width}x{new_height} @ {image_dpi} DPI")
+            # Check if image has actual transparency
+            has_transparency = has_actual_transparency(doc, xref, verbose, cache)
             
-            # Determine output format and process accordingly
-            output = io.BytesIO()
-            saved_as_png = False
+        except Exception as e:
+            return False, original_size, original_size, f"Processing error: {e}"
+        
+        return {
+            'xref': xref, 'img': img, 'cache': cache,
+            'width': width, 'height': height, 'original_size': original_size,
+            'actual_dpi': actual_dpi, 'dpi_threshold': dpi_threshold,
+            'image_dpi': image_dpi, 'quality': quality, 'grayscale': grayscale,
+            'is_background': is_background, 'original_smask': original_smask,
+            'has_transparency': has_transparency, 'verbose': verbose,
+        }
             
-            # Check if image has actual transparency
-            has_transparency = has_actual_transparency(doc, xref, verbose)
+    except Exception as e:
+        return False, 0, 0, f"Error: {e}"
+
+
+def encode_image_job(job):
+    """
+    process_image_with_smask_preservation の中段：リサイズ・劣化・エンコード
+    PyMuPDFのオブジェクトには触れないのでスレッドで実行可能（Pillowはエンコード中GILを解放する）
+    
+    Returns:
+        dict: new_img_data / saved_as_png / colorspace / needs_transparency / separate / img / log
+    """
+    img = job['img']
+    xref, width, height = job['xref'], job['width'], job['height']
+    actual_dpi, dpi_threshold, image_dpi = job['actual_dpi'], job['dpi_threshold'], job['image_dpi']
+    quality, grayscale, verbose = job['quality'], job['grayscale'], job['verbose']
+    is_background, original_smask = job['is_background'], job['original_smask']
+    has_transparency = job['has_transparency']
+    log = []  # 詳細表示は apply_image_job でまとめて出力
+    separate = False
+    
+    # Background images get extreme treatment
+    if is_background:
+        # 32 DPI固定でリサイズ
+        background_dpi = 32
+        scale = background_dpi / actual_dpi
+        new_width = max(int(width * scale), 64)
+        new_height = max(int(height * scale), 64)
+        img = resize_lanczos(img, (new_width, new_height))
+        log.append(f"      背景画像リサイズ {xref}: {width}x{height} → {new_width}x{new_height} @ 32 DPI")
+        
+        # 最大ぼかし適用
+        img = apply_extreme_degradation(img, verbose)
+        
+    # Normal resize if needed
+    elif actual_dpi > dpi_threshold:
+        scale = image_dpi / actual_dpi
+        new_width = max(int(width * scale), 64)
+        new_height = max(int(height * scale), 64)
+        img = resize_lanczos(img, (new_width, new_height))
+        log.append(f"      Resizing {xref}: {width}x{height} @ {actual_dpi:.0f} DPI → {new_width}x{new_height} @ {image_dpi} DPI")
+    
+    # Determine output format and process accordingly
+    # (the encoded bytes are kept as-is; no intermediate buffer to copy into)
+    new_img_data = b''
+    saved_as_png = False
+    colorspace = None  # Indexed のFlateで保存する場合のみ設定（replace_imageを使わず直接書き込む）
+    
+    # Check mode-based transparency
+    mode_has_transparency = False
+    if img.mode in ('RGBA', 'LA'):
+        alpha = img.getchannel('A')
+        mode_has_transparency = alpha_below(alpha, 250)
+    elif 'transparency' in img.info:
+        mode_has_transparency = True
+        
+    # Determine if we really need transparency
+    needs_transparency = has_transparency or mode_has_transparency
+    
+    # Background images always become JPEG with quality 1
+    if is_background:
+        # Force RGB mode for JPEG
+        if img.mode != 'RGB':
+            if img.mode == 'RGBA':
+                img = composite_on_white(img)
+            else:
+                img = img.convert('RGB')
+        
+        # Save with ultimate compression
+        new_img_data = encode_jpeg(img, 1)
+        log.append(f"        背景画像: JPEG品質1で保存")
             
-            # Check mode-based transparency
-            mode_has_transparency = False
-            if img.mode in ('RGBA', 'LA'):
-                if img.mode == 'RGBA':
-                    alpha = img.split()[3]
-                else:
-                    alpha = img.split()[1]
-                alpha_min, alpha_max = alpha.getextrema()
-                mode_has_transparency = alpha_min < 250
-            elif 'transparency' in img.info:
-                mode_has_transparency = True
-                
-            # Determine if we really need transparency
-            needs_transparency = has_transparency or mode_has_transparency
+    # For images with ACTUAL transparency, use PNG with aggressive compression
+    elif needs_transparency:
+        # JPEG+SMask分離は現在無効化（SMask更新処理が未完成のため）
+        # TODO: JPEG+SMask完全分離処理の実装
+        
+        if True:  # 完全JPEG+SMask分離を有効化
+            # 完全JPEG+SMask分離はPDFを書き換えるため apply_image_job で行う
+            separate = True
+        else:
+            # 分離失敗時はPNGフォールバック（最小限に）
+            if img.mode == 'CMYK':
+                img = img.convert('RGB')
+            elif img.mode == 'P' and 'transparency' not in img.info:
+                img = img.convert('RGB')
             
-            # Background images always become JPEG with quality 1
-            if is_background:
-                # Force RGB mode for JPEG
-                if img.mode != 'RGB':
-                    if img.mode == 'RGBA':
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        background.paste(img, mask=img.split()[3])
-                        img = background
-                    else:
-                        img = img.convert('RGB')
-                
-                # Save with ultimate compression
-                img.save(output, format='JPEG', quality=1, optimize=True, progressive=True)
-                if verbose:
-                    print(f"        背景画像: JPEG品質1で保存")
-                    
-            # For images with ACTUAL transparency, use PNG with aggressive compression
-            elif needs_transparency:
-                # JPEG+SMask分離は現在無効化（SMask更新処理が未完成のため）
-                # TODO: JPEG+SMask完全分離処理の実装
-                
-                if True:  # 完全JPEG+SMask分離を有効化
-                    # 完全JPEG+SMask分離処理を実行
-                    success, result = complete_jpeg_smask_separation(
-                        doc, page, xref, img, quality, grayscale, verbose
-                    )
-                    
-                    if success:
-                        # 分離成功時は処理済み（replace_imageが内部で実行されている）
-                        return True, original_size, 0, "Complete JPEG+SMask separation"
+            if grayscale and img.mode not in ('LA', 'L'):
+                if img.mode == 'RGBA':
+                    # Convert RGBA to LA
+                    rgb = img.convert('RGB').convert('L')
+                    alpha = img.getchannel('A')
+                    img = Image.merge('LA', (rgb, alpha))
                 else:
-                    # 分離失敗時はPNGフォールバック（最小限に）
-                    if img.mode == 'CMYK':
-                        img = img.convert('RGB')
-                    elif img.mode == 'P' and 'transparency' not in img.info:
-                        img = img.convert('RGB')
-                    
-                    if grayscale and img.mode not in ('LA', 'L'):
-                        if img.mode == 'RGBA':
-                            # Convert RGBA to LA
-                            rgb = img.convert('RGB').convert('L')
-                            alpha = img.split()[3]
-                            img = Image.merge('LA', (rgb, alpha))
-                        else:
-                            img = img.convert('L')
-                    
-                    # PNG色数削減適用（極限設定）
-                    img = optimize_png_with_quantization(img, 1, verbose)  # 品質1で最小化
-                    
-                    # Save as PNG with compression
-                    img.save(output, format='PNG', optimize=True, compress_level=9)
-                    saved_as_png = True
-                    if verbose:
-                        print(f"        PNG保存（極限圧縮、色数8）")
-                    
-            else:
-                # No transparency needed - convert to JPEG for ALL opaque images
-                if verbose:
-                    if original_smask:
-                        print(f"        実質透明度なし - JPEGに変換")
-                    else:
-                        print(f"        透明度なし - JPEGに変換")
-                        
-                # Force RGB mode for JPEG
-                if img.mode != 'RGB':
-                    if img.mode == 'RGBA':
-                        # RGBAの場合、アルファチャンネルを白背景で合成
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        background.paste(img, mask=img.split()[3])
-                        img = background
-                    elif img.mode == 'LA':
-                        # LAの場合も同様に処理
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        rgb_img = img.convert('RGB')
-                        background.paste(rgb_img, mask=img.split()[1])
-                        img = background
-                    elif img.mode in ('CMYK', 'P'):
-                        img = img.convert('RGB')
-                    elif img.mode == 'L':
-                        # グレースケールはそのまま使用可能
-                        pass
-                    else:
-                        img = img.convert('RGB')
-                
-                if grayscale and img.mode != 'L':
                     img = img.convert('L')
-                
-                # Save as JPEG with appropriate quality
-                img.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
-                if verbose:
-                    print(f"        JPEG保存: 品質{quality}")
             
+            # PNG色数削減適用（極限設定）
+            img = optimize_png_with_quantization(img, 1, verbose)  # 品質1で最小化
+            
+            # Save as PNG with compression
+            output = io.BytesIO()
+            img.save(output, format='PNG', optimize=True, compress_level=9)
             new_img_data = output.getvalue()
-            new_size = len(new_img_data)
+            saved_as_png = True
+            log.append(f"        PNG保存（極限圧縮、色数8）")
             
-            if new_size >= original_size * 0.95:
-                return False, original_size, original_size, "Not beneficial"
+    else:
+        # No transparency needed - convert to JPEG for ALL opaque images
+        if original_smask:
+            log.append(f"        実質透明度なし - JPEGに変換")
+        else:
+            log.append(f"        透明度なし - JPEGに変換")
+        
+        if img.mode == 'P' and not grayscale:
+            # パレット画像はRGBに展開せず、パレットのまま保存する
+            colorspace, new_img_data = encode_indexed_flate(img)
+            log.append(f"        Indexed保存（パレットのまま）")
             
-            # Replace image with SMask preservation
-            try:
+        # Force RGB mode for JPEG
+        elif img.mode != 'RGB':
+            if img.mode in ('RGBA', 'LA'):
+                # RGBA/LAの場合、アルファチャンネルを白背景で合成
+                img = composite_on_white(img)
+            elif img.mode in ('CMYK', 'P'):
+                img = img.convert('RGB')
+            elif img.mode == 'L':
+                # グレースケールはそのまま使用可能
+                pass
+            else:
+                img = img.convert('RGB')
+        
+        if colorspace is None:
+            if grayscale and img.mode != 'L':
+                img = img.convert('L')
+            
+            # Save as JPEG with appropriate quality
+            new_img_data = encode_jpeg(img, quality)
+            log.append(f"        JPEG保存: 品質{quality}")
+            
+            # 色数の少ない画像（文字・図版）はロスレスのIndexedの方が小さければそちらを使う
+            indexed = encode_indexed_if_few_colors(img)
+            if indexed is not None and len(indexed[1]) < len(new_img_data):
+                colorspace, new_img_data = indexed
+                log.append(f"        Indexed保存（色数が少ないためJPEGより小さい）")
+    
+    return {
+        'new_img_data': new_img_data, 'saved_as_png': saved_as_png, 'colorspace': colorspace,
+        'needs_transparency': needs_transparency, 'separate': separate,
+        'img': img, 'log': log,
+    }
+
+
+def apply_image_job(doc, page, job, encoded):
+    """
+    process_image_with_smask_preservation の後段：エンコード結果をPDFに反映（メインスレッドで実行）
+    """
+    xref, original_size, verbose = job['xref'], job['original_size'], job['verbose']
+    original_smask = job['original_smask']
+    new_img_data, saved_as_png = encoded['new_img_data'], encoded['saved_as_png']
+    needs_transparency, img = encoded['needs_transparency'], encoded['img']
+    if verbose:
+        for line in encoded['log']:
+            print(line)
+    
+    try:
+        if encoded['separate']:
+            # 完全JPEG+SMask分離処理を実行
+            success, result = complete_jpeg_smask_separation(
+                doc, page, xref, img, job['quality'], job['grayscale'], verbose, job['cache']
+            )
+            
+            if success:
+                # 分離成功時は処理済み（replace_imageが内部で実行されている）
+                return True, original_size, 0, "Complete JPEG+SMask separation"
+        
+        new_size = len(new_img_data)
+        
+        if new_size >= original_size * 0.95:
+            return False, original_size, original_size, "Not beneficial"
+        
+        # Replace image with SMask preservation
+        try:
+            if encoded['colorspace']:
+                # Indexed はPNGを経由せず直接書き込む（replace_imageだとRGBに展開される）
+                write_flate_image(doc, xref, img.size, encoded['colorspace'], new_img_data)
+            else:
                 page.replace_image(xref, stream=new_img_data)
-                
-                # Restore SMask if it existed and we're using JPEG format
-                if original_smask:
-                    # PNG images don't need SMask restoration as they have built-in transparency
-                    if saved_as_png:
-                        if verbose:
-                            print(f"        PNG format - SMask not needed")
-                    else:
-                        # For JPEG, try to restore SMask
-                        try:
-                            doc.xref_set_key(xref, "SMask", original_smask)
-                            if verbose:
-                                print(f"        SMask preserved")
-                        except Exception as smask_error:
-                            if verbose:
-                                print(f"        SMask restore failed: {smask_error}")
-                
-                # Verify success
-                replaced = doc.extract_image(xref)
-                if replaced and replaced['width'] == img.size[0]:
-                    reduction = (1 - new_size / original_size) * 100
+            
+            # Restore SMask if it existed and we're using JPEG format
+            if original_smask:
+                if not needs_transparency:
+                    # SMask is fully opaque: drop the reference instead of keeping an all-255 mask
+                    # (the orphaned SMask object is removed by garbage collection on save)
+                    doc.xref_set_key(xref, "SMask", "null")
                     if verbose:
-                        print(f"      Compressed {xref}: {original_size:,} → {new_size:,} bytes ({reduction:.1f}% reduction)")
-                    return True, original_size, new_size, None
-                    
-            except Exception as e:
+                        print(f"        Opaque SMask removed")
+                # PNG images don't need SMask restoration as they have built-in transparency
+                elif saved_as_png:
+                    if verbose:
+                        print(f"        PNG format - SMask not needed")
+                else:
+                    # For JPEG, try to restore SMask
+                    try:
+                        doc.xref_set_key(xref, "SMask", original_smask[1])
+                        if verbose:
+                            print(f"        SMask preserved")
+                    except Exception as smask_error:
+                        if verbose:
+                            print(f"        SMask restore failed: {smask_error}")
+            
+            # Verify success
+            replaced = doc.extract_image(xref)
+            if replaced and replaced['width'] == img.size[0]:
+                reduction = (1 - new_size / original_size) * 100
                 if verbose:
-                    print(f"        Replacement failed: {e}")
-                
-            return False, original_size, original_size, "Replacement failed"
+                    print(f"      Compressed {xref}: {original_size:,} → {new_size:,} bytes ({reduction:.1f}% reduction)")
+                return True, original_size, new_size, None
                 
         except Exception as e:
-            return False, original_size, original_size, f"Processing error: {e}"
+            if verbose:
+                print(f"        Replacement failed: {e}")
+            
+        return False, original_size, original_size, "Replacement failed"
             
     except Exception as e:
-        return False, 0, 0, f"Error: {e}"
+        return False, original_size, original_size, f"Processing error: {e}"
 
 
 def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, image_dpi=150, 
@@ -890,21 +1699,6 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
             print(f"Original size: {original_size:,} bytes")
             print(f"Level: {optimization_level}, DPI: {image_dpi}")
         
-        # Art box trimming
-        if trim_to_artbox:
-            trimmed = 0
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                try:
-                    artbox = page.artbox
-                    if artbox and artbox != page.rect:
-                        page.set_cropbox(artbox)
-                        trimmed += 1
-                except:
-                    pass
-            if verbose and trimmed > 0:
-                print(f"  Trimmed {trimmed} page(s)")
-        
         # Basic cleanup
         if optimization_level >= 1:
             try:
@@ -936,6 +1730,38 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
             except:
                 pass
         
+        # ページの走査は1回だけ：アートボックスと（PyMuPDFで処理する場合は）画像xrefを集め、
+        # トリミングは走査後にまとめて適用する
+        # （clean_pagesで未使用の画像がリソースから外れるため、画像の収集はscrubの後で行う）
+        collect_images = optimization_level >= 3 and not PIKEPDF_AVAILABLE
+        artboxes = []
+        all_images = {}
+        for page in doc:
+            if trim_to_artbox:
+                try:
+                    artbox = page.artbox
+                    if artbox and artbox != page.rect:
+                        artboxes.append((page, artbox))
+                except:
+                    pass
+            if collect_images:
+                for img in page.get_images():
+                    xref = img[0]
+                    if xref not in all_images:
+                        all_images[xref] = (page, img)
+        
+        # Art box trimming
+        if trim_to_artbox:
+            trimmed = 0
+            for page, artbox in artboxes:
+                try:
+                    page.set_cropbox(artbox)
+                    trimmed += 1
+                except:
+                    pass
+            if verbose and trimmed > 0:
+                print(f"  Trimmed {trimmed} page(s)")
+        
         # Image optimization
         if optimization_level >= 3:
             quality = 50 if optimization_level == 3 else 30
@@ -945,30 +1771,62 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
                 if verbose:
                     print(f"  pikepdf高度処理を実行中...")
                 
-                # 一旦保存してpikepdfで処理
-                temp_path = output_path + '.temp'
-                doc.save(temp_path, garbage=1, deflate=True)
+                # PyMuPDFの結果はメモリ上でpikepdfに渡し、出力ファイルへは最後に1回だけ書き込む
+                page_count = len(doc)
+                pdf_data = doc.tobytes(garbage=1, deflate=True)
                 doc.close()
                 
                 total_pikepdf_processed = 0
+                pikepdf_saved = False
                 
-                # 各ページをpikepdfで処理
-                for page_num in range(len(pymupdf.open(temp_path))):
-                    success, processed_count, result_msg = complete_jpeg_smask_separation_pikepdf(
-                        temp_path, page_num, quality, image_dpi, preserve_background, verbose
-                    )
-                    if success:
-                        total_pikepdf_processed += processed_count
-                        if verbose and processed_count > 0:
-                            print(f"    ページ{page_num+1}: {result_msg}")
+                # デコード・エンコードはページ単位でプロセスプールに分散し、
+                # 結果の反映と保存はこのプロセスで1回だけ行う
+                cpu_count = os.cpu_count() or 1
+                processes = max(1, min(cpu_count, page_count))
+                threads = max(1, cpu_count // processes)
+                try:
+                    with ProcessPoolExecutor(max_workers=processes, initializer=_init_page_worker,
+                                             initargs=(pdf_data,)) as executor:
+                        futures = [
+                            executor.submit(_encode_page_in_worker, page_num, quality,
+                                            image_dpi, preserve_background, threads)
+                            for page_num in range(page_count)
+                        ]
+                        
+                        with pikepdf.Pdf.open(io.BytesIO(pdf_data)) as pdf:
+                            replaced = {}  # 複数ページで共有される画像は一度だけ置換
+                            for page_num, future in enumerate(futures):
+                                try:
+                                    results = future.result()
+                                except Exception as e:
+                                    if verbose:
+                                        print(f"    ページ{page_num+1}: pikepdf処理エラー: {e}")
+                                    continue
+                                if not results:
+                                    continue
+                                
+                                processed_count, total_savings = apply_page_smask_images(
+                                    pdf, page_num, results, replaced, verbose
+                                )
+                                total_pikepdf_processed += processed_count
+                                if verbose and processed_count > 0:
+                                    print(f"    ページ{page_num+1}: pikepdf: {processed_count}個処理, {total_savings:,}bytes削減")
+                            
+                            save_pikepdf_result(pdf, output_path)
+                            pikepdf_saved = True
+                except Exception as e:
+                    if verbose:
+                        print(f"  pikepdf処理エラー: {e}")
+                
+                if not pikepdf_saved:
+                    # pikepdfで保存できなかった場合はPyMuPDFの結果をそのまま出力
+                    with open(output_path, 'wb') as f:
+                        f.write(pdf_data)
                 
                 if total_pikepdf_processed > 0:
                     if verbose:
                         print(f"  pikepdf処理完了: {total_pikepdf_processed}個のSMask画像を最適化")
                 
-                # 処理済みファイルを再オープン
-                doc = pymupdf.open(temp_path)
-                
                 # pikepdf処理を行った場合、PyMuPDF後処理はスキップ
                 if verbose:
                     print(f"  PyMuPDF後処理をスキップ（pikepdf処理済み）")
@@ -976,15 +1834,7 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
                 all_images = {}  # 空にしてPyMuPDF処理をスキップ
                 
             else:
-                # pikepdf非対応時は従来処理
-                all_images = {}
-                for page_num in range(len(doc)):
-                    page = doc[page_num]
-                    for img in page.get_images():
-                        xref = img[0]
-                        if xref not in all_images:
-                            all_images[xref] = (page, img)
-                
+                # pikepdf非対応時は従来処理（画像はトリミング前の走査で収集済み）
                 if verbose:
                     print(f"  Found {len(all_images)} image(s), quality: {quality}")
             
@@ -995,11 +1845,10 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
             total_orig = 0
             total_new = 0
             
-            for xref, (page, img) in all_images.items():
-                success, orig, new, msg = process_image_with_smask_preservation(
-                    doc, page, img, xref, image_dpi, quality, grayscale, png_quality, 
-                    preserve_background, verbose
-                )
+            # PyMuPDFの読み書きはこのスレッドで、エンコードはスレッドプールで並列に行う
+            for success, orig, new, msg in process_images_threaded(
+                    doc, all_images, image_dpi, quality, grayscale, png_quality,
+                    preserve_background, verbose):
                 
                 if success:
                     processed += 1
@@ -1020,17 +1869,8 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
                     print(f"  Skipped: {skipped} images")
             
             # 最終保存処理の判定
-            if PIKEPDF_AVAILABLE and 'temp_path' in locals() and os.path.exists(temp_path):
-                # pikepdf処理を行った場合：temp_pathが最新版
-                if verbose:
-                    print(f"  pikepdf処理版を最終出力として使用")
-                
-                doc.close()  # PyMuPDF docを閉じる
-                
-                # pikepdf処理済みファイルを最終出力にコピー
-                import shutil
-                shutil.move(temp_path, output_path)
-                
+            if PIKEPDF_AVAILABLE:
+                # pikepdf処理を行った場合：出力は保存済み
                 if verbose:
                     print(f"  pikepdf処理版を保存: {output_path}")
                     
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import os
+import re
 import sys
 import io
 from pathlib import Path
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageChops
 
 try:
     import fitz  # PyMuPDF
@@ -26,6 +29,46 @@ except ImportError:
     print("Warning: pikepdf is not available. Advanced SMask processing will be limited.")
     PIKEPDF_AVAILABLE = False
 
+# libjpeg-turboによるJPEGエンコード（任意、turbojpegの共有ライブラリも必要）
+# PyTurboJPEGはインスタンスごとにハンドルを持つので、1つを使い回す
+try:
+    from turbojpeg import TurboJPEG, TJPF_GRAY, TJPF_RGB, TJSAMP_GRAY, TJSAMP_420, TJFLAG_PROGRESSIVE
+    _TJ = TurboJPEG()
+    TURBOJPEG_AVAILABLE = True
+except (ImportError, OSError, RuntimeError):
+    TURBOJPEG_AVAILABLE = False
+
+# アルファ合成ループのJITコンパイル（任意）
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# mozjpegによるロスレス再最適化（任意、ハフマン表・プログレッシブ化のみで画質は変わらない）
+try:
+    import mozjpeg_lossless_optimization
+    MOZJPEG_AVAILABLE = True
+except ImportError:
+    MOZJPEG_AVAILABLE = False
+
+# プログレッシブJPEGにする最小画素数（理由は pdf_optimizer_simple_smask の同名定数を参照）
+PROGRESSIVE_MIN_PIXELS = 200_000
+
+# SMaskのJPEG品質の下げ幅と下限（pdf_optimizer_simple_smask と同じ値）
+ALPHA_QUALITY_DROP = 20
+ALPHA_MIN_QUALITY = 35
+
+# SMask参照 ('xref', '12 0 R') の文字列部分からオブジェクト番号を取る
+SMASK_REF_RE = re.compile(r'(\d+)\s+\d+\s+R')
+
+# ICCプロファイルによる色変換（任意、CMYK画像をRGBにする際に使用）
+try:
+    from PIL import ImageCms
+    IMAGECMS_AVAILABLE = True
+except ImportError:
+    IMAGECMS_AVAILABLE = False
+
 
 def should_preserve_transparency(doc, xref, verbose=False):
     """
@@ -45,10 +88,7 @@ def should_preserve_transparency(doc, xref, verbose=False):
                 img = Image.open(io.BytesIO(img_dict['image']))
                 
                 if img.mode in ('RGBA', 'LA'):
-                    if img.mode == 'RGBA':
-                        alpha = img.split()[3]
-                    else:
-                        alpha = img.split()[1]
+                    alpha = img.getchannel('A')
                     
                     alpha_min, alpha_max = alpha.getextrema()
                     
@@ -94,10 +134,68 @@ def extract_smask_data(doc, smask_ref):
     return None
 
 
-def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, image_dpi=150, preserve_background=False, verbose=True):
+@functools.lru_cache(maxsize=8)
+def _cmyk_to_srgb_transform(icc_data):
+    """CMYKのICCプロファイルからsRGBへの変換を作成（同じプロファイルは使い回す）"""
+    profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_data))
+    return ImageCms.buildTransform(profile, ImageCms.createProfile('sRGB'), 'CMYK', 'RGB')
+
+
+def cmyk_jpeg_to_rgb(img, colorspace):
+    """
+    CMYKのJPEGをRGBに変換
+    Adobe形式（APP14）のJPEGは値が反転して格納されているので戻してから、
+    ICCBasedならそのプロファイルでsRGBに変換する（使えなければ単純変換）
+    """
+    if 'adobe' in img.info:
+        img = ImageChops.invert(img)
+    if IMAGECMS_AVAILABLE and isinstance(colorspace, pikepdf.Array) and len(colorspace) == 2 \
+            and colorspace[0] == '/ICCBased':
+        try:
+            transform = _cmyk_to_srgb_transform(bytes(colorspace[1].read_bytes()))
+            return ImageCms.applyTransform(img, transform)
+        except Exception:
+            pass
+    return img.convert('RGB')
+
+
+def pikepdf_image_to_pil(obj):
+    """
+    pikepdfの画像XObjectをPIL画像に変換
+    DCTのCMYK画像はAdobeの反転とICCプロファイルを考慮してRGBにする
+    （as_pil_image() は反転を戻さず、SMaskも合成してしまう）。
+    それ以外は PdfImage.as_pil_image() に任せる。
+    """
+    if obj.get('/Filter') == pikepdf.Name.DCTDecode and '/Decode' not in obj:
+        try:
+            img = Image.open(io.BytesIO(bytes(obj.read_raw_bytes())))
+            if img.mode == 'CMYK':
+                return cmyk_jpeg_to_rgb(img, obj.get('/ColorSpace'))
+        except Exception:
+            pass
+    return pikepdf.PdfImage(obj).as_pil_image()
+
+
+def jpeg_colorspace_for(obj):
     """
-    pikepdfを使った完全なJPEG+SMask分離処理
+    RGBに変換してJPEG化した画像のColorSpace
+    元がRGBのICCBasedならそのまま使い、それ以外（CMYK、Indexedなど）はDeviceRGB
+    """
+    colorspace = obj.get('/ColorSpace')
+    if isinstance(colorspace, pikepdf.Array) and len(colorspace) == 2 and colorspace[0] == '/ICCBased':
+        if int(colorspace[1].get('/N', 0)) == 3:
+            return colorspace
+    return pikepdf.Name.DeviceRGB
+
+
+def complete_jpeg_smask_separation_pikepdf(pdf, page_index, quality=70, image_dpi=150, preserve_background=False, verbose=True,
+                                           replaced=None):
+    """
+    pikepdfを使った完全なJPEG+SMask分離処理（1ページ分）
     PyMuPDFの制限を回避してSMask参照を維持
+    pdf は開いたままの pikepdf.Pdf で、保存は呼び出し側が全ページの処理後に1回だけ行う
+    replaced: 元XObjectのobjgen → 置き換え後のXObject。文書全体で共有すれば、
+    複数の名前・ページから参照される画像は一度だけ処理・出力される
     
     Returns:
         success (bool): 処理成功フラグ
@@ -108,19 +206,24 @@ def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, ima
         return False, 0, "pikepdf not available"
         
     try:
-        pdf = pikepdf.Pdf.open(pdf_path)
         page = pdf.pages[page_index]
         
         if '/Resources' not in page or '/XObject' not in page['/Resources']:
-            pdf.close()
             return False, 0, "No images found"
             
+        if replaced is None:
+            replaced = {}
         xobjects = page['/Resources']['/XObject']
         processed_count = 0
         total_savings = 0
         
-        for name, obj in xobjects.items():
+        for name, obj in list(xobjects.items()):
             if '/Subtype' in obj and obj['/Subtype'] == '/Image' and '/SMask' in obj:
+                objgen = obj.objgen
+                if objgen in replaced:
+                    # 他の名前・ページで処理済み：同じXObjectを参照させる（削減量は数えない）
+                    xobjects[name] = replaced[objgen]
+                    continue
                 try:
                     width = int(obj['/Width'])
                     height = int(obj['/Height'])
@@ -135,7 +238,7 @@ def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, ima
                         original_size = 0
                     
                     # ベース画像抽出
-                    base_img = pikepdf.PdfImage(obj).as_pil_image()
+                    base_img = pikepdf_image_to_pil(obj)
                     if base_img.mode == 'CMYK':
                         base_img = base_img.convert('RGB')
                     elif base_img.mode != 'RGB':
@@ -149,7 +252,7 @@ def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, ima
                     
                     # サイズ合わせ
                     if base_img.size != smask_img.size:
-                        smask_img = smask_img.resize(base_img.size, Image.Resampling.LANCZOS)
+                        smask_img = resize_smask(smask_img, base_img.size)
                     
                     # DPI最適化（解像度ダウン）
                     original_width, original_height = base_img.size
@@ -168,8 +271,8 @@ def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, ima
                             print(f"      DPI最適化: {width}x{height} → {new_width}x{new_height}")
                         
                         # 画像リサイズ
-                        base_img = base_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                        smask_img = smask_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+                        base_img = smart_downscale(base_img, (new_width, new_height))
+                        smask_img = smart_downscale(smask_img, (new_width, new_height))
                     
                     # 背景画像判定（PyMuPDF版のロジックを再実装）
                     is_background = False
@@ -189,8 +292,8 @@ def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, ima
                         # さらに極端な劣化：解像度を大幅に下げる
                         ultra_width = max(base_img.width // 4, 32)
                         ultra_height = max(base_img.height // 4, 32)
-                        base_img = base_img.resize((ultra_width, ultra_height), Image.Resampling.LANCZOS)
-                        smask_img = smask_img.resize((ultra_width, ultra_height), Image.Resampling.LANCZOS)
+                        base_img = smart_downscale(base_img, (ultra_width, ultra_height))
+                        smask_img = smart_downscale(smask_img, (ultra_width, ultra_height))
                         
                         if verbose:
                             print(f"      背景画像: 超劣化適用 → {ultra_width}x{ultra_height}, JPEG品質1")
@@ -200,24 +303,39 @@ def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, ima
                     base_img.save(jpeg_output, format='JPEG', quality=current_quality, optimize=True)
                     jpeg_data = jpeg_output.getvalue()
                     
-                    # Alpha（SMask）をJPEGで保存
-                    alpha_rgb = Image.merge('RGB', (smask_img, smask_img, smask_img))
+                    # Alpha（SMask）をJPEGで保存（DeviceGrayとして書き込むので1チャンネルのまま）
                     alpha_output = io.BytesIO()
-                    alpha_rgb.save(alpha_output, format='JPEG', quality=current_quality, optimize=True)
+                    smask_img.save(alpha_output, format='JPEG', quality=alpha_jpeg_quality(current_quality),
+                                   optimize=True)
                     alpha_data = alpha_output.getvalue()
                     
+                    # 元の画像+SMaskより小さくならなければ置き換えない
+                    try:
+                        original_size += len(bytes(smask_obj.read_raw_bytes()))
+                    except:
+                        pass
+                    if original_size and len(jpeg_data) + len(alpha_data) >= original_size:
+                        if verbose:
+                            print(f"      削減効果なし: {len(jpeg_data) + len(alpha_data):,} >= {original_size:,}bytes")
+                        replaced[objgen] = obj
+                        continue
+                    
                     # PDFオブジェクトを更新（正しい方法）
                     try:
                         # 新しいXObjectを作成
                         new_img_obj = pdf.make_stream(jpeg_data)
+                        new_img_obj.Type = pikepdf.Name.XObject
+                        new_img_obj.Subtype = pikepdf.Name.Image
                         new_img_obj.Width = base_img.width
                         new_img_obj.Height = base_img.height
                         new_img_obj.Filter = pikepdf.Name.DCTDecode
-                        new_img_obj.ColorSpace = obj.ColorSpace  # 元のColorSpaceを保持
-                        new_img_obj.BitsPerComponent = obj.get('/BitsPerComponent', 8)
+                        new_img_obj.ColorSpace = jpeg_colorspace_for(obj)  # JPEGはRGBで書き出している
+                        new_img_obj.BitsPerComponent = 8
                         
                         # 新しいSMaskオブジェクトを作成
                         new_smask_obj = pdf.make_stream(alpha_data)
+                        new_smask_obj.Type = pikepdf.Name.XObject
+                        new_smask_obj.Subtype = pikepdf.Name.Image
                         new_smask_obj.Width = smask_img.width
                         new_smask_obj.Height = smask_img.height
                         new_smask_obj.Filter = pikepdf.Name.DCTDecode
@@ -229,6 +347,7 @@ def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, ima
                         
                         # Resources辞書で参照を更新
                         xobjects[name] = new_img_obj
+                        replaced[objgen] = new_img_obj
                         
                         if verbose:
                             print(f"      XObject置換完了: {base_img.width}x{base_img.height}")
@@ -254,19 +373,9 @@ def complete_jpeg_smask_separation_pikepdf(pdf_path, page_index, quality=70, ima
                         print(f"      画像処理エラー: {e}")
                     continue
         
-        # 保存（最大圧縮オプション）
-        pdf.save(pdf_path, 
-                 compress_streams=True,      # ストリーム再圧縮を有効
-                 recompress_flate=True,     # Flateストリーム再圧縮
-                 normalize_content=True,    # コンテンツストリーム最適化
-                 )
-        pdf.close()
-        
         return True, processed_count, f"pikepdf: {processed_count}個処理, {total_savings:,}bytes削減"
         
     except Exception as e:
-        if 'pdf' in locals():
-            pdf.close()
         return False, 0, f"pikepdf処理エラー: {e}"
 
 
@@ -291,40 +400,30 @@ def complete_jpeg_smask_separation(doc, page, xref, img, quality=70, grayscale=F
         # SMask xrefを抽出
         smask_xref = None
         if isinstance(smask_ref, tuple) and len(smask_ref) >= 2:
-            smask_str = smask_ref[1]
-            if ' 0 R' in smask_str:
-                smask_xref = int(smask_str.split(' 0 R')[0])
+            match = SMASK_REF_RE.match(smask_ref[1])
+            if match:
+                smask_xref = int(match.group(1))
                 
         if not smask_xref:
             return False, "Invalid SMask xref"
             
         # RGBA分離
         if img.mode == 'RGBA':
-            r, g, b, a = img.split()
-            rgb_img = Image.merge('RGB', (r, g, b))
-            alpha_img = a
+            rgb_img = img.convert('RGB')  # アルファを捨てるだけ（合成はしない）
+            alpha_img = img.getchannel('A')
         elif img.mode == 'LA':
-            l, a = img.split()
-            rgb_img = Image.merge('RGB', (l, l, l))
-            alpha_img = a
+            rgb_img = img.convert('RGB')
+            alpha_img = img.getchannel('A')
             
         # グレースケール変換
         if grayscale:
             rgb_img = rgb_img.convert('L')
             
-        # 1. RGB部分をJPEGで保存
-        jpeg_output = io.BytesIO()
-        if grayscale and rgb_img.mode == 'L':
-            rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True)
-        else:
-            rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True, progressive=True)
-        new_jpeg_data = jpeg_output.getvalue()
+        # 1. RGB部分をJPEGで保存（TurboJPEGがあればそちらでエンコード）
+        new_jpeg_data = encode_jpeg(rgb_img, quality)
         
-        # 2. Alpha部分もJPEGで保存（グレースケール）
-        alpha_rgb = Image.merge('RGB', (alpha_img, alpha_img, alpha_img))
-        alpha_jpeg_output = io.BytesIO()
-        alpha_rgb.save(alpha_jpeg_output, format='JPEG', quality=quality, optimize=True)
-        new_alpha_data = alpha_jpeg_output.getvalue()
+        # 2. Alpha部分もJPEGで保存（1成分のグレースケールJPEG、RGBに複製しない。品質はRGBより低め）
+        new_alpha_data = encode_jpeg(alpha_img, alpha_jpeg_quality(quality))
         
         # 3. 元画像をJPEGで置換
         page.replace_image(xref, stream=new_jpeg_data)
@@ -336,10 +435,11 @@ def complete_jpeg_smask_separation(doc, page, xref, img, quality=70, grayscale=F
         doc.xref_set_key(xref, "Width", str(rgb_img.width))
         doc.xref_set_key(xref, "Height", str(rgb_img.height))
         # SMask参照を再設定（重要！）
-        doc.xref_set_key(xref, "SMask", smask_ref)
+        doc.xref_set_key(xref, "SMask", smask_ref[1])
         
         doc.xref_set_key(smask_xref, "Width", str(alpha_img.width))
         doc.xref_set_key(smask_xref, "Height", str(alpha_img.height))
+        doc.xref_set_key(smask_xref, "ColorSpace", "/DeviceGray")
         
         if verbose:
             print(f"        完全JPEG分離: RGB {len(new_jpeg_data):,}b + Alpha {len(new_alpha_data):,}b")
@@ -363,25 +463,18 @@ def save_as_jpeg_smask_separated(img, quality=70, grayscale=False, verbose=True)
             
         # RGB部分とアルファ部分を分離
         if img.mode == 'RGBA':
-            r, g, b, a = img.split()
-            rgb_img = Image.merge('RGB', (r, g, b))
-            alpha_img = a
+            rgb_img = img.convert('RGB')
+            alpha_img = img.getchannel('A')
         elif img.mode == 'LA':
-            l, a = img.split()
-            rgb_img = Image.merge('RGB', (l, l, l))  # グレースケールをRGBに
-            alpha_img = a
+            rgb_img = img.convert('RGB')  # グレースケールをRGBに
+            alpha_img = img.getchannel('A')
         
         # グレースケール変換
         if grayscale:
             rgb_img = rgb_img.convert('L')
             
         # JPEG部分の保存
-        jpeg_output = io.BytesIO()
-        if grayscale and rgb_img.mode == 'L':
-            rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True)
-        else:
-            rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True, progressive=True)
-        jpeg_data = jpeg_output.getvalue()
+        jpeg_data = encode_jpeg(rgb_img, quality)
         
         # SMask部分の保存（グレースケールPNG、最大圧縮）
         smask_output = io.BytesIO()
@@ -417,7 +510,7 @@ def combine_jpeg_with_smask(doc, img_dict, xref):
             
             # SMaskをアルファチャンネルとしてサイズ調整
             if smask_img.size != jpeg_img.size:
-                smask_img = smask_img.resize(jpeg_img.size, Image.Resampling.LANCZOS)
+                smask_img = resize_smask(smask_img, jpeg_img.size)
             
             # グレースケールのSMaskをアルファチャンネルとして使用
             if smask_img.mode != 'L':
@@ -462,17 +555,19 @@ def optimize_png_with_quantization(img, png_quality=20, verbose=True):
     colors = png_quality_to_colors(png_quality)
     
     try:
-        # RGBAの場合はFast Octreeを使用
-        if img.mode == 'RGBA':
-            quantized = img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
-            result = quantized.convert('RGBA')
-        elif img.mode == 'LA':
-            # LAの場合はRGBAに変換してから処理
-            rgba_img = img.convert('RGBA')
+        # 全面不透明ならアルファを捨て、RGBで量子化したパレット画像を返す
+        if img.getchannel('A').getextrema() == (255, 255):
+            return img.convert('RGB').quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+        
+        # LAはRGBAに変換してから量子化
+        rgba_img = img if img.mode == 'RGBA' else img.convert('RGBA')
+        try:
+            # Pillowがlibimagequant付きでビルドされていれば、アルファ込みのパレット画像をそのまま使う
+            result = rgba_img.quantize(colors=colors, method=Image.Quantize.LIBIMAGEQUANT)
+        except ValueError:
+            # libimagequantなし：Fast Octree
             quantized = rgba_img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
             result = quantized.convert('RGBA')
-        else:
-            result = img
             
         if verbose:
             print(f"        色数削減: {colors}色")
@@ -564,10 +659,7 @@ def is_background_image(page, img_info, xref, doc, verbose=False):
             img = Image.open(io.BytesIO(img_dict['image']))
             if img.mode in ('RGBA', 'LA'):
                 # RGBAやLAでも実際の透明度をチェック
-                if img.mode == 'RGBA':
-                    alpha = img.split()[3]
-                elif img.mode == 'LA':
-                    alpha = img.split()[1]
+                alpha = img.getchannel('A')
                     
                 alpha_min, alpha_max = alpha.getextrema()
                 if alpha_min < 250:  # 実質的な透明度あり
@@ -612,6 +704,103 @@ def apply_extreme_degradation(img, verbose=False):
         return img
 
 
+def smart_downscale(img, size):
+    """
+    縮小リサイズ
+    幅・高さとも同じ整数倍率で割り切れる場合はreduce()（ボックス平均）で縮小し、それ以外はLanczos
+    アルファ付き画像はLanczos（乗算済みアルファで補間）のまま
+    """
+    factor = img.width // size[0]
+    if (factor >= 2 and img.mode in ('L', 'RGB', 'CMYK')
+            and img.width == size[0] * factor and img.height == size[1] * factor):
+        return img.reduce(factor)
+    return img.resize(size, Image.Resampling.LANCZOS)
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _composite_on_white_kernel(pixels):
+        """Composite onto white in one pass over the rows, uint8 in / uint8 out (LA is widened to RGB)."""
+        height, width, channels = pixels.shape
+        out = np.empty((height, width, 3), dtype=np.uint8)
+        for y in prange(height):
+            for x in range(width):
+                a = np.uint32(pixels[y, x, channels - 1])
+                background = 255 * (255 - a) + 128
+                for c in range(3):
+                    t = np.uint32(pixels[y, x, min(c, channels - 2)]) * a + background
+                    out[y, x, c] = (t + (t >> 8)) >> 8
+        return out
+
+
+def composite_on_white(img):
+    """
+    RGBA/LA画像を白背景に合成してRGB画像を返す
+    Image.new + paste(mask=) と同じ丸めを、split()による帯域の複製なしにNumPyの整数演算で行う
+    Numbaがあれば同じ式をuint16の中間配列なしに行単位の並列ループで計算する
+    """
+    pixels = np.asarray(img)
+    if NUMBA_AVAILABLE:
+        return Image.fromarray(_composite_on_white_kernel(pixels))
+    color = pixels[..., :-1].astype(np.uint16)
+    alpha = pixels[..., -1:].astype(np.uint16)
+    # color * a + 255 * (255 - a) を丸めて255で割る
+    blended = color * alpha + 255 * (255 - alpha) + 128
+    color = ((blended + (blended >> 8)) >> 8).astype(np.uint8)
+    if img.mode == 'LA':  # グレースケールを3チャンネルに複製
+        color = np.repeat(color, 3, axis=-1)
+    return Image.fromarray(np.ascontiguousarray(color))
+
+
+def resize_smask(smask_img, size):
+    """
+    Fit an SMask to its base image. Alpha planes are smooth or two-level, so
+    a box average (shrinking) or bilinear (enlarging) is enough; Lanczos
+    costs far more taps for no visible difference.
+    """
+    if smask_img.width >= size[0] and smask_img.height >= size[1]:
+        return smask_img.resize(size, Image.Resampling.BOX)
+    return smask_img.resize(size, Image.Resampling.BILINEAR)
+
+
+def alpha_jpeg_quality(quality):
+    """RGBの品質 quality に対するSMask用のJPEG品質（RGBより高くはしない）"""
+    return min(quality, max(ALPHA_MIN_QUALITY, quality - ALPHA_QUALITY_DROP))
+
+
+def use_progressive(img):
+    """プログレッシブJPEGにするか（PROGRESSIVE_MIN_PIXELS 以上の画像だけ）"""
+    return img.width * img.height >= PROGRESSIVE_MIN_PIXELS
+
+
+def encode_jpeg(img, quality):
+    """
+    Encode an RGB or L image as JPEG.
+    
+    TurboJPEG encodes straight from the pixel buffer when available; its flags
+    offer no Huffman optimization besides progressive mode, so it always writes
+    progressive. Otherwise Pillow is used, progressive only when use_progressive.
+    mozjpeg then re-optimizes the entropy coding if installed.
+    """
+    if TURBOJPEG_AVAILABLE and img.mode in ('L', 'RGB'):
+        if img.mode == 'L':
+            pixel_format, subsample = TJPF_GRAY, TJSAMP_GRAY
+        else:
+            pixel_format, subsample = TJPF_RGB, TJSAMP_420
+        jpeg_data = _TJ.encode(np.asarray(img), quality=quality, pixel_format=pixel_format,
+                               jpeg_subsample=subsample, flags=TJFLAG_PROGRESSIVE)
+    else:
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=quality, optimize=True, progressive=use_progressive(img))
+        jpeg_data = output.getvalue()
+    
+    if MOZJPEG_AVAILABLE:
+        optimized = mozjpeg_lossless_optimization.optimize(jpeg_data)
+        if len(optimized) < len(jpeg_data):
+            jpeg_data = optimized
+    return jpeg_data
+
+
 def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=150, quality=70, 
                                           grayscale=False, png_quality=20, preserve_background=False, verbose=True):
     """
@@ -694,7 +883,7 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
                 scale = background_dpi / actual_dpi
                 new_width = max(int(width * scale), 64)
                 new_height = max(int(height * scale), 64)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+                img = smart_downscale(img, (new_width, new_height))
                 if verbose:
                     print(f"      背景画像リサイズ {xref}: {width}x{height} → {new_width}x{new_height} @ 32 DPI")
                 
@@ -706,7 +895,7 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
                 scale = image_dpi / actual_dpi
                 new_width = max(int(width * scale), 64)
                 new_height = max(int(height * scale), 64)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+                img = smart_downscale(img, (new_width, new_height))
                 if verbose:
                     print(f"      Resizing {xref}: {width}x{height} @ {actual_dpi:.0f} DPI → {new_width}x{new_height} @ {image_dpi} DPI")
             
@@ -720,10 +909,7 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
             # Check mode-based transparency
             mode_has_transparency = False
             if img.mode in ('RGBA', 'LA'):
-                if img.mode == 'RGBA':
-                    alpha = img.split()[3]
-                else:
-                    alpha = img.split()[1]
+                alpha = img.getchannel('A')
                 alpha_min, alpha_max = alpha.getextrema()
                 mode_has_transparency = alpha_min < 250
             elif 'transparency' in img.info:
@@ -737,14 +923,12 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
                 # Force RGB mode for JPEG
                 if img.mode != 'RGB':
                     if img.mode == 'RGBA':
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        background.paste(img, mask=img.split()[3])
-                        img = background
+                        img = composite_on_white(img)
                     else:
                         img = img.convert('RGB')
                 
                 # Save with ultimate compression
-                img.save(output, format='JPEG', quality=1, optimize=True, progressive=True)
+                output.write(encode_jpeg(img, 1))
                 if verbose:
                     print(f"        背景画像: JPEG品質1で保存")
                     
@@ -773,7 +957,7 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
                         if img.mode == 'RGBA':
                             # Convert RGBA to LA
                             rgb = img.convert('RGB').convert('L')
-                            alpha = img.split()[3]
+                            alpha = img.getchannel('A')
                             img = Image.merge('LA', (rgb, alpha))
                         else:
                             img = img.convert('L')
@@ -797,17 +981,9 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
                         
                 # Force RGB mode for JPEG
                 if img.mode != 'RGB':
-                    if img.mode == 'RGBA':
-                        # RGBAの場合、アルファチャンネルを白背景で合成
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        background.paste(img, mask=img.split()[3])
-                        img = background
-                    elif img.mode == 'LA':
-                        # LAの場合も同様に処理
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        rgb_img = img.convert('RGB')
-                        background.paste(rgb_img, mask=img.split()[1])
-                        img = background
+                    if img.mode in ('RGBA', 'LA'):
+                        # RGBA/LAの場合、アルファチャンネルを白背景で合成
+                        img = composite_on_white(img)
                     elif img.mode in ('CMYK', 'P'):
                         img = img.convert('RGB')
                     elif img.mode == 'L':
@@ -820,7 +996,7 @@ def process_image_with_smask_preservation(doc, page, img_info, xref, image_dpi=1
                     img = img.convert('L')
                 
                 # Save as JPEG with appropriate quality
-                img.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+                output.write(encode_jpeg(img, quality))
                 if verbose:
                     print(f"        JPEG保存: 品質{quality}")
             
@@ -890,21 +1066,6 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
             print(f"Original size: {original_size:,} bytes")
             print(f"Level: {optimization_level}, DPI: {image_dpi}")
         
-        # Art box trimming
-        if trim_to_artbox:
-            trimmed = 0
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                try:
-                    artbox = page.artbox
-                    if artbox and artbox != page.rect:
-                        page.set_cropbox(artbox)
-                        trimmed += 1
-                except:
-                    pass
-            if verbose and trimmed > 0:
-                print(f"  Trimmed {trimmed} page(s)")
-        
         # Basic cleanup
         if optimization_level >= 1:
             try:
@@ -936,6 +1097,38 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
             except:
                 pass
         
+        # ページの走査は1回だけ：アートボックスと（PyMuPDFで処理する場合は）画像xrefを集め、
+        # トリミングは走査後にまとめて適用する
+        # （clean_pagesで未使用の画像がリソースから外れるため、画像の収集はscrubの後で行う）
+        collect_images = optimization_level >= 3 and not PIKEPDF_AVAILABLE
+        artboxes = []
+        all_images = {}
+        for page in doc:
+            if trim_to_artbox:
+                try:
+                    artbox = page.artbox
+                    if artbox and artbox != page.rect:
+                        artboxes.append((page, artbox))
+                except:
+                    pass
+            if collect_images:
+                for img in page.get_images():
+                    xref = img[0]
+                    if xref not in all_images:
+                        all_images[xref] = (page, img)
+        
+        # Art box trimming
+        if trim_to_artbox:
+            trimmed = 0
+            for page, artbox in artboxes:
+                try:
+                    page.set_cropbox(artbox)
+                    trimmed += 1
+                except:
+                    pass
+            if verbose and trimmed > 0:
+                print(f"  Trimmed {trimmed} page(s)")
+        
         # Image optimization
         if optimization_level >= 3:
             quality = 50 if optimization_level == 3 else 30
@@ -945,30 +1138,46 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
                 if verbose:
                     print(f"  pikepdf高度処理を実行中...")
                 
-                # 一旦保存してpikepdfで処理
-                temp_path = output_path + '.temp'
-                doc.save(temp_path, garbage=1, deflate=True)
+                # PyMuPDFの結果はメモリ上でpikepdfに渡し、全ページを処理してから出力ファイルへ1回だけ書き込む
+                pdf_data = doc.tobytes(garbage=1, deflate=True)
                 doc.close()
                 
                 total_pikepdf_processed = 0
+                pikepdf_saved = False
+                replaced = {}  # 複数ページで共有される画像は一度だけ置き換える
                 
-                # 各ページをpikepdfで処理
-                for page_num in range(len(pymupdf.open(temp_path))):
-                    success, processed_count, result_msg = complete_jpeg_smask_separation_pikepdf(
-                        temp_path, page_num, quality, image_dpi, preserve_background, verbose
-                    )
-                    if success:
-                        total_pikepdf_processed += processed_count
-                        if verbose and processed_count > 0:
-                            print(f"    ページ{page_num+1}: {result_msg}")
+                try:
+                    with pikepdf.Pdf.open(io.BytesIO(pdf_data)) as pdf:
+                        # 各ページをpikepdfで処理
+                        for page_num in range(len(pdf.pages)):
+                            success, processed_count, result_msg = complete_jpeg_smask_separation_pikepdf(
+                                pdf, page_num, quality, image_dpi, preserve_background, verbose, replaced
+                            )
+                            if success:
+                                total_pikepdf_processed += processed_count
+                                if verbose and processed_count > 0:
+                                    print(f"    ページ{page_num+1}: {result_msg}")
+                        
+                        # 保存（既存のストリームはPyMuPDFで圧縮済みなので再圧縮・正規化はしない。
+                        # normalize_contentはコンテンツストリームを非圧縮で書き出すため逆に大きくなる）
+                        pdf.save(output_path,
+                                 compress_streams=True,      # 新しいストリームを圧縮
+                                 object_stream_mode=pikepdf.ObjectStreamMode.generate,  # オブジェクトストリームにまとめる
+                                 )
+                        pikepdf_saved = True
+                except Exception as e:
+                    if verbose:
+                        print(f"  pikepdf処理エラー: {e}")
+                
+                if not pikepdf_saved:
+                    # pikepdfで保存できなかった場合はPyMuPDFの結果をそのまま出力
+                    with open(output_path, 'wb') as f:
+                        f.write(pdf_data)
                 
                 if total_pikepdf_processed > 0:
                     if verbose:
                         print(f"  pikepdf処理完了: {total_pikepdf_processed}個のSMask画像を最適化")
                 
-                # 処理済みファイルを再オープン
-                doc = pymupdf.open(temp_path)
-                
                 # pikepdf処理を行った場合、PyMuPDF後処理はスキップ
                 if verbose:
                     print(f"  PyMuPDF後処理をスキップ（pikepdf処理済み）")
@@ -976,15 +1185,7 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
                 all_images = {}  # 空にしてPyMuPDF処理をスキップ
                 
             else:
-                # pikepdf非対応時は従来処理
-                all_images = {}
-                for page_num in range(len(doc)):
-                    page = doc[page_num]
-                    for img in page.get_images():
-                        xref = img[0]
-                        if xref not in all_images:
-                            all_images[xref] = (page, img)
-                
+                # pikepdf非対応時は従来処理（画像はトリミング前の走査で収集済み）
                 if verbose:
                     print(f"  Found {len(all_images)} image(s), quality: {quality}")
             
@@ -1020,17 +1221,8 @@ def optimize_pdf_simple_smask(input_path, output_path, optimization_level=4, ima
                     print(f"  Skipped: {skipped} images")
             
             # 最終保存処理の判定
-            if PIKEPDF_AVAILABLE and 'temp_path' in locals() and os.path.exists(temp_path):
-                # pikepdf処理を行った場合：temp_pathが最新版
-                if verbose:
-                    print(f"  pikepdf処理版を最終出力として使用")
-                
-                doc.close()  # PyMuPDF docを閉じる
-                
-                # pikepdf処理済みファイルを最終出力にコピー
-                import shutil
-                shutil.move(temp_path, output_path)
-                
+            if PIKEPDF_AVAILABLE:
+                # pikepdf処理を行った場合：出力は保存済み
                 if verbose:
                     print(f"  pikepdf処理版を保存: {output_path}")
                     
@@ -5,12 +5,144 @@ Enhanced pikepdf機能の動作確認用
 """
 
 import pikepdf
-from PIL import Image
+from PIL import Image, features
+import numpy as np
 import io
 import os
 import sys
+import zlib
 
-def simple_jpeg_smask_optimization(input_pdf, output_pdf):
+# mozjpegによるロスレス再最適化（任意、ハフマン表・プログレッシブ化のみで画質は変わらない）
+try:
+    import mozjpeg_lossless_optimization
+    MOZJPEG_AVAILABLE = True
+except ImportError:
+    MOZJPEG_AVAILABLE = False
+
+# zlib-ng（任意、zlib互換の出力をSIMDで高速に圧縮）
+try:
+    from zlib_ng import zlib_ng
+    ZLIB_NG_AVAILABLE = True
+except ImportError:
+    ZLIB_NG_AVAILABLE = False
+
+# CCITT G4エンコード（PillowのlibtiffによるTIFF保存を利用）
+LIBTIFF_AVAILABLE = features.check('libtiff')
+
+def deflate(data):
+    """zlib-ngがあればレベル6、なければ標準zlibのレベル9で圧縮"""
+    if ZLIB_NG_AVAILABLE:
+        return zlib_ng.compress(data, 6)
+    return zlib.compress(data, 9)
+
+def png_predict_deflate(img):
+    """
+    8bitグレースケール画像をPNG予測付きでFlate圧縮
+    行ごとに None/Sub/Up/Average/Paeth のうち差分の絶対値和が最小のフィルタを選ぶ（pngと同じ方式）。
+    /DecodeParms << /Predictor 15 /Colors 1 /BitsPerComponent 8 /Columns 幅 >> で復元できる。
+    """
+    x = np.asarray(img, dtype=np.uint8).astype(np.int16)
+    height, width = x.shape
+    left = np.zeros_like(x)
+    left[:, 1:] = x[:, :-1]
+    up = np.zeros_like(x)
+    up[1:] = x[:-1]
+    upleft = np.zeros_like(x)
+    upleft[1:, 1:] = x[:-1, :-1]
+    
+    # Paeth予測子
+    p = left + up - upleft
+    pa, pb, pc = np.abs(p - left), np.abs(p - up), np.abs(p - upleft)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+    
+    # フィルタ種別 0-4 の順に差分を計算（256で折り返す）
+    filtered = np.stack([x, x - left, x - up, x - ((left + up) >> 1), x - paeth]).astype(np.uint8)
+    cost = np.abs(filtered.view(np.int8).astype(np.int32)).sum(axis=2)
+    best = cost.argmin(axis=0)
+    
+    rows = np.empty((height, width + 1), dtype=np.uint8)
+    rows[:, 0] = best
+    rows[:, 1:] = filtered[best, np.arange(height)]
+    return deflate(rows.tobytes())
+
+
+def encode_binary_mask_g4(img):
+    """
+    0/255だけの2値マスクを1bitのCCITT G4で圧縮（8bit Flateの数分の一になる）
+    TIFF(group4)に1ストリップで書き出し、そのストリップをそのまま使う。
+    /DecodeParms << /K -1 /Columns 幅 /Rows 高さ /BlackIs1 true >> で復元できる。
+    2値でない・libtiffがない場合はNone
+    """
+    if not LIBTIFF_AVAILABLE:
+        return None
+    arr = np.asarray(img)
+    if not np.isin(arr, (0, 255)).all():
+        return None
+    
+    output = io.BytesIO()
+    img.convert('1', dither=Image.Dither.NONE).save(output, format='TIFF', compression='group4',
+                                                     tiffinfo={278: img.height})  # RowsPerStrip
+    tiff = Image.open(io.BytesIO(output.getvalue()))
+    offset = tiff.tag_v2[273][0]  # StripOffsets
+    length = tiff.tag_v2[279][0]  # StripByteCounts
+    return output.getvalue()[offset:offset + length]
+
+
+def encode_jpeg(img, quality=70):
+    """
+    JPEGエンコード
+    mozjpegがあればPillowのハフマン最適化の代わりにmozjpegでロスレス再最適化する
+    """
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=not MOZJPEG_AVAILABLE)
+    jpeg_data = output.getvalue()
+    if MOZJPEG_AVAILABLE:
+        optimized = mozjpeg_lossless_optimization.optimize(jpeg_data)
+        if len(optimized) < len(jpeg_data):
+            jpeg_data = optimized
+    return jpeg_data
+
+
+# IJG標準の輝度量子化テーブル（JPEGの品質推定に使用）
+STD_LUMA_QTABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+
+def reusable_jpeg(obj, quality=70):
+    """
+    元がDCTDecodeで、量子化テーブルから推定した品質が quality 以下なら (推定品質, JPEGデータ) を返す
+    再圧縮しても小さくならず劣化だけが重なるため、元のJPEGをそのまま使う（mozjpegがあればロスレス再最適化のみ）。
+    該当しなければNone
+    """
+    if obj.get('/Filter') != pikepdf.Name.DCTDecode:
+        return None
+    jpeg_data = bytes(obj.read_raw_bytes())
+    try:
+        tables = Image.open(io.BytesIO(jpeg_data)).quantization
+    except Exception:
+        return None
+    if not tables or 0 not in tables:
+        return None
+    scale = sum(tables[0]) * 100 / sum(STD_LUMA_QTABLE)
+    source_quality = max(1, min(100, round((200 - scale) / 2 if scale <= 100 else 5000 / scale)))
+    if source_quality > quality:
+        return None
+    if MOZJPEG_AVAILABLE:
+        optimized = mozjpeg_lossless_optimization.optimize(jpeg_data)
+        if len(optimized) < len(jpeg_data):
+            jpeg_data = optimized
+    return source_quality, jpeg_data
+
+
+def simple_jpeg_smask_optimization(input_pdf, output_pdf, image_dpi=150):
     """シンプルなJPEG+SMask最適化テスト"""
     
     print("=== pikepdf シンプル最適化テスト ===")
@@ -23,6 +155,17 @@ def simple_jpeg_smask_optimization(input_pdf, output_pdf):
     total_processed = 0
     total_pages = len(pdf.pages)
     
+    # 他の画像のSMaskとして使われているオブジェクト（単独の画像としては処理しない）
+    smask_ids = set()
+    for page in pdf.pages:
+        if '/Resources' in page and '/XObject' in page['/Resources']:
+            for obj in page['/Resources']['/XObject'].values():
+                if '/SMask' in obj:
+                    smask_ids.add(obj['/SMask'].objgen)
+    
+    # 処理済みの画像（ページ間で共有される画像を二度デコード・再圧縮しない）
+    seen = set()
+    
     for page_num, page in enumerate(pdf.pages):
         print(f"\nPage {page_num + 1}/{total_pages}")
         
@@ -33,6 +176,10 @@ def simple_jpeg_smask_optimization(input_pdf, output_pdf):
         
         for name, obj in xobjects.items():
             if '/Subtype' in obj and obj['/Subtype'] == '/Image':
+                if obj.objgen in seen or obj.objgen in smask_ids:
+                    continue
+                seen.add(obj.objgen)
+                
                 width = int(obj.get('/Width', 0))
                 height = int(obj.get('/Height', 0))
                 
@@ -41,12 +188,32 @@ def simple_jpeg_smask_optimization(input_pdf, output_pdf):
                     print(f"  Processing SMask image: {name} ({width}x{height})")
                     
                     try:
-                        # ベース画像抽出
-                        base_img = pikepdf.PdfImage(obj).as_pil_image()
-                        if base_img.mode == 'CMYK':
-                            base_img = base_img.convert('RGB')
-                        elif base_img.mode != 'RGB':
-                            base_img = base_img.convert('RGB')
+                        # 出力サイズをDPIから決める（ベース画像・SMaskとも同じサイズにそろえる）
+                        estimated_dpi = max(width, height) / 10  # 簡易推定（pdf_optimizer_simple_smaskと同じ）
+                        if estimated_dpi > image_dpi * 1.5:
+                            scale = image_dpi / estimated_dpi
+                            target_size = (max(int(width * scale), 32), max(int(height * scale), 32))
+                        else:
+                            target_size = (width, height)
+                        
+                        # 既に品質70以下のJPEGでリサイズも不要ならベース画像は再圧縮しない（色空間もそのまま）
+                        reused = reusable_jpeg(obj, 70) if target_size == (width, height) else None
+                        if reused:
+                            source_quality, jpeg_data = reused
+                            print(f"    Base JPEG q{source_quality} kept")
+                        else:
+                            # ベース画像抽出
+                            base_img = pikepdf.PdfImage(obj).as_pil_image()
+                            if base_img.mode == 'CMYK':
+                                base_img = base_img.convert('RGB')
+                            elif base_img.mode != 'RGB':
+                                base_img = base_img.convert('RGB')
+                            
+                            # JPEG圧縮で高周波は失われるので、縮小はLanczosではなくバイリニアで十分
+                            base_img = base_img.resize(target_size, Image.Resampling.BILINEAR)
+                            
+                            # JPEGで保存（品質70）
+                            jpeg_data = encode_jpeg(base_img, 70)
                         
                         # SMask抽出
                         smask_obj = obj['/SMask']
@@ -54,33 +221,40 @@ def simple_jpeg_smask_optimization(input_pdf, output_pdf):
                         if smask_img.mode != 'L':
                             smask_img = smask_img.convert('L')
                         
-                        # サイズ合わせ
-                        if base_img.size != smask_img.size:
-                            smask_img = smask_img.resize(base_img.size, Image.Resampling.LANCZOS)
-                        
-                        # JPEGで保存（品質70）
-                        jpeg_output = io.BytesIO()
-                        base_img.save(jpeg_output, format='JPEG', quality=70, optimize=True)
-                        jpeg_data = jpeg_output.getvalue()
+                        # ベース画像と同じ出力サイズへ（バイリニアの方がなめらかでFlate圧縮にも有利）
+                        smask_img = smask_img.resize(target_size, Image.Resampling.BILINEAR)
                         
-                        # Alpha（SMask）は生ピクセルデータとして保存（FlateDecode圧縮）
-                        alpha_data = smask_img.tobytes()
+                        # Alpha（SMask）はPNG予測付きでFlate圧縮、2値なら1bit CCITT G4の方が小さければそちら（どちらもロスレス）
+                        alpha_data = png_predict_deflate(smask_img)
+                        g4_data = encode_binary_mask_g4(smask_img)
+                        binary_mask = g4_data is not None and len(g4_data) < len(alpha_data)
+                        if binary_mask:
+                            alpha_data = g4_data
                         
                         # PDFオブジェクトを更新
                         obj.write(jpeg_data, filter=pikepdf.Name.DCTDecode)
-                        obj.Width = base_img.width
-                        obj.Height = base_img.height
-                        obj.ColorSpace = pikepdf.Name.DeviceRGB
-                        obj.BitsPerComponent = 8
+                        if not reused:
+                            obj.Width = base_img.width
+                            obj.Height = base_img.height
+                            obj.ColorSpace = pikepdf.Name.DeviceRGB
+                            obj.BitsPerComponent = 8
                         
-                        # SMaskも更新（生ピクセルデータをFlateDecode圧縮）
-                        smask_obj.write(alpha_data, filter=pikepdf.Name.FlateDecode)
+                        # SMaskも更新（CCITTFaxDecode または PNG予測付きFlateDecode）
+                        if binary_mask:
+                            smask_obj.write(alpha_data, filter=pikepdf.Name.CCITTFaxDecode,
+                                            decode_parms=pikepdf.Dictionary(K=-1, Columns=smask_img.width,
+                                                                            Rows=smask_img.height, BlackIs1=True))
+                        else:
+                            smask_obj.write(alpha_data, filter=pikepdf.Name.FlateDecode,
+                                            decode_parms=pikepdf.Dictionary(Predictor=15, Colors=1, BitsPerComponent=8,
+                                                                            Columns=smask_img.width))
                         smask_obj.Width = smask_img.width
                         smask_obj.Height = smask_img.height
                         smask_obj.ColorSpace = pikepdf.Name.DeviceGray
-                        smask_obj.BitsPerComponent = 8
+                        smask_obj.BitsPerComponent = 1 if binary_mask else 8
                         
-                        print(f"    ✓ Updated: JPEG {len(jpeg_data):,} bytes, SMask {len(alpha_data):,} bytes")
+                        mask_filter = "G4" if binary_mask else "Flate"
+                        print(f"    ✓ Updated: JPEG {len(jpeg_data):,} bytes, SMask {len(alpha_data):,} bytes ({mask_filter})")
                         total_processed += 1
                         
                     except Exception as e:
@@ -91,6 +265,14 @@ def simple_jpeg_smask_optimization(input_pdf, output_pdf):
                     print(f"  Processing regular image: {name} ({width}x{height})")
                     
                     try:
+                        # 既に品質70以下のJPEGなら再圧縮しない
+                        reused = reusable_jpeg(obj, 70)
+                        if reused:
+                            source_quality, jpeg_data = reused
+                            obj.write(jpeg_data, filter=pikepdf.Name.DCTDecode)
+                            print(f"    ✓ Kept JPEG q{source_quality}: {len(jpeg_data):,} bytes")
+                            continue
+                        
                         img = pikepdf.PdfImage(obj).as_pil_image()
                         
                         # CMYK→RGB変換
@@ -100,9 +282,7 @@ def simple_jpeg_smask_optimization(input_pdf, output_pdf):
                             img = img.convert('RGB')
                         
                         # JPEG圧縮
-                        output = io.BytesIO()
-                        img.save(output, format='JPEG', quality=70, optimize=True)
-                        jpeg_data = output.getvalue()
+                        jpeg_data = encode_jpeg(img, 70)
                         
                         # 更新
                         obj.write(jpeg_data, filter=pikepdf.Name.DCTDecode)
@@ -4,52 +4,76 @@ import fitz
 from PIL import Image
 import io
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 
-def complete_jpeg_smask_separation(doc, page, xref, img, quality=70, verbose=True):
+# 間接参照 '449 0 R' のオブジェクト番号部分
+SMASK_REF_RE = re.compile(r'(\d+)\s+\d+\s+R')
+
+# プログレッシブJPEGにする最小画素数（src/pdf_optimizer_simple_smask.py と同じ値）
+PROGRESSIVE_MIN_PIXELS = 200_000
+
+def parse_smask_xref(smask_ref):
+    """xref_get_key(xref, "SMask") の結果 ('xref', '449 0 R') からSMaskのxrefを取り出す（なければNone）"""
+    if not smask_ref or smask_ref in [None, 'null', ('null', 'null')]:
+        return None
+    if isinstance(smask_ref, tuple) and len(smask_ref) >= 2:
+        match = SMASK_REF_RE.match(smask_ref[1])
+        if match:
+            return int(match.group(1))
+    return None
+
+def encode_jpeg_smask_pair(img, quality=70):
+    """
+    RGBA/LA画像をJPEG(RGB)とグレースケールJPEG(Alpha)にエンコード
+    docには触れないので、スレッドプールのワーカーで実行できる
+    
+    Returns:
+        (size, new_jpeg_data, new_alpha_data)
+    """
+    # RGBA分離
+    # convert('RGB') はLAのグレーも3チャンネルに複製する（split()/merge() の往復をしない）
+    rgb_img = img.convert('RGB')
+    alpha_img = img.getchannel('A')
+        
+    # 1. RGB部分をJPEGで保存
+    jpeg_output = io.BytesIO()
+    progressive = rgb_img.width * rgb_img.height >= PROGRESSIVE_MIN_PIXELS
+    rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True, progressive=progressive)
+    new_jpeg_data = jpeg_output.getvalue()
+    
+    # 2. Alpha部分もJPEGで保存（グレースケール）
+    # Lモードのまま保存して1成分のJPEGにする（マスクは常にベースライン）
+    alpha_jpeg_output = io.BytesIO()
+    alpha_quality = min(quality, max(35, quality - 20))  # アルファはRGBより低い品質で十分（下限35）
+    alpha_img.save(alpha_jpeg_output, format='JPEG', quality=alpha_quality, optimize=True)
+    new_alpha_data = alpha_jpeg_output.getvalue()
+    
+    return img.size, new_jpeg_data, new_alpha_data
+
+def complete_jpeg_smask_separation(doc, page, xref, img, quality=70, verbose=True, smask_xref=None,
+                                   encoded=None):
     """
     完全なJPEG+SMask分離処理
     両方ともJPEG形式で保存してPNG膨張を完全回避
+    smask_xref: 呼び出し側で解析済みのSMask xref（省略時はここで取得）
+    encoded: encode_jpeg_smask_pair の結果（省略時はここでエンコード）
+    PDFの書き換えはスレッドセーフではないので、この関数はメインスレッドから呼ぶ
     """
     try:
         if img.mode not in ('RGBA', 'LA'):
             return False, "Not RGBA/LA image"
             
-        # SMask参照を取得
-        smask_ref = doc.xref_get_key(xref, "SMask")
-        if not smask_ref or smask_ref in [None, 'null', ('null', 'null')]:
-            return False, "No SMask found"
-            
-        # SMask xrefを抽出
-        smask_xref = None
-        if isinstance(smask_ref, tuple) and len(smask_ref) >= 2:
-            smask_str = smask_ref[1]
-            if ' 0 R' in smask_str:
-                smask_xref = int(smask_str.split(' 0 R')[0])
-                
+        # SMask xrefを取得
+        if smask_xref is None:
+            smask_xref = parse_smask_xref(doc.xref_get_key(xref, "SMask"))
         if not smask_xref:
-            return False, "Invalid SMask xref"
-            
-        # RGBA分離
-        if img.mode == 'RGBA':
-            r, g, b, a = img.split()
-            rgb_img = Image.merge('RGB', (r, g, b))
-            alpha_img = a
-        elif img.mode == 'LA':
-            l, a = img.split()
-            rgb_img = Image.merge('RGB', (l, l, l))
-            alpha_img = a
+            return False, "No SMask found"
             
-        # 1. RGB部分をJPEGで保存
-        jpeg_output = io.BytesIO()
-        rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True, progressive=True)
-        new_jpeg_data = jpeg_output.getvalue()
-        
-        # 2. Alpha部分もJPEGで保存（グレースケール）
-        # アルファチャンネルをRGBに変換してJPEG保存
-        alpha_rgb = Image.merge('RGB', (alpha_img, alpha_img, alpha_img))
-        alpha_jpeg_output = io.BytesIO()
-        alpha_rgb.save(alpha_jpeg_output, format='JPEG', quality=quality, optimize=True)
-        new_alpha_data = alpha_jpeg_output.getvalue()
+        # 1.-2. RGB部分とAlpha部分をJPEGにエンコード
+        if encoded is None:
+            encoded = encode_jpeg_smask_pair(img, quality)
+        (width, height), new_jpeg_data, new_alpha_data = encoded
         
         # 3. 元画像をJPEGで置換
         page.replace_image(xref, stream=new_jpeg_data)
@@ -59,14 +83,14 @@ def complete_jpeg_smask_separation(doc, page, xref, img, quality=70, verbose=Tru
         
         # 5. オブジェクト属性を更新
         # JPEG画像のオブジェクト属性
-        doc.xref_set_key(xref, "Width", str(rgb_img.width))
-        doc.xref_set_key(xref, "Height", str(rgb_img.height))
+        doc.xref_set_key(xref, "Width", str(width))
+        doc.xref_set_key(xref, "Height", str(height))
         # ColorSpaceとFilterは既存のままにする（変更すると破損の可能性）
         
         # SMaskのオブジェクト属性  
-        doc.xref_set_key(smask_xref, "Width", str(alpha_img.width))
-        doc.xref_set_key(smask_xref, "Height", str(alpha_img.height))
-        # SMaskも既存設定を維持
+        doc.xref_set_key(smask_xref, "Width", str(width))
+        doc.xref_set_key(smask_xref, "Height", str(height))
+        doc.xref_set_key(smask_xref, "ColorSpace", "/DeviceGray")
         
         if verbose:
             print(f"        完全JPEG分離: RGB {len(new_jpeg_data):,}b + Alpha {len(new_alpha_data):,}b")
@@ -78,6 +102,28 @@ def complete_jpeg_smask_separation(doc, page, xref, img, quality=70, verbose=Tru
             print(f"        JPEG完全分離エラー: {e}")
         return False, f"Error: {e}"
 
+def load_small_rgba(doc, base_image, smask_xref):
+    """
+    テスト用の縮小RGBA画像を作る（combine_jpeg_with_smask の簡易版）
+    JPEGはベース・SMaskともdraftでDCTの段階から縮小してデコードし、それぞれ目標サイズへ直接リサイズする
+    （フル解像度のRGBAを組み立ててから縮小しない）
+    """
+    size = (min(base_image['width']//4, 128), min(base_image['height']//4, 128))
+    
+    jpeg_img = Image.open(io.BytesIO(base_image['image']))
+    jpeg_img.draft('RGB', size)
+    smask_img = Image.open(io.BytesIO(doc.extract_image(smask_xref)['image']))
+    smask_img.draft('L', size)  # SMaskもJPEGならDCT段階で縮小（PNGなどでは何もしない）
+    
+    if jpeg_img.mode != 'RGB':
+        jpeg_img = jpeg_img.convert('RGB')
+    if smask_img.mode != 'L':
+        smask_img = smask_img.convert('L')
+    
+    jpeg_img = jpeg_img.resize(size, Image.Resampling.LANCZOS)
+    smask_img = smask_img.resize(size, Image.Resampling.BOX)  # アルファの縮小は画素平均で十分
+    return Image.merge('RGBA', (*jpeg_img.split(), smask_img))
+
 def test_complete_jpeg_smask():
     """完全JPEG+SMask分離のテスト"""
     
@@ -88,6 +134,7 @@ def test_complete_jpeg_smask():
     images = page.get_images()
     
     # テスト用画像選択（小さめの画像）
+    # extract_image・SMask参照の解析・縮小RGBA画像の作成はここで1回だけ行い、以降は test_cases の値を使う
     test_cases = []
     for img_info in images:
         xref = img_info[0]
@@ -97,9 +144,14 @@ def test_complete_jpeg_smask():
                 base_image['width'] <= 800 and base_image['height'] <= 800):
                 
                 # SMask確認
-                smask_ref = doc.xref_get_key(xref, "SMask")
-                if smask_ref and smask_ref not in [None, 'null', ('null', 'null')]:
-                    test_cases.append((xref, base_image))
+                smask_xref = parse_smask_xref(doc.xref_get_key(xref, "SMask"))
+                if smask_xref:
+                    small_img = error = None
+                    try:
+                        small_img = load_small_rgba(doc, base_image, smask_xref)
+                    except Exception as e:
+                        error = e
+                    test_cases.append((xref, base_image, smask_xref, small_img, error))
                     if len(test_cases) >= 3:  # 3つまで
                         break
         except:
@@ -110,68 +162,57 @@ def test_complete_jpeg_smask():
     success_count = 0
     total_savings = 0
     
-    for i, (xref, base_image) in enumerate(test_cases):
-        print(f"\\n{i+1}. xref{xref} ({base_image['width']}x{base_image['height']})")
+    # 1. PDFの読み取りはメインスレッドで行い、
+    #    JPEGエンコードだけをスレッドプールに投入する（PillowのJPEGエンコードはGILを解放する）
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        jobs = []
+        for xref, base_image, smask_xref, small_img, error in test_cases:
+            # 元のサイズ確認
+            try:
+                original_stream_size = len(doc.xref_stream(xref))
+            except:
+                original_stream_size = 0
+                
+            future = None
+            if error is None:
+                future = executor.submit(encode_jpeg_smask_pair, small_img, 70)
+            jobs.append((xref, base_image, smask_xref, original_stream_size, small_img, future, error))
         
-        # 元のサイズ確認
-        try:
-            original_stream_size = len(doc.xref_stream(xref))
-            print(f"    元PDF内サイズ: {original_stream_size:,} bytes")
-        except:
-            original_stream_size = 0
-            
-        # RGBA画像を構築
-        try:
-            # combine_jpeg_with_smask の簡易版
-            jpeg_img = Image.open(io.BytesIO(base_image['image']))
+        # 2. エンコード結果を元の順にPDFへ反映（PDFの書き換えはメインスレッドのみ）
+        for i, (xref, base_image, smask_xref, original_stream_size, small_img, future, error) in enumerate(jobs):
+            print(f"\\n{i+1}. xref{xref} ({base_image['width']}x{base_image['height']})")
+            if original_stream_size:
+                print(f"    元PDF内サイズ: {original_stream_size:,} bytes")
             
-            # SMask取得
-            smask_ref = doc.xref_get_key(xref, "SMask")
-            smask_xref = int(smask_ref[1].split(' 0 R')[0])
-            smask_image = doc.extract_image(smask_xref)
-            smask_img = Image.open(io.BytesIO(smask_image['image']))
-            
-            # サイズ調整
-            if jpeg_img.size != smask_img.size:
-                smask_img = smask_img.resize(jpeg_img.size, Image.Resampling.LANCZOS)
-                
-            # RGBA合成
-            if jpeg_img.mode != 'RGB':
-                jpeg_img = jpeg_img.convert('RGB')
-            if smask_img.mode != 'L':
-                smask_img = smask_img.convert('L')
+            try:
+                if error is not None:
+                    raise error
                 
-            r, g, b = jpeg_img.split()
-            rgba_img = Image.merge('RGBA', (r, g, b, smask_img))
-            
-            # リサイズ（テスト用）
-            small_img = rgba_img.resize((min(rgba_img.width//4, 128), min(rgba_img.height//4, 128)), 
-                                      Image.Resampling.LANCZOS)
-            
-            # 完全JPEG分離実行
-            success, result = complete_jpeg_smask_separation(
-                doc, page, xref, small_img, quality=70, verbose=True
-            )
-            
-            if success:
-                success_count += 1
+                # 完全JPEG分離実行
+                success, result = complete_jpeg_smask_separation(
+                    doc, page, xref, small_img, quality=70, verbose=True, smask_xref=smask_xref,
+                    encoded=future.result()
+                )
                 
-                # 分離後のサイズ確認
-                try:
-                    new_stream_size = len(doc.xref_stream(xref))
-                    savings = original_stream_size - new_stream_size
-                    total_savings += savings
+                if success:
+                    success_count += 1
                     
-                    if original_stream_size > 0:
-                        reduction = (savings / original_stream_size) * 100
-                        print(f"    分離後サイズ: {new_stream_size:,} bytes ({reduction:.1f}% 削減)")
-                except:
-                    pass
-            else:
-                print(f"    分離失敗: {result}")
-                
-        except Exception as e:
-            print(f"    処理エラー: {e}")
+                    # 分離後のサイズ確認
+                    try:
+                        new_stream_size = len(doc.xref_stream(xref))
+                        savings = original_stream_size - new_stream_size
+                        total_savings += savings
+                        
+                        if original_stream_size > 0:
+                            reduction = (savings / original_stream_size) * 100
+                            print(f"    分離後サイズ: {new_stream_size:,} bytes ({reduction:.1f}% 削減)")
+                    except:
+                        pass
+                else:
+                    print(f"    分離失敗: {result}")
+                    
+            except Exception as e:
+                print(f"    処理エラー: {e}")
     
     # 結果保存とテスト
     test_output = "complete_jpeg_smask_test.pdf"
@@ -3,31 +3,40 @@
 import fitz
 from PIL import Image
 import io
-import os
+import re
 
-def separate_jpeg_smask(doc, xref, quality=50, verbose=True):
+# 'NNN 0 R' 形式の参照にマッチ（番号をgroup(1)で取る）
+SMASK_REF_RE = re.compile(r'(\d+)\s+\d+\s+R')
+
+def parse_smask_xref(smask_ref):
+    """('xref', '449 0 R') 形式のSMask参照をxref番号にする（SMaskがなければNone）"""
+    if not smask_ref or smask_ref in [None, 'null', ('null', 'null')]:
+        return None
+    if isinstance(smask_ref, tuple) and len(smask_ref) >= 2:
+        match = SMASK_REF_RE.match(smask_ref[1])
+        if match:
+            return int(match.group(1))
+    return None
+
+def separate_jpeg_smask(doc, xref, quality=50, verbose=True, jpeg_dict=None, smask_xref=None):
     """
     JPEG+SMask画像を分離して、JPEG(RGB) + SMask(グレースケール)として保存
+    jpeg_dict, smask_xref: 取得済みの extract_image(xref) の結果とSMask xref（省略時はここで取得）
     """
     try:
         # 1. 元のJPEG+SMask情報取得
-        smask_ref = doc.xref_get_key(xref, "SMask")
-        if not smask_ref or smask_ref in [None, 'null', ('null', 'null')]:
-            return False, "No SMask found"
+        if smask_xref is None:
+            smask_ref = doc.xref_get_key(xref, "SMask")
+            if not smask_ref or smask_ref in [None, 'null', ('null', 'null')]:
+                return False, "No SMask found"
+            smask_xref = parse_smask_xref(smask_ref)
             
         # 2. JPEG画像とSMaskを取得
-        jpeg_dict = doc.extract_image(xref)
+        if jpeg_dict is None:
+            jpeg_dict = doc.extract_image(xref)
         if not jpeg_dict or jpeg_dict.get('ext') != 'jpeg':
             return False, "Not a JPEG image"
             
-        # SMask画像取得
-        smask_xref = None
-        if isinstance(smask_ref, tuple) and len(smask_ref) >= 2:
-            # ('xref', '449 0 R') 形式の処理
-            smask_str = smask_ref[1]
-            if ' 0 R' in smask_str:
-                smask_xref = int(smask_str.split(' 0 R')[0])
-        
         if not smask_xref:
             return False, "Invalid SMask reference"
             
@@ -44,32 +53,24 @@ def separate_jpeg_smask(doc, xref, quality=50, verbose=True):
         
         # サイズ調整
         if jpeg_img.size != smask_img.size:
-            smask_img = smask_img.resize(jpeg_img.size, Image.Resampling.LANCZOS)
+            # アルファなので縮小はBOX、拡大はBILINEAR
+            shrink = smask_img.width >= jpeg_img.width and smask_img.height >= jpeg_img.height
+            smask_img = smask_img.resize(jpeg_img.size, Image.Resampling.BOX if shrink
+                                         else Image.Resampling.BILINEAR)
             
         # SMaskをグレースケールに変換
         if smask_img.mode != 'L':
             smask_img = smask_img.convert('L')
             
-        # RGBA合成
-        if jpeg_img.mode != 'RGB':
-            jpeg_img = jpeg_img.convert('RGB')
-            
-        rgba_img = Image.new('RGBA', jpeg_img.size)
-        rgba_img.paste(jpeg_img, (0, 0))
-        
-        # アルファチャンネル設定
-        r, g, b = rgba_img.split()[:3]
-        rgba_img = Image.merge('RGBA', (r, g, b, smask_img))
-        
         # 4. 分離保存の準備
-        # RGB部分をJPEGとして保存
-        rgb_img = rgba_img.convert('RGB')
+        # RGB部分をJPEGとして保存（RGBAに合成して分け直しても同じ画像に戻るだけなので、そのまま使う）
+        rgb_img = jpeg_img.convert('RGB') if jpeg_img.mode != 'RGB' else jpeg_img
         jpeg_output = io.BytesIO()
         rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True)
         new_jpeg_data = jpeg_output.getvalue()
         
         # Alpha部分をグレースケール画像として保存
-        alpha_channel = rgba_img.split()[3]  # A channel
+        alpha_channel = smask_img
         smask_output = io.BytesIO()
         alpha_channel.save(smask_output, format='PNG', optimize=True, compress_level=9)
         new_smask_data = smask_output.getvalue()
@@ -96,6 +97,7 @@ def test_jpeg_smask_separation():
     images = page.get_images()
     
     # テスト対象画像を選択（最初の3つ）
+    # ここで取得した extract_image の結果とSMask xrefを separate_jpeg_smask にそのまま渡す
     test_images = []
     for i, img_info in enumerate(images[:5]):
         xref = img_info[0]
@@ -103,9 +105,9 @@ def test_jpeg_smask_separation():
             base_image = doc.extract_image(xref)
             if base_image.get('ext') == 'jpeg':
                 # SMask確認
-                smask_ref = doc.xref_get_key(xref, "SMask")
-                if smask_ref and smask_ref not in [None, 'null', ('null', 'null')]:
-                    test_images.append((xref, base_image))
+                smask_xref = parse_smask_xref(doc.xref_get_key(xref, "SMask"))
+                if smask_xref:
+                    test_images.append((xref, base_image, smask_xref))
                     if len(test_images) >= 3:  # 3つまで
                         break
         except:
@@ -116,7 +118,11 @@ def test_jpeg_smask_separation():
     successful_separations = 0
     total_savings = 0
     
-    for i, (xref, base_image) in enumerate(test_images):
+    # 分離適用テスト用：毎回まっさらなPDFから始めるので、ファイルは一度だけ読んでメモリから開き直す
+    with open('smasked-image-sample.pdf', 'rb') as f:
+        pristine_pdf = f.read()
+    
+    for i, (xref, base_image, smask_xref) in enumerate(test_images):
         print(f"\\n{i+1}. xref{xref} ({base_image['width']}x{base_image['height']})")
         
         # 元のPDF内サイズ
@@ -127,7 +133,8 @@ def test_jpeg_smask_separation():
             original_stream_size = 0
             
         # JPEG+SMask分離実行
-        success, result = separate_jpeg_smask(doc, xref, quality=70, verbose=True)
+        success, result = separate_jpeg_smask(doc, xref, quality=70, verbose=True,
+                                              jpeg_dict=base_image, smask_xref=smask_xref)
         
         if success:
             new_jpeg_data, new_smask_data, smask_xref = result
@@ -149,7 +156,7 @@ def test_jpeg_smask_separation():
             # 実際にPDFに適用してテスト
             try:
                 # 一時的なPDFで分離適用をテスト
-                test_doc = fitz.open('smasked-image-sample.pdf')
+                test_doc = fitz.open(stream=pristine_pdf, filetype='pdf')
                 test_page = test_doc[0]
                 
                 # JPEG部分を置換
@@ -158,18 +165,12 @@ def test_jpeg_smask_separation():
                 # SMaskを新しいデータに置換（実験的）
                 # 注意: この部分は複雑で、完全な実装には追加作業が必要
                 
-                test_doc.save(f"test_separated_{xref}.pdf", deflate=True)
-                separated_pdf_size = os.path.getsize(f"test_separated_{xref}.pdf")
+                # サイズを測るだけなので、ファイルに書いて消す代わりにメモリ上で保存
+                separated_pdf_size = len(test_doc.tobytes(deflate=True))
                 
                 print(f"    分離適用PDF: {separated_pdf_size:,} bytes")
                 
                 test_doc.close()
-                
-                # クリーンアップ
-                try:
-                    os.remove(f"test_separated_{xref}.pdf")
-                except:
-                    pass
                     
             except Exception as e:
                 print(f"    分離適用エラー: {e}")
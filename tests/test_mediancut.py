@@ -34,15 +34,20 @@ def optimize_png_with_mediancut(img, quality=20, verbose=True):
         print(f"  メディアンカット: 品質{quality} -> {colors}色")
     
     try:
-        # RGBAの場合はFast Octreeを使用
-        if img.mode == 'RGBA':
-            quantized = img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
-            result = quantized.convert('RGBA')
-        elif img.mode == 'LA':
-            # LAの場合はRGBAに変換してから処理
-            rgba_img = img.convert('RGBA')
-            quantized = rgba_img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
-            result = quantized.convert('RGBA')
+        # アルファが全面255ならRGBのパレット画像にする（4チャンネルの量子化とconvertの往復を省く）
+        if img.getchannel('A').getextrema() == (255, 255):
+            return img.convert('RGB').quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+        
+        if img.mode in ('RGBA', 'LA'):
+            # LAはRGBAに変換してから処理
+            rgba_img = img if img.mode == 'RGBA' else img.convert('RGBA')
+            try:
+                # libimagequant（pngquantのエンジン）はアルファ付きパレットを直接作る
+                result = rgba_img.quantize(colors=colors, method=Image.Quantize.LIBIMAGEQUANT)
+            except ValueError:
+                # Pillowがlibimagequantなしでビルドされている場合はFast Octree
+                quantized = rgba_img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+                result = quantized.convert('RGBA')
         else:
             quantized = img.quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
             result = quantized
@@ -85,7 +85,10 @@ def extract_image_with_transparency_pikepdf(pdf_obj, image_info):
         
         # サイズを合わせる
         if base_pil.size != smask_pil.size:
-            smask_pil = smask_pil.resize(base_pil.size, Image.Resampling.LANCZOS)
+            # アルファなので縮小はBOX、拡大はBILINEAR
+            shrink = smask_pil.width >= base_pil.width and smask_pil.height >= base_pil.height
+            smask_pil = smask_pil.resize(base_pil.size, Image.Resampling.BOX if shrink
+                                         else Image.Resampling.BILINEAR)
         
         # CMYK対応：RGBに変換
         if base_pil.mode == 'CMYK':
@@ -137,19 +140,17 @@ def optimize_image_with_jpeg_smask_pikepdf(pdf_path, output_path, quality=70):
                 continue
                 
             # RGBA分離
-            r, g, b, a = rgba_img.split()
-            rgb_img = Image.merge('RGB', (r, g, b))
-            alpha_img = a
+            rgb_img = rgba_img.convert('RGB')
+            alpha_img = rgba_img.getchannel('A')
             
             # JPEGで保存
             jpeg_output = io.BytesIO()
             rgb_img.save(jpeg_output, format='JPEG', quality=quality, optimize=True)
             jpeg_data = jpeg_output.getvalue()
             
-            # Alpha（SMask）をJPEGで保存（グレースケール→RGB変換）
-            alpha_rgb = Image.merge('RGB', (alpha_img, alpha_img, alpha_img))
+            # Alpha（SMask）をJPEGで保存（グレースケールのまま）
             alpha_output = io.BytesIO()
-            alpha_rgb.save(alpha_output, format='JPEG', quality=quality, optimize=True)
+            alpha_img.save(alpha_output, format='JPEG', quality=quality, optimize=True)
             alpha_data = alpha_output.getvalue()
             
             print(f"  JPEG変換: RGB {len(jpeg_data):,}bytes, Alpha {len(alpha_data):,}bytes")
@@ -161,9 +162,9 @@ def optimize_image_with_jpeg_smask_pikepdf(pdf_path, output_path, quality=70):
             # ベース画像を置換
             img_obj = xobjects[img_info['name']]
             
-            # 元のストリームサイズ取得
+            # 元のストリームサイズ取得（/Length を見るだけで、ストリームは読み出さない）
             try:
-                original_size = len(bytes(img_obj.read_raw_bytes()))
+                original_size = int(img_obj.Length)
                 print(f"  元サイズ: {original_size:,}bytes")
             except:
                 original_size = 0
@@ -178,6 +179,7 @@ def optimize_image_with_jpeg_smask_pikepdf(pdf_path, output_path, quality=70):
             smask_obj.write(alpha_data, filter=pikepdf.Name.DCTDecode)
             smask_obj.Width = alpha_img.width
             smask_obj.Height = alpha_img.height
+            smask_obj.ColorSpace = pikepdf.Name.DeviceGray
             
             # SMask参照を維持（pikepdfでは自動的に保持される）
             print(f"  SMask参照: {img_obj.get('/SMask', 'なし')}")
@@ -197,7 +199,10 @@ def optimize_image_with_jpeg_smask_pikepdf(pdf_path, output_path, quality=70):
             continue
     
     # 4. 最適化PDFを保存
-    pdf.save(output_path)
+    # DCTDecodeのストリームはqpdfが再圧縮しないので、未圧縮ストリームの圧縮とオブジェクトストリーム化だけ指定
+    pdf.save(output_path,
+             compress_streams=True,
+             object_stream_mode=pikepdf.ObjectStreamMode.generate)
     pdf.close()
     
     # 5. 結果表示
@@ -232,8 +237,13 @@ def compare_transparency_preservation():
     # 品質比較を実行
     print("\n品質検証を実行中...")
     
-    # 既存のテストスクリプトを活用
-    os.system('source venv/bin/activate && python3 test_quality_validation.py')
+    # 既存の検証関数を同じプロセスで呼ぶ（インタプリタの再起動とimportのやり直しを省く）
+    from test_quality_validation import validate_pdf_quality
+    validate_pdf_quality(
+        'smasked-image-sample.pdf',
+        'smasked-image-sample-pikepdf.pdf',
+        'smasked-image-sample-acrobat.pdf'
+    )
 
 if __name__ == "__main__":
     compare_transparency_preservation()
\ No newline at end of file
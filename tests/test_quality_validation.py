@@ -2,24 +2,36 @@
 
 import fitz
 from PIL import Image, ImageChops, ImageStat
-import io
 import os
 import math
 
+# 任意：scikit-imageがあれば本物のSSIMを使う（なければRMSからの簡易値）
+try:
+    import numpy as np
+    from skimage.metrics import structural_similarity as ssim
+    SSIM_AVAILABLE = True
+except ImportError:
+    SSIM_AVAILABLE = False
+
 def pdf_to_image(pdf_path, page_num=0, dpi=150):
     """PDFページを画像に変換"""
     doc = fitz.open(pdf_path)
     page = doc[page_num]
     mat = fitz.Matrix(dpi/72, dpi/72)
     pix = page.get_pixmap(matrix=mat, alpha=True)
-    img_data = pix.tobytes("png")
+    # PNGにエンコードして読み直さず、ピクセルバッファから直接作る（frombytesはコピーするのでdocを閉じてもよい）
+    mode = 'RGBA' if pix.alpha else 'RGB'
+    img = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+    pix = None
     doc.close()
     
-    img = Image.open(io.BytesIO(img_data))
     return img
 
-def calculate_metrics(img1, img2):
-    """画像品質メトリクスを計算（PIL only版）"""
+def calculate_metrics(img1, img2, gray1=None):
+    """
+    画像品質メトリクスを計算（PIL版、Similarityだけはscikit-imageがあればSSIM）
+    gray1: 変換済みの img1.convert('L')（同じ元画像を何度も比較するときに渡す）
+    """
     
     # サイズを合わせる
     if img1.size != img2.size:
@@ -28,6 +40,7 @@ def calculate_metrics(img1, img2):
         min_height = min(img1.height, img2.height)
         img1 = img1.crop((0, 0, min_width, min_height))
         img2 = img2.crop((0, 0, min_width, min_height))
+        gray1 = None  # 切り抜いたので作り直す
     
     # RGBに変換
     if img1.mode != 'RGB':
@@ -53,17 +66,22 @@ def calculate_metrics(img1, img2):
     else:
         psnr = 20 * math.log10(1.0 / math.sqrt(mse))
     
-    # 簡易SSIM（相関係数ベース）
-    # 完全一致=1.0、全く異なる=0.0
-    similarity = 1.0 - (rms / 255.0)
-    
-    # 黒画像検出（グレースケール変換して判定）
-    gray1 = img1.convert('L')
+    # 黒画像検出・SSIM用のグレースケール
+    if gray1 is None:
+        gray1 = img1.convert('L')
     gray2 = img2.convert('L')
     
+    # 類似度：scikit-imageがあれば輝度のSSIM、なければRMSベースの簡易値
+    # 完全一致=1.0、全く異なる=0.0
+    if SSIM_AVAILABLE:
+        similarity = float(ssim(np.asarray(gray1), np.asarray(gray2), data_range=255))
+    else:
+        similarity = 1.0 - (rms / 255.0)
+    
     # 黒画素率計算（10未満を黒とする）
-    black_pixels1 = sum(1 for pixel in gray1.getdata() if pixel < 10)
-    black_pixels2 = sum(1 for pixel in gray2.getdata() if pixel < 10)
+    # 画素をPythonで1つずつ数えず、ヒストグラム（C側で集計）の0-9を足す
+    black_pixels1 = sum(gray1.histogram()[:10])
+    black_pixels2 = sum(gray2.histogram()[:10])
     
     total_pixels = gray1.width * gray1.height
     black_ratio1 = black_pixels1 / total_pixels
@@ -92,12 +110,16 @@ def validate_pdf_quality(original_pdf, optimized_pdf, reference_pdf=None):
     print(f"最適化画像サイズ: {optimized_img.size}")
     
     # 品質メトリクス計算
+    # 元画像は参照PDFとの比較でも使うので、RGB・グレースケールへの変換は1回だけにする
     print("\n品質メトリクス計算中...")
-    metrics = calculate_metrics(original_img, optimized_img)
+    original_rgb = original_img.convert('RGB')
+    original_gray = original_rgb.convert('L')
+    metrics = calculate_metrics(original_rgb, optimized_img, original_gray)
     
     print(f"\n=== 最適化品質スコア ===")
     print(f"MSE (Mean Squared Error): {metrics['mse']:.2f} (低いほど良い)")
-    print(f"Similarity: {metrics['similarity']:.4f} (高いほど良い、1.0が完全一致)")
+    similarity_kind = "SSIM" if SSIM_AVAILABLE else "1 - RMS/255"
+    print(f"Similarity ({similarity_kind}): {metrics['similarity']:.4f} (高いほど良い、1.0が完全一致)")
     print(f"PSNR (Peak SNR): {metrics['psnr']:.2f} dB (高いほど良い)")
     print(f"黒画素率（元）: {metrics['black_ratio_1']*100:.1f}%")
     print(f"黒画素率（最適化）: {metrics['black_ratio_2']*100:.1f}%")
@@ -118,7 +140,7 @@ def validate_pdf_quality(original_pdf, optimized_pdf, reference_pdf=None):
     if reference_pdf and os.path.exists(reference_pdf):
         print(f"\n=== 参照PDFとの比較 ===")
         ref_img = pdf_to_image(reference_pdf)
-        ref_metrics = calculate_metrics(original_img, ref_img)
+        ref_metrics = calculate_metrics(original_rgb, ref_img, original_gray)
         
         print(f"参照版Similarity: {ref_metrics['similarity']:.4f}")
         print(f"最適化版Similarity: {metrics['similarity']:.4f}")
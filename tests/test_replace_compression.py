@@ -42,11 +42,11 @@ def test_replace_image_compression():
     print(f"置換PNG サイズ: {len(png_data):,} bytes")
     
     # 色数削減版
+    # パレット画像のまま保存する（RGBAパレットはtRNSチャンクになるので透明度も残る）
     quantized = replacement_img.quantize(colors=8, method=Image.Quantize.FASTOCTREE)
-    rgba_quantized = quantized.convert('RGBA')
     
     quantized_stream = io.BytesIO()
-    rgba_quantized.save(quantized_stream, format='PNG', optimize=True, compress_level=9)
+    quantized.save(quantized_stream, format='PNG', optimize=True, compress_level=9)
     quantized_data = quantized_stream.getvalue()
     print(f"8色PNG サイズ: {len(quantized_data):,} bytes")
     
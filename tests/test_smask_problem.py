@@ -18,9 +18,9 @@ def compare_smask_methods():
     for i, img_info in enumerate(our_images[:3]):
         xref = img_info[0]
         try:
-            base_image = our_doc.extract_image(xref)
-            width = base_image['width'] 
-            height = base_image['height']
+            # 幅・高さは辞書から読む（extract_imageはストリーム全体を取り出すので使わない）
+            width = int(our_doc.xref_get_key(xref, 'Width')[1])
+            height = int(our_doc.xref_get_key(xref, 'Height')[1])
             
             # SMask確認
             smask_ref = our_doc.xref_get_key(xref, 'SMask')
@@ -58,9 +58,9 @@ def compare_smask_methods():
     for i, img_info in enumerate(acrobat_images[:3]):
         xref = img_info[0]
         try:
-            base_image = acrobat_doc.extract_image(xref)
-            width = base_image['width']
-            height = base_image['height']
+            # 幅・高さは辞書から読む（extract_imageはストリーム全体を取り出すので使わない）
+            width = int(acrobat_doc.xref_get_key(xref, 'Width')[1])
+            height = int(acrobat_doc.xref_get_key(xref, 'Height')[1])
             
             # SMask確認
             smask_ref = acrobat_doc.xref_get_key(xref, 'SMask')
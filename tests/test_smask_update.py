@@ -48,32 +48,26 @@ def test_smask_update_methods():
         print(f"元画像: {base_image['width']}x{base_image['height']} {base_image['ext']}")
         print(f"SMask: {smask_image['width']}x{smask_image['height']} {smask_image['ext']}")
         
-        # 2. RGBA画像に合成
+        # 2. ベース画像とSMaskを開く
+        # どちらもすぐ64x64に縮小するので、JPEGならdraftで縮小デコードする
+        # （サイズが違っても最後に同じサイズになるので、SMaskをベースに合わせる縮小はしない）
         jpeg_img = Image.open(io.BytesIO(base_image['image']))
+        jpeg_img.draft('RGB', (64, 64))
         smask_img = Image.open(io.BytesIO(smask_image['image']))
-        
-        # サイズ調整
-        if jpeg_img.size != smask_img.size:
-            smask_img = smask_img.resize(jpeg_img.size, Image.Resampling.LANCZOS)
+        smask_img.draft('L', (64, 64))
             
         # SMaskをグレースケールに変換
         if smask_img.mode != 'L':
             smask_img = smask_img.convert('L')
             
-        # RGBA合成
         if jpeg_img.mode != 'RGB':
             jpeg_img = jpeg_img.convert('RGB')
             
-        r, g, b = jpeg_img.split()
-        rgba_img = Image.merge('RGBA', (r, g, b, smask_img))
-        
         # 3. 64x64にリサイズ（テスト用）
-        small_img = rgba_img.resize((64, 64), Image.Resampling.LANCZOS)
-        
         # 4. JPEG+SMask分離
-        r, g, b, a = small_img.split()
-        new_jpeg_img = Image.merge('RGB', (r, g, b))
-        new_alpha_img = a
+        # RGBAに合成して縮小し、また分けるのは往復になるだけなので、RGBとアルファを別々に縮小する
+        new_jpeg_img = jpeg_img.resize((64, 64), Image.Resampling.LANCZOS)
+        new_alpha_img = smask_img.resize((64, 64), Image.Resampling.LANCZOS)
         
         # JPEG保存
         jpeg_output = io.BytesIO()
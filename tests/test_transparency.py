@@ -31,10 +31,15 @@ def create_transparency_test_pdf(output_path):
     page.insert_image(rect, stream=red_jpeg.getvalue())
     
     # 2. 背景パターンを追加（透明度の効果を確認するため）
+    # page.draw_rect は1回ごとにShapeを作ってコンテンツストリームに書き込むので、
+    # 市松模様の矩形は1つのShapeにまとめて1回でコミットする
+    shape = page.new_shape()
     for i in range(0, 600, 40):
         for j in range(0, 400, 40):
             if (i//40 + j//40) % 2 == 0:
-                page.draw_rect(fitz.Rect(i, j, i+40, j+40), color=(0.9, 0.9, 0.9), fill=(0.9, 0.9, 0.9))
+                shape.draw_rect(fitz.Rect(i, j, i+40, j+40))
+    shape.finish(color=(0.9, 0.9, 0.9), fill=(0.9, 0.9, 0.9))
+    shape.commit()
     
     # テキスト追加
     page.insert_text((300, 100), "透明度テスト", fontsize=20)
@@ -3,7 +3,6 @@
 import fitz
 from PIL import Image, ImageDraw
 import io
-import os
 import zlib
 
 def test_xref_bypass():
@@ -21,8 +20,8 @@ def test_xref_bypass():
     rect = fitz.Rect(50, 50, 250, 250)
     page.insert_image(rect, stream=orig_jpeg.getvalue())
     
-    temp_pdf = "temp_xref_test.pdf"
-    doc.save(temp_pdf)
+    # 元の状態はファイルに書かずメモリに持ち、開き直すときもそこから開く
+    pristine_pdf = doc.tobytes()
     doc.close()
     
     print("=== xrefバイパステスト ===")
@@ -36,7 +35,7 @@ def test_xref_bypass():
     print(f"PNGデータサイズ: {len(png_data):,} bytes")
     
     # PDFを開いて画像xref特定
-    doc2 = fitz.open(temp_pdf)
+    doc2 = fitz.open(stream=pristine_pdf, filetype='pdf')
     page2 = doc2[0]
     images = page2.get_images()
     xref = images[0][0]
@@ -46,13 +45,12 @@ def test_xref_bypass():
     # 1. 現在の方法での置換（参照用）
     print(f"\\n1. 通常のreplace_image:")
     page2.replace_image(xref, stream=png_data)
-    doc2.save("test_normal_replace.pdf", deflate=True)
-    size_normal = os.path.getsize("test_normal_replace.pdf")
+    size_normal = len(doc2.tobytes(deflate=True))
     print(f"  ファイルサイズ: {size_normal:,} bytes")
     
     # 元の状態に戻す
     doc2.close()
-    doc2 = fitz.open(temp_pdf)
+    doc2 = fitz.open(stream=pristine_pdf, filetype='pdf')
     page2 = doc2[0]
     
     # 2. 低レベルxref操作を試す
@@ -118,20 +116,12 @@ def test_xref_bypass():
         print(f"  _getXrefStream エラー: {e}")
     
     # 4. 結果確認
-    doc2.save("test_xref_bypass.pdf", deflate=True)
-    size_bypass = os.path.getsize("test_xref_bypass.pdf")
+    size_bypass = len(doc2.tobytes(deflate=True))
     print(f"\\n結果:")
     print(f"  通常置換: {size_normal:,} bytes")
     print(f"  xrefバイパス: {size_bypass:,} bytes")
     
     doc2.close()
-    
-    # クリーンアップ
-    for f in [temp_pdf, "test_normal_replace.pdf", "test_xref_bypass.pdf"]:
-        try:
-            os.remove(f)
-        except:
-            pass
 
 if __name__ == "__main__":
     test_xref_bypass()
\ No newline at end of file